@@ -0,0 +1,151 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from config import settings
+from janitor import janitor
+from system_monitor import SystemMonitor
+from video_processor import video_processor
+
+logger = logging.getLogger(__name__)
+
+# Разрешение, которое предполагается, пока вход не проанализирован
+DEFAULT_INPUT_WIDTH, DEFAULT_INPUT_HEIGHT = 1920, 1080
+OUTPUT_PIXELS = 1080 * 1920
+# Байт на пиксель кадра yuv420p
+FRAME_BYTES_PER_PIXEL = 1.5
+# Сколько кадров держит x264 (lookahead, опорные кадры, потоки) и декодер
+ENCODER_BUFFERED_FRAMES = 130
+DECODER_BUFFERED_FRAMES = 16
+# Память самого процесса FFmpeg без кадров
+FFMPEG_PROCESS_BASE_BYTES = 50 * 1024 * 1024
+
+MB = 1024 * 1024
+
+
+@dataclass
+class Footprint:
+    """Оценка ресурсов задачи на пике: место на диске и память FFmpeg"""
+    disk_bytes: int
+    memory_bytes: int
+
+    def describe(self) -> str:
+        return f"диск {self.disk_bytes / MB:.0f}MB, память {self.memory_bytes / MB:.0f}MB"
+
+
+class AdmissionController:
+    """
+    Допуск задач к обработке по бюджетам диска и памяти.
+    Запущенные задачи резервируют свою оценку; новая задача допускается,
+    если её оценка укладывается и в настроенные бюджеты, и в реальный запас,
+    измеренный фоновым монитором
+    """
+
+    def __init__(self, monitor: SystemMonitor):
+        self.monitor = monitor
+        self.reserved_disk = 0
+        self.reserved_memory = 0
+
+    def estimate(self, file_size: int, width: int = 0, height: int = 0,
+                 duration: float = 0.0, variants: int = 6) -> Footprint:
+        """Оценивает ресурсы задачи по размеру входа и разрешению"""
+        width = width or DEFAULT_INPUT_WIDTH
+        height = height or DEFAULT_INPUT_HEIGHT
+        ladder = video_processor.get_quality_ladder(variants)
+
+        # Диск: вход, аудиодорожка и все варианты с превью
+        if duration > 0:
+            info = {'duration': duration, 'bitrate': file_size * 8 / duration, 'has_audio': True}
+            outputs_mb = sum(min(video_processor.predict_variant_size_mb(quality, info), settings.upload_limit_mb)
+                             for quality in ladder)
+        else:
+            # Длительность неизвестна - варианты больше лимита отправки всё равно отбрасываются
+            outputs_mb = len(ladder) * settings.upload_limit_mb
+        disk_bytes = file_size + int(outputs_mb * MB)
+        # Длинное видео кодируется кусками: нарезка без перекодирования - ещё одна копия видео
+        segments = 0
+        if duration > 0 and video_processor.should_segment({'duration': duration}):
+            segments = video_processor.get_segment_count({'duration': duration})
+        if segments > 1:
+            disk_bytes += file_size
+
+        # Память: кадры, которые держат кодировщики и декодеры одновременно
+        if segments > 1:
+            # Куски варианта кодируются отдельными процессами x264 параллельно
+            encoders = processes = video_processor.get_segment_parallel(segments)
+        elif settings.encode_engine == "single_pass":
+            encoders, processes = len(ladder), 1
+        else:
+            encoders = max(1, min(settings.max_parallel_encodes, len(ladder)))
+            processes = encoders
+        encoder_bytes = OUTPUT_PIXELS * FRAME_BYTES_PER_PIXEL * ENCODER_BUFFERED_FRAMES
+        decoder_bytes = width * height * FRAME_BYTES_PER_PIXEL * DECODER_BUFFERED_FRAMES
+        memory_bytes = processes * (FFMPEG_PROCESS_BASE_BYTES + decoder_bytes) + encoders * encoder_bytes
+        if settings.delivery_mode == "album":
+            # Альбом читает готовые варианты в память целиком
+            memory_bytes += outputs_mb * MB
+
+        return Footprint(disk_bytes=int(disk_bytes), memory_bytes=int(memory_bytes))
+
+    def disk_usage(self) -> int:
+        """
+        Занято рабочими файлами на диске, где замеряется disk_free.
+        Каталог в RAM (tmpfs) сюда не входит: его освобождение места на диске не добавит
+        """
+        return janitor.usage('temp') + janitor.usage('output')
+
+    def rejection_reason(self, footprint: Footprint) -> Optional[str]:
+        """Причина отказа, если задача не поместится даже на пустом сервере"""
+        if settings.disk_budget_mb and footprint.disk_bytes > settings.disk_budget_mb * MB:
+            return (f"нужно около {footprint.disk_bytes / MB:.0f}MB на диске, "
+                    f"а бюджет - {settings.disk_budget_mb}MB")
+        if settings.memory_budget_mb and footprint.memory_bytes > settings.memory_budget_mb * MB:
+            return (f"нужно около {footprint.memory_bytes / MB:.0f}MB памяти, "
+                    f"а бюджет - {settings.memory_budget_mb}MB")
+
+        snapshot = self.monitor.snapshot()
+        # Свободное место, если бы рабочие файлы уже были удалены
+        disk_capacity = snapshot['disk_free'] + self.disk_usage() - settings.disk_reserve_mb * MB
+        if footprint.disk_bytes > disk_capacity:
+            return f"на сервере не хватает места (нужно около {footprint.disk_bytes / MB:.0f}MB)"
+        memory_capacity = (snapshot['memory_available'] + snapshot['children_rss']
+                           - settings.memory_reserve_mb * MB)
+        if footprint.memory_bytes > memory_capacity:
+            return f"на сервере не хватает памяти (нужно около {footprint.memory_bytes / MB:.0f}MB)"
+        return None
+
+    def fits(self, footprint: Footprint) -> bool:
+        """Поместится ли задача рядом с уже запущенными"""
+        if settings.disk_budget_mb and self.reserved_disk + footprint.disk_bytes > settings.disk_budget_mb * MB:
+            return False
+        if (settings.memory_budget_mb
+                and self.reserved_memory + footprint.memory_bytes > settings.memory_budget_mb * MB):
+            return False
+
+        # Реальный запас: к свободному добавляем то, что уже занято задачами,
+        # и вычитаем их резерв, чтобы не учитывать их дважды
+        snapshot = self.monitor.snapshot()
+        disk_headroom = snapshot['disk_free'] + self.disk_usage() - self.reserved_disk
+        if disk_headroom - footprint.disk_bytes < settings.disk_reserve_mb * MB:
+            return False
+        memory_headroom = snapshot['memory_available'] + snapshot['children_rss'] - self.reserved_memory
+        if memory_headroom - footprint.memory_bytes < settings.memory_reserve_mb * MB:
+            return False
+        return True
+
+    def reserve(self, footprint: Footprint):
+        """Резервирует ресурсы запущенной задачи"""
+        self.reserved_disk += footprint.disk_bytes
+        self.reserved_memory += footprint.memory_bytes
+
+    def release(self, footprint: Footprint):
+        """Освобождает резерв завершившейся задачи"""
+        self.reserved_disk = max(0, self.reserved_disk - footprint.disk_bytes)
+        self.reserved_memory = max(0, self.reserved_memory - footprint.memory_bytes)
+
+    def adjust(self, footprint: Footprint, refined: Footprint):
+        """Заменяет резерв задачи уточнённой оценкой (после анализа входа)"""
+        self.release(footprint)
+        footprint.disk_bytes = refined.disk_bytes
+        footprint.memory_bytes = refined.memory_bytes
+        self.reserve(footprint)
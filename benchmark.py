@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+VideoBot - бенчмарк конвейера кодирования
+Генерирует синтетические входы (lavfi testsrc2 + sine), прогоняет
+compress_and_resize_video и create_multiple_variants в каждом движке
+и печатает результаты в JSON для сравнения между коммитами
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, List, Optional
+
+# Добавляем текущую директорию в путь
+sys.path.insert(0, str(Path(__file__).parent))
+
+import ffmpeg
+import psutil
+
+from config import settings
+from video_processor import video_processor
+
+logger = logging.getLogger(__name__)
+
+# segmented - варианты движка sequential, закодированные по кускам (см. segment_min_duration);
+# остальные движки замеряются с выключенным сегментным кодированием при любой длительности
+ENGINES = ("sequential", "single_pass", "segmented")
+
+# Синтетические входы: имя -> (ширина, высота, длительность в секундах)
+BENCHMARK_CASES = {
+    "landscape_1080p_10s": (1920, 1080, 10),
+    "landscape_720p_30s": (1280, 720, 30),
+    "vertical_1080x1920_10s": (1080, 1920, 10),
+    "square_720_10s": (720, 720, 10),
+    "classic_640x480_60s": (640, 480, 60),
+}
+
+# Как часто замерять память FFmpeg, секунды
+RSS_SAMPLE_INTERVAL = 0.1
+
+
+def generate_input(work_dir: Path, name: str, width: int, height: int, duration: float) -> Path:
+    """Создает синтетическое видео со звуком (переиспользуется между запусками)"""
+    input_path = work_dir / f"{name}.mp4"
+    if input_path.exists():
+        return input_path
+
+    video = ffmpeg.input(f"testsrc2=size={width}x{height}:rate=30:duration={duration}", f='lavfi')
+    audio = ffmpeg.input(f"sine=frequency=440:sample_rate=48000:duration={duration}", f='lavfi')
+    (
+        ffmpeg
+        .output(video, audio, str(input_path),
+                vcodec='libx264', preset='veryfast', crf=20, pix_fmt='yuv420p',
+                acodec='aac', audio_bitrate='128k', movflags='faststart')
+        .overwrite_output()
+        .run(quiet=True)
+    )
+    logger.info(f"Создан вход {input_path.name}: {width}x{height}, {duration}с")
+    return input_path
+
+
+def get_commit() -> Optional[str]:
+    """Текущий коммит репозитория, чтобы результаты можно было сопоставить"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def children_cpu_seconds() -> float:
+    """Процессорное время завершившихся дочерних процессов (FFmpeg), как RUSAGE_CHILDREN"""
+    cpu_times = psutil.Process().cpu_times()
+    return cpu_times.children_user + cpu_times.children_system
+
+
+async def sample_peak_rss(state: dict):
+    """Замеряет суммарную память процессов FFmpeg, пока задача не отменена"""
+    current = psutil.Process()
+    while True:
+        rss = 0
+        for child in current.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        state['peak_rss'] = max(state['peak_rss'], rss)
+        await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+
+async def measure(run: Callable[[], Awaitable[List[Path]]], duration: float) -> dict:
+    """Запускает замер: время, CPU, пиковая память и размеры выходных файлов"""
+    state = {'peak_rss': 0}
+    sampler = asyncio.create_task(sample_peak_rss(state))
+
+    cpu_before = children_cpu_seconds()
+    started_at = time.perf_counter()
+    try:
+        outputs = await run()
+    finally:
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+    wall_time = time.perf_counter() - started_at
+    cpu_seconds = children_cpu_seconds() - cpu_before
+
+    return {
+        'success': bool(outputs),
+        'wall_seconds': round(wall_time, 3),
+        'cpu_seconds': round(cpu_seconds, 3),
+        'peak_rss_mb': round(state['peak_rss'] / (1024 * 1024), 1),
+        # Во сколько раз быстрее реального времени обработан вход
+        'realtime_factor': round(duration / wall_time, 3) if wall_time else None,
+        'output_sizes_bytes': [path.stat().st_size for path in outputs if path.exists()],
+    }
+
+
+async def run_case(name: str, input_path: Path, duration: float, engine: str,
+                   output_dir: Path, variants: int) -> List[dict]:
+    """Прогоняет один вход через одиночное сжатие и создание вариантов"""
+    results = []
+    if engine == "segmented":
+        segments = video_processor.get_segment_count({'duration': duration})
+        if segments < 2:
+            logger.warning(f"⏭ {name}: вход {duration:g}с слишком короткий для сегментного кодирования")
+            return results
+        settings.encode_engine = "sequential"
+        settings.segment_min_duration = 1
+        # Одиночное сжатие не режется на куски - его замер совпал бы с sequential
+        stages = ('create_multiple_variants',)
+    else:
+        settings.encode_engine = engine
+        settings.segment_min_duration = 0
+        stages = ('compress_and_resize_video', 'create_multiple_variants')
+
+    async def compress() -> List[Path]:
+        output_path = output_dir / f"{name}_compressed.mp4"
+        result = await video_processor.compress_and_resize_video(input_path, output_path)
+        return [output_path] if result and result.get('success') else []
+
+    async def create_variants() -> List[Path]:
+        created = await video_processor.create_multiple_variants(input_path, output_dir, variants)
+        return [variant['path'] for variant in created]
+
+    runs = {'compress_and_resize_video': compress, 'create_multiple_variants': create_variants}
+    for stage in stages:
+        run = runs[stage]
+        logger.info(f"⏱ {name}: {stage}, движок {engine}")
+        measurement = await measure(run, duration)
+        results.append({'case': name, 'engine': engine, 'stage': stage, **measurement})
+
+        # Выходы не копятся между замерами и не влияют на следующий
+        await video_processor.cleanup_temp_files(*video_processor.get_job_outputs(input_path, output_dir))
+        await video_processor.cleanup_temp_files(output_dir / f"{name}_compressed.mp4")
+
+    return results
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    """Запускает все выбранные случаи во всех выбранных движках"""
+    work_dir = args.work_dir
+    output_dir = work_dir / "output"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Подбор параметров рамок детерминирован, размеры выходов сравнимы между запусками
+    random.seed(args.seed)
+
+    results = []
+    for name in args.cases:
+        width, height, duration = BENCHMARK_CASES[name]
+        if args.duration:
+            duration = args.duration
+            name = f"{name.rsplit('_', 1)[0]}_{duration:g}s"
+        input_path = generate_input(work_dir, name, width, height, duration)
+
+        for engine in args.engines:
+            results.extend(await run_case(name, input_path, duration, engine, output_dir, args.variants))
+
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'variants': args.variants,
+        'seed': args.seed,
+        'settings': {
+            'preset_policy': settings.preset_policy,
+            'x264_preset': settings.x264_preset,
+            'max_parallel_encodes': settings.max_parallel_encodes,
+            'segment_count': settings.segment_count,
+            'encode_workers': settings.encode_workers,
+        },
+        'results': results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера кодирования VideoBot")
+    parser.add_argument('--cases', nargs='+', choices=sorted(BENCHMARK_CASES),
+                        default=list(BENCHMARK_CASES), help="Какие входы прогонять")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=list(ENGINES),
+                        help="Движки кодирования вариантов")
+    parser.add_argument('--variants', type=int, default=3, help="Сколько вариантов создавать")
+    parser.add_argument('--duration', type=float, default=None,
+                        help="Переопределить длительность всех входов (быстрый прогон)")
+    parser.add_argument('--seed', type=int, default=42, help="Зерно случайных рамок и цветов")
+    parser.add_argument('--work-dir', type=Path, default=Path("benchmark_data"),
+                        help="Каталог для входов и выходов бенчмарка")
+    parser.add_argument('--output', type=Path, default=None,
+                        help="Файл для JSON с результатами (по умолчанию stdout)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # Логи в stderr, чтобы stdout оставался чистым JSON
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        stream=sys.stderr
+    )
+
+    args = parse_args()
+    args.work_dir.mkdir(parents=True, exist_ok=True)
+    report = asyncio.run(run_benchmark(args))
+
+    report_json = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(report_json, encoding='utf-8')
+        logger.info(f"✅ Результаты сохранены в {args.output}")
+    else:
+        print(report_json)
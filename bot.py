@@ -1,11 +1,12 @@
 import asyncio
 import logging
 import os
+import signal
 import time
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
 
-from telegram import Update, Message
+from telegram import InputMediaVideo, Update, Message
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -15,8 +16,28 @@ from telegram.ext import (
 )
 from telegram.constants import ChatAction
 
+from admission import AdmissionController, Footprint
 from config import settings, SUPPORTED_VIDEO_FORMATS
+from janitor import janitor
+from job_journal import MAX_RESUMES, JobJournal, JournalEntry
+from job_spool import JobSpool
+from metrics import (
+    BYTES_IN, BYTES_OUT, DIR_FILES, DIR_USAGE_BYTES, DOWNLOAD_SECONDS, ENCODE_SECONDS, ENCODE_SPEED,
+    FFMPEG_FAILURES, JOBS_IN_FLIGHT, JOBS_QUEUED, JOBS_TOTAL, PROBE_SECONDS, UPLOAD_SECONDS,
+    start_metrics_server
+)
+from process_supervisor import process_supervisor
+from progress import EditRateLimiter, JobProgress, ProgressMessage
+from result_cache import ResultCache
+from scheduler import JobScheduler, QueueLimitExceeded
+from system_monitor import system_monitor
+from tracing import JobTrace, current_trace, setup_trace_log, trace_span
+from utils import get_processing_stats, validate_video_file
 from video_processor import video_processor
+from workspace import is_streamable, workspace_manager
+
+# Максимум элементов в одном альбоме (send_media_group)
+MEDIA_GROUP_LIMIT = 10
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,9 +51,57 @@ class VideoBot:
     """Телеграм бот для сжатия видео с добавлением случайных рамок"""
     
     def __init__(self):
-        self.application = Application.builder().token(settings.bot_token).build()
+        # Обновления обрабатываются конкурентно: команды не ждут кодирования чужих видео
+        builder = Application.builder().token(settings.bot_token).concurrent_updates(True)
+        if settings.bot_api_base_url:
+            # Локальный сервер Bot API: файлы до 2000MB, в local_mode - прямо с его диска
+            base_url = settings.bot_api_base_url.rstrip('/')
+            server_url = base_url[:-len('/bot')] if base_url.endswith('/bot') else base_url
+            base_file_url = settings.bot_api_base_file_url or f"{server_url}/file/bot"
+            builder = builder.base_url(base_url).base_file_url(base_file_url).local_mode(settings.bot_api_local_mode)
+        self.application = builder.build()
+        # Допуск задач по оценке диска и памяти и реальным замерам ресурсов
+        self.admission = AdmissionController(system_monitor)
+        # Тяжёлые задачи кодирования проходят через общий планировщик
+        self.scheduler = JobScheduler(settings.encode_workers, settings.max_jobs_per_user, self.admission)
+        # В режиме spool задачи кодируют отдельные процессы-воркеры (run.py --mode worker)
+        self.spool = (JobSpool(settings.spool_path, settings.spool_stale_seconds)
+                      if settings.encode_backend == "spool" else None)
+        # Журнал этапов задач: после перезапуска задачи продолжаются, а не теряются
+        self.journal = JobJournal(settings.journal_path)
+        # Процесс останавливается: прерванные задачи остаются в журнале
+        self.stopping = False
+        # Общий лимит правок статусных сообщений для всех задач
+        self.edit_limiter = EditRateLimiter(settings.progress_edits_per_second)
+        # Кэш отправленных вариантов для повторно присланных видео
+        self.result_cache = ResultCache(
+            settings.result_cache_path,
+            settings.result_cache_max_entries,
+            settings.result_cache_ttl_hours
+        )
+        self.metrics_server = None
+        self.janitor_task: Optional[asyncio.Task] = None
+        self.monitor_task: Optional[asyncio.Task] = None
+        self.setup_metrics()
+        if settings.trace_log_enabled:
+            setup_trace_log(settings.trace_log_path, settings.trace_log_max_mb, settings.trace_log_backups)
         self.setup_handlers()
     
+    def setup_metrics(self):
+        """Привязывает вычисляемые метрики к планировщику и временным каталогам"""
+        JOBS_IN_FLIGHT.set_function(lambda: self.job_counts()['running'])
+        JOBS_QUEUED.set_function(lambda: self.job_counts()['queued'])
+        DIR_USAGE_BYTES.set_function(lambda: get_processing_stats()['temp_size'], dir='temp')
+        DIR_USAGE_BYTES.set_function(lambda: get_processing_stats()['output_size'], dir='output')
+        DIR_FILES.set_function(lambda: get_processing_stats()['temp_files'], dir='temp')
+        DIR_FILES.set_function(lambda: get_processing_stats()['output_files'], dir='output')
+    
+    def job_counts(self) -> dict:
+        """Задачи в работе и в очереди: в этом процессе или во всём спуле"""
+        if self.spool is not None:
+            return self.spool.counts()
+        return {'running': self.scheduler.running_count, 'queued': self.scheduler.queued_count}
+    
     def setup_handlers(self):
         """Настройка обработчиков команд и сообщений"""
         
@@ -40,6 +109,7 @@ class VideoBot:
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("help", self.help_command))
         self.application.add_handler(CommandHandler("stats", self.stats_command))
+        self.application.add_handler(CommandHandler("cancel", self.cancel_command))
         
         # Обработка видео файлов
         self.application.add_handler(
@@ -98,6 +168,7 @@ MP4, AVI, MOV, MKV, WEBM, FLV и другие
 /start - Начать работу с ботом
 /help - Показать эту справку
 /stats - Статистика обработки
+/cancel - Отменить обработку ваших видео
 
 📐 *Что получаешь:*
 • 6 вариантов одного видео
@@ -108,13 +179,12 @@ MP4, AVI, MOV, MKV, WEBM, FLV и другие
 • Сохранение пропорций исходного видео
 
 ⚠️ *Ограничения:*
-• Максимальный размер: 20MB (лимит Telegram Bot API)
+• Максимальный размер: {max_size}MB
 • Поддерживаемые форматы: {formats}
 
 💡 *Советы:*
-• Файлы до 20MB обрабатываются надёжно
 • Для больших файлов используйте сжатие перед отправкой
-• Telegram getFile API имеет жёсткий лимит 20MB
+• Видео, отправленное как видео (не документ), Telegram сжимает сам
 
 🔧 *Технические особенности:*
 • 6 настроек качества: от максимального до ультра-компактного
@@ -123,7 +193,7 @@ MP4, AVI, MOV, MKV, WEBM, FLV и другие
 • Bitrate от 400k до 2500k
 • Сохранение аудио в высоком качестве
         """.format(
-            max_size=settings.max_file_size_mb,
+            max_size=settings.max_input_mb,
             formats=", ".join(sorted(SUPPORTED_VIDEO_FORMATS))
         )
         
@@ -133,27 +203,61 @@ MP4, AVI, MOV, MKV, WEBM, FLV и другие
         )
     
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик команды /stats"""
+        """Обработчик команды /stats - сводка тех же метрик, что отдаёт /metrics"""
+        ffmpeg_failures = ", ".join(
+            f"{labels[0]}: {count:.0f}" for labels, count in sorted(FFMPEG_FAILURES.values().items())
+        ) or "нет"
+        
+        if self.spool is not None:
+            # Задачи выполняют процессы-воркеры: их итоги видны в спуле, а счётчики этого процесса пусты
+            outcomes = self.spool.outcome_counts()
+            spool_note = ("\n\nℹ️ Скачивание, кодирование и отправка идут в воркерах - время этапов, "
+                          "трафик и ошибки FFmpeg смотрите на их эндпоинтах метрик (`WORKER_METRICS_PORT`)")
+        else:
+            outcomes = {status: JOBS_TOTAL.value(status=status) for status in ('done', 'failed', 'cancelled')}
+            spool_note = ""
+        
         stats_message = """
 📊 *Статистика VideoBot*
 
-🗂 *Директории:*
-• Временные файлы: `{temp_dir}`
-• Выходные файлы: `{output_dir}`
-
-⚙️ *Настройки:*
-• Максимальный размер: {max_size}MB
-• Поддерживаемых форматов: {formats_count}
+📋 *Задачи:*
+• В работе: {in_flight}, в очереди: {queued}
+• Выполнено{outcome_period}: {done:.0f}, с ошибкой: {failed:.0f}, отменено: {cancelled:.0f}
 
-🎲 *Доступных соотношений сторон:* {ratios_count}
+⏱ *Среднее время этапов:*
+• Скачивание: {download:.1f}с ({download_count})
+• Анализ (ffprobe): {probe:.2f}с ({probe_count})
+• Кодирование варианта: {encode:.1f}с ({encode_count}), скорость {encode_speed:.2f}x
+• Отправка: {upload:.1f}с ({upload_count})
 
-Bot работает стабильно! ✅
+📦 *Трафик:* получено {bytes_in:.1f}MB, отправлено {bytes_out:.1f}MB
+🔧 *Ошибки FFmpeg:* {ffmpeg_failures}
+🗂 *Временные файлы:* {temp_files:.0f} ({temp_size:.1f}MB), выходные: {output_files:.0f} ({output_size:.1f}MB)
+♻️ *Кэш результатов:* {cache_hits} попаданий, {cache_hit_rate:.0%}{spool_note}
         """.format(
-            temp_dir=settings.temp_dir,
-            output_dir=settings.output_dir,
-            max_size=settings.max_file_size_mb,
-            formats_count=len(SUPPORTED_VIDEO_FORMATS),
-            ratios_count=len(video_processor.calculate_resize_params.__code__.co_names)
+            in_flight=self.job_counts()['running'],
+            queued=self.job_counts()['queued'],
+            outcome_period=" (за сутки, все воркеры)" if self.spool is not None else "",
+            **outcomes,
+            download=DOWNLOAD_SECONDS.average,
+            download_count=DOWNLOAD_SECONDS.count,
+            probe=PROBE_SECONDS.average,
+            probe_count=PROBE_SECONDS.count,
+            encode=ENCODE_SECONDS.average,
+            encode_count=ENCODE_SECONDS.count,
+            encode_speed=ENCODE_SPEED.average,
+            upload=UPLOAD_SECONDS.average,
+            upload_count=UPLOAD_SECONDS.count,
+            bytes_in=BYTES_IN.total / (1024 * 1024),
+            bytes_out=BYTES_OUT.total / (1024 * 1024),
+            ffmpeg_failures=ffmpeg_failures,
+            temp_files=DIR_FILES.value(dir='temp'),
+            temp_size=DIR_USAGE_BYTES.value(dir='temp') / (1024 * 1024),
+            output_files=DIR_FILES.value(dir='output'),
+            output_size=DIR_USAGE_BYTES.value(dir='output') / (1024 * 1024),
+            cache_hits=self.result_cache.hits,
+            cache_hit_rate=self.result_cache.hit_rate,
+            spool_note=spool_note
         )
         
         await update.message.reply_text(
@@ -161,6 +265,19 @@ Bot работает стабильно! ✅
             parse_mode='Markdown'
         )
     
+    async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /cancel"""
+        user_id = update.effective_user.id
+        if self.spool is not None:
+            cancelled = self.spool.cancel_user_jobs(user_id)
+        else:
+            cancelled = self.scheduler.cancel_user_jobs(user_id)
+        
+        if cancelled:
+            await update.message.reply_text(f"🛑 Отменено задач: {cancelled}")
+        else:
+            await update.message.reply_text("🤷 У вас нет видео в обработке")
+    
     async def handle_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик видео файлов"""
         message = update.message
@@ -172,19 +289,21 @@ Bot работает стабильно! ✅
         logger.info(f"📋 Детали видео: {video.width}x{video.height}, длительность: {video.duration}с")
         
         # Проверяем размер файла
-        if video.file_size > settings.max_file_size_mb * 1024 * 1024:
-            logger.warning(f"❌ ВИДЕО отклонено: размер {file_size_mb:.2f}MB превышает лимит {settings.max_file_size_mb}MB")
+        if video.file_size > settings.max_input_bytes:
+            logger.warning(f"❌ ВИДЕО отклонено: размер {file_size_mb:.2f}MB превышает лимит {settings.max_input_mb}MB")
             await message.reply_text(
                 f"❌ Видео превышает максимальный размер!\n\n"
                 f"📁 Размер вашего видео: {file_size_mb:.1f}MB\n"
-                f"📏 Максимальный размер: {settings.max_file_size_mb}MB\n\n"
-                f"💡 Уменьшите размер файла до 50MB или меньше"
+                f"📏 Максимальный размер: {settings.max_input_mb}MB\n\n"
+                f"💡 Уменьшите размер файла до {settings.max_input_mb}MB или меньше"
             )
             return
         
-        # Сразу обрабатываем видео с 6 вариантами
-        await self.process_video_file(message, context, video.file_id, 
-                                    video.file_name or f"video_{int(time.time())}.mp4", 6)
+        # Ставим обработку видео с 6 вариантами в очередь
+        await self.enqueue_video_file(message, context, video.file_id, video.file_unique_id,
+                                    video.file_name or f"video_{int(time.time())}.mp4", 6,
+                                    file_size=video.file_size, width=video.width,
+                                    height=video.height, duration=video.duration)
     
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик документов (видео отправленные как документы)"""
@@ -205,18 +324,19 @@ Bot работает стабильно! ✅
         logger.info(f"📋 Имя файла: {document.file_name}, тип: {document.mime_type}")
         
         # Проверяем размер файла
-        if document.file_size > settings.max_file_size_mb * 1024 * 1024:
-            logger.warning(f"❌ ДОКУМЕНТ отклонен: размер {file_size_mb:.2f}MB превышает лимит {settings.max_file_size_mb}MB")
+        if document.file_size > settings.max_input_bytes:
+            logger.warning(f"❌ ДОКУМЕНТ отклонен: размер {file_size_mb:.2f}MB превышает лимит {settings.max_input_mb}MB")
             await message.reply_text(
                 f"❌ Документ превышает максимальный размер!\n\n"
                 f"📁 Размер файла: {file_size_mb:.1f}MB\n"
-                f"📏 Максимальный размер: {settings.max_file_size_mb}MB\n\n"
-                f"💡 Уменьшите размер файла до 50MB или меньше"
+                f"📏 Максимальный размер: {settings.max_input_mb}MB\n\n"
+                f"💡 Уменьшите размер файла до {settings.max_input_mb}MB или меньше"
             )
             return
         
-        # Сразу обрабатываем видео-документ с 6 вариантами
-        await self.process_video_file(message, context, document.file_id, document.file_name, 6)
+        # Ставим обработку видео-документа с 6 вариантами в очередь
+        await self.enqueue_video_file(message, context, document.file_id, document.file_unique_id,
+                                    document.file_name, 6, file_size=document.file_size)
     
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
@@ -231,176 +351,757 @@ Bot работает стабильно! ✅
             "Используй /help для получения справки."
         )
     
-    async def process_video_file(self, message: Message, context: ContextTypes.DEFAULT_TYPE, file_id: str, filename: str, variant_count: int = 6):
-        """Основная функция обработки видео"""
+    async def send_cached_variants(self, message: Message, cache_key: str) -> Tuple[bool, List[dict]]:
+        """
+        Повторно отправляет варианты из кэша по file_id без скачивания и кодирования.
+        Возвращает, все ли варианты отправлены, и уже доставленные варианты -
+        при ошибке их не нужно кодировать и отправлять заново
+        """
+        entries = self.result_cache.get(cache_key)
+        if not entries:
+            return False, []
+        
+        logger.info(f"♻️ Отправляю {len(entries)} вариантов из кэша пользователю {message.from_user.id}")
+        delivered = []
+        for position, entry in enumerate(entries):
+            try:
+                await message.reply_video(
+                    video=entry['file_id'],
+                    caption=entry['caption'],
+                    supports_streaming=True
+                )
+            except Exception as send_error:
+                # file_id мог устареть - запись больше не годится, недоставленные варианты кодируем заново
+                logger.error(f"Ошибка отправки варианта из кэша: {send_error}")
+                self.result_cache.delete(cache_key)
+                return False, delivered
+            # Записи без индекса (до журнала задач) хранятся полным списком в порядке лестницы
+            delivered.append({**entry, 'index': entry.get('index', position)})
+        return True, delivered
+    
+    async def enqueue_video_file(self, message: Message, context: ContextTypes.DEFAULT_TYPE, file_id: str, file_unique_id: str, filename: str, variant_count: int = 6,
+                                 file_size: int = 0, width: int = 0, height: int = 0, duration: float = 0.0):
+        """
+        Ставит обработку видео в очередь планировщика.
+        Размер, разрешение и длительность (если Telegram их сообщил) нужны для оценки ресурсов задачи
+        """
+        user_id = message.from_user.id
+        
+        # Трасса начинается с постановки в очередь, чтобы учитывать ожидание воркера
+        trace = JobTrace(user_id, file_unique_id=file_unique_id, filename=filename, variant_count=variant_count)
+        
+        # Это видео уже обрабатывалось - отвечаем сохранёнными file_id
+        cache_key = ResultCache.make_key(file_unique_id, video_processor.get_quality_ladder(variant_count))
+        with trace.span('cached_send') as span:
+            span['hit'], delivered = await self.send_cached_variants(message, cache_key)
+            span['delivered'] = len(delivered)
+        if span['hit']:
+            trace.finish('cached')
+            return
+        
+        # Задача, которая не поместится даже на свободном сервере, сразу получает вежливый отказ
+        footprint = self.admission.estimate(file_size, width, height, duration or 0.0, variant_count)
+        rejection = self.admission.rejection_reason(footprint)
+        if rejection:
+            trace.finish('rejected')
+            logger.warning(f"❌ Видео пользователя {user_id} не принято ({footprint.describe()}): {rejection}")
+            await message.reply_text(
+                f"😔 Сейчас не получится обработать это видео\n\n"
+                f"🔍 Причина: {rejection}\n\n"
+                f"💡 Попробуйте видео покороче или поменьше"
+            )
+            return
+        trace.set(estimated_disk_bytes=footprint.disk_bytes, estimated_memory_bytes=footprint.memory_bytes)
+        
+        # Всё, что нужно, чтобы выполнить задачу в другом процессе или после перезапуска
+        payload = {
+            'message': message.to_dict(),
+            'file_id': file_id,
+            'file_unique_id': file_unique_id,
+            'filename': filename,
+            'variant_count': variant_count,
+            'cache_key': cache_key,
+            'file_size': file_size,
+            'width': width,
+            'height': height,
+            'duration': duration,
+            'trace_id': trace.trace_id,
+            # Варианты, уже отправленные из кэша до ошибки, - их пропускаем
+            'delivered': delivered
+        }
+        
+        journal_entry = None
+        try:
+            if self.spool is not None:
+                # Задачу заберёт один из процессов-воркеров и сам отправит результат
+                spool_job_id, position = self.spool.submit(user_id, payload, settings.max_jobs_per_user)
+                trace.set(spool_job_id=spool_job_id, queue_position=position)
+                trace.finish('spooled')
+                await message.reply_text(
+                    f"⏳ Видео в очереди: #{position}\n\n"
+                    f"Обработка начнётся автоматически, как только освободится воркер"
+                )
+                return
+            
+            journal_entry = self.journal.start(user_id, payload)
+            for sent in delivered:
+                self.journal.record_uploaded(journal_entry, sent)
+            position = self.scheduler.submit(
+                user_id,
+                lambda: self.process_video_file(message, context, file_id, filename, variant_count,
+                                                cache_key, trace, footprint, journal_entry),
+                footprint,
+                on_cancel=lambda: self.drop_queued_job(journal_entry, trace)
+            )
+        except QueueLimitExceeded:
+            if journal_entry is not None:
+                self.journal.finish(journal_entry)
+            trace.finish('queue_limit')
+            logger.warning(f"❌ Пользователь {user_id} превысил лимит задач в очереди")
+            await message.reply_text(
+                f"⏳ У вас уже {settings.max_jobs_per_user} видео в обработке!\n\n"
+                f"💡 Дождитесь результата и отправьте следующее видео"
+            )
+            return
+        
+        trace.set(queue_position=position)
+        if position > 0:
+            await message.reply_text(
+                f"⏳ Вы #{position} в очереди\n\n"
+                f"Обработка начнётся автоматически, как только освободится место"
+            )
+    
+    def drop_queued_job(self, journal_entry: JournalEntry, trace: JobTrace):
+        """
+        Задачу отменили до запуска: возобновлять её после перезапуска не нужно,
+        а трасса завершается здесь, потому что process_video_file не вызывался
+        """
+        self.journal.finish(journal_entry)
+        janitor.release(journal_entry.prefix)
+        trace.add_span('queue', trace.started_monotonic, time.monotonic())
+        trace.finish('cancelled')
+    
+    def build_variant_caption(self, variant: dict, video_info: dict) -> str:
+        """Формирует подпись к отправляемому варианту"""
+        return (f"✅ Вариант {variant['index']+1}/{variant['count']}: {variant['name']}\n\n"
+                f"📐 Исходный размер: {video_info['width']}x{video_info['height']}"
+                f"{' (поворот ' + str(video_info['rotation']) + '°)' if video_info['rotation'] else ''}\n"
+                f"📐 Новый размер: 1080x1920 (Stories)\n"
+                f"⏱ Длительность: {video_info['duration']:.1f}с\n"
+                f"📁 Размер: {variant['size_mb']:.1f}MB\n"
+                f"🎯 Качество: CRF {variant['quality']}, пресет {variant['preset']}\n"
+                f"🎨 Цвет рамки: {variant['frame_color']}\n"
+                f"🖼 Толщина рамки: {variant['frame_thickness']} ({variant['frame_thickness_px']}px)")
+    
+    def variant_files(self, variant: dict) -> List[Path]:
+        """Файлы варианта на диске: видео и превью, если оно есть"""
+        return [path for path in (variant['path'], variant.get('thumbnail')) if path]
+    
+    async def send_variant(self, message: Message, variant: dict, caption: str) -> Optional[dict]:
+        """Отправляет один вариант отдельным сообщением и удаляет его файлы"""
+        try:
+            # Готовое превью избавляет Telegram от генерации его на сервере
+            thumbnail = None
+            if variant.get('thumbnail'):
+                thumbnail = await asyncio.to_thread(variant['thumbnail'].read_bytes)
+            size = variant['path'].stat().st_size
+            started_at = time.monotonic()
+            with trace_span('upload', variant=variant['index'] + 1, bytes=size):
+                with open(variant['path'], 'rb') as video_file:
+                    sent_message = await message.reply_video(
+                        video=video_file,
+                        caption=caption,
+                        thumbnail=thumbnail,
+                        supports_streaming=True,
+                        read_timeout=60,
+                        write_timeout=60
+                    )
+            UPLOAD_SECONDS.observe(time.monotonic() - started_at)
+            BYTES_OUT.inc(size)
+            return {'file_id': sent_message.video.file_id, 'caption': caption, 'index': variant['index']}
+        except Exception as upload_error:
+            logger.error(f"Ошибка отправки варианта {variant['index']+1}: {upload_error}")
+            return None
+        finally:
+            # Файлы варианта больше не нужны
+            await video_processor.cleanup_temp_files(*self.variant_files(variant))
+    
+    async def send_album(self, message: Message, variants: List[dict], captions: List[str]) -> List[dict]:
+        """Отправляет группу вариантов одним альбомом и удаляет их файлы"""
+        try:
+            # Файлы читаются параллельно и вне цикла событий
+            contents = await asyncio.gather(
+                *(asyncio.to_thread(variant['path'].read_bytes) for variant in variants)
+            )
+            thumbnails = await asyncio.gather(
+                *(asyncio.to_thread(variant['thumbnail'].read_bytes) if variant.get('thumbnail')
+                  else asyncio.sleep(0, result=None) for variant in variants)
+            )
+            media = [
+                InputMediaVideo(
+                    media=content,
+                    caption=caption,
+                    filename=variant['path'].name,
+                    thumbnail=thumbnail,
+                    supports_streaming=True
+                )
+                for variant, content, thumbnail, caption in zip(variants, contents, thumbnails, captions)
+            ]
+            started_at = time.monotonic()
+            with trace_span('upload', variants=[variant['index'] + 1 for variant in variants],
+                            bytes=sum(len(content) for content in contents)):
+                sent_messages = await message.reply_media_group(
+                    media=media,
+                    read_timeout=120,
+                    write_timeout=120
+                )
+            UPLOAD_SECONDS.observe(time.monotonic() - started_at)
+            BYTES_OUT.inc(sum(len(content) for content in contents))
+            return [
+                {'file_id': sent_message.video.file_id, 'caption': caption, 'index': variant['index']}
+                for sent_message, variant, caption in zip(sent_messages, variants, captions)
+            ]
+        except Exception as upload_error:
+            logger.error(f"Ошибка отправки альбома из {len(variants)} вариантов: {upload_error}")
+            return []
+        finally:
+            await video_processor.cleanup_temp_files(
+                *(path for variant in variants for path in self.variant_files(variant))
+            )
+    
+    def group_album_variants(self, variants: List[dict]) -> List[List[dict]]:
+        """Делит варианты на альбомы с учётом лимита Telegram на число и размер файлов"""
+        groups = []
+        current_group = []
+        current_size_mb = 0.0
+        
+        for variant in variants:
+            # Слишком большой файл отправляется отдельно
+            if variant['size_mb'] > settings.upload_limit_mb:
+                groups.append([variant])
+                continue
+            
+            if (len(current_group) >= MEDIA_GROUP_LIMIT
+                    or current_size_mb + variant['size_mb'] > settings.upload_limit_mb):
+                groups.append(current_group)
+                current_group, current_size_mb = [], 0.0
+            
+            current_group.append(variant)
+            current_size_mb += variant['size_mb']
+        
+        if current_group:
+            groups.append(current_group)
+        return groups
+    
+    async def upload_variants(self, message: Message, variants_queue: asyncio.Queue,
+                              video_info: dict,
+                              on_sent: Optional[Callable[[dict], None]] = None) -> Tuple[List[dict], int]:
+        """
+        Потребитель конвейера: отправляет готовые варианты и сразу удаляет их файлы.
+        Возвращает отправленные file_id с подписями и число полученных вариантов;
+        on_sent вызывается для каждого отправленного варианта (запись в журнал)
+        """
+        sent_entries = []
+        variants = []
+        started_at = time.monotonic()
+        
+        while True:
+            variant = await variants_queue.get()
+            if variant is None:
+                break
+            
+            variants.append(variant)
+            if settings.delivery_mode == "album":
+                # Альбом собирается целиком после кодирования всех вариантов
+                continue
+            
+            entry = await self.send_variant(message, variant, self.build_variant_caption(variant, video_info))
+            if entry:
+                sent_entries.append(entry)
+                if on_sent:
+                    on_sent(entry)
+                if len(sent_entries) == 1:
+                    logger.info(f"📤 Первый вариант отправлен через {time.monotonic() - started_at:.1f}с")
+        
+        if settings.delivery_mode == "album" and variants:
+            upload_started_at = time.monotonic()
+            sends = []
+            for group in self.group_album_variants(variants):
+                captions = [self.build_variant_caption(variant, video_info) for variant in group]
+                if len(group) == 1:
+                    # Альбом должен содержать минимум 2 элемента
+                    sends.append(self.send_variant(message, group[0], captions[0]))
+                else:
+                    sends.append(self.send_album(message, group, captions))
+            
+            for result in await asyncio.gather(*sends):
+                entries = result if isinstance(result, list) else [result] if result else []
+                sent_entries.extend(entries)
+                if on_sent:
+                    for entry in entries:
+                        on_sent(entry)
+            logger.info(f"📤 Отправка {len(variants)} вариантов ({len(sends)} запросов) "
+                        f"заняла {time.monotonic() - upload_started_at:.1f}с")
+        
+        logger.info(f"📤 Отправлено {len(sent_entries)}/{len(variants)} вариантов, "
+                    f"общее время отправки {time.monotonic() - started_at:.1f}с")
+        return sent_entries, len(variants)
+    
+    async def process_video_file(self, message: Message, context: ContextTypes.DEFAULT_TYPE, file_id: str, filename: str, variant_count: int = 6, cache_key: Optional[str] = None, trace: Optional[JobTrace] = None, footprint: Optional[Footprint] = None, journal_entry: Optional[JournalEntry] = None):
+        """
+        Основная функция обработки видео.
+        journal_entry - запись задачи в журнале; при возобновлении после перезапуска
+        в ней уже отмечены скачанный файл и готовые или отправленные варианты
+        Возвращает итоговый статус задачи (тот же, что в трассе)
+        """
         user_id = message.from_user.id
         logger.info(f"Начинаю обработку видео для пользователя {user_id}, файл: {filename}")
         
+        # Этапы задачи (в том числе в дочерних задачах кодирования и отправки) пишутся в её трассу
+        trace = trace or JobTrace(user_id, filename=filename, variant_count=variant_count)
+        trace.add_span('queue', trace.started_monotonic, time.monotonic())
+        trace_token = current_trace.set(trace)
+        trace.status = 'failed'
+        
+        if journal_entry is None:
+            journal_entry = self.journal.start(user_id, {
+                'message': message.to_dict(), 'file_id': file_id,
+                'file_unique_id': trace.attributes.get('file_unique_id'), 'filename': filename,
+                'variant_count': variant_count, 'cache_key': cache_key, 'file_size': 0,
+                'width': 0, 'height': 0, 'duration': 0.0, 'trace_id': trace.trace_id
+            })
+        trace.set(journal_id=journal_entry.job_id, resumes=journal_entry.resumes)
+        
         # Уведомляем пользователя о начале обработки
-        await message.reply_text("🎬 Начинаю обработку видео...")
+        if journal_entry.resumes:
+            await message.reply_text("🔄 Бот перезапускался - продолжаю обработку вашего видео...")
+        else:
+            await message.reply_text("🎬 Начинаю обработку видео...")
         
         # Показываем индикатор "загрузка видео"
         await message.chat.send_action(ChatAction.UPLOAD_VIDEO)
         
-        # Создаем уникальные имена файлов
-        timestamp = int(time.time())
-        temp_input_path = settings.temp_dir / f"{user_id}_{timestamp}_input_{filename}"
-        temp_output_path = settings.output_dir / f"{user_id}_{timestamp}_output.mp4"
+        # Рабочие каталоги задачи: в RAM, если задача туда помещается, иначе на диске
+        workspace = workspace_manager.acquire(
+            (footprint or self.admission.estimate(0, variants=variant_count)).disk_bytes
+        )
+        trace.set(workspace='ram' if workspace.in_ram else 'disk')
+        
+        # Уникальные имена файлов задачи (префикс хранится в журнале и не меняется после перезапуска)
+        job_prefix = journal_entry.prefix
+        temp_input_path = workspace.temp_dir / f"{job_prefix}input_{filename}"
+        temp_output_path = workspace.output_dir / f"{job_prefix}output.mp4"
+        # Уборщик не трогает файлы задачи, пока она в работе
+        janitor.protect(job_prefix)
         
         try:
-            # Скачиваем файл
-            progress_message = await message.reply_text("📥 Скачиваю видео...")
+            resumed_input = journal_entry.input_path
+            if resumed_input is not None and resumed_input.exists():
+                # Видео скачано до перезапуска - продолжаем с анализа
+                temp_input_path = resumed_input
+                janitor.track(temp_input_path)
+                progress_message = await message.reply_text("📥 Видео уже скачано, продолжаю...")
+            else:
+                # Скачиваем файл
+                progress_message = await message.reply_text("📥 Скачиваю видео...")
             
-            try:
-                file = await context.bot.get_file(file_id)
-                
-                # Логируем детальную информацию о файле через Bot API
-                api_file_size_mb = file.file_size / (1024*1024)
-                logger.info(f"🔍 Bot API информация:")
-                logger.info(f"   📏 Размер: {api_file_size_mb:.2f}MB ({file.file_size} bytes)")
-                logger.info(f"   📂 Путь: {file.file_path}")
-                logger.info(f"   🆔 File ID: {file.file_id}")
+                try:
+                    download_started_at = time.monotonic()
+                    file = await context.bot.get_file(file_id)
+                    trace.add_span('get_file', download_started_at, time.monotonic(),
+                                   file_size=file.file_size, file_path=file.file_path)
                 
-                # Дополнительная проверка размера файла через Bot API  
-                if file.file_size > 20 * 1024 * 1024:  # 20MB жёсткий лимит
-                    await progress_message.edit_text(
-                        f"❌ Файл превышает максимальный лимит!\n\n"
-                        f"📁 Размер файла: {file.file_size / (1024*1024):.1f}MB\n"
-                        f"📏 Лимит Telegram Bot API: 20MB (жёсткий)\n\n"
-                        f"💡 Уменьшите размер файла до 20MB или меньше"
-                    )
-                    return
+                    # Логируем детальную информацию о файле через Bot API
+                    api_file_size_mb = file.file_size / (1024*1024)
+                    logger.info(f"🔍 Bot API информация:")
+                    logger.info(f"   📏 Размер: {api_file_size_mb:.2f}MB ({file.file_size} bytes)")
+                    logger.info(f"   📂 Путь: {file.file_path}")
+                    logger.info(f"   🆔 File ID: {file.file_id}")
                 
-                # Скачиваем файл
-                if file.file_size > 15 * 1024 * 1024:  # 15MB+
-                    # Для файлов больше 15MB используем увеличенный таймаут
-                    download_task = asyncio.create_task(file.download_to_drive(temp_input_path))
-                    try:
-                        await asyncio.wait_for(download_task, timeout=300)  # 5 минут для больших файлов
-                    except asyncio.TimeoutError:
+                    # Дополнительная проверка размера файла через Bot API (тот же лимит, что при приёме)
+                    if file.file_size > settings.max_input_bytes:
                         await progress_message.edit_text(
-                            f"❌ Таймаут скачивания (5 минут)!\n\n"
-                            f"📁 Файл слишком большой: {file.file_size / (1024*1024):.1f}MB\n"
-                            f"💡 Попробуйте файл меньшего размера"
+                            f"❌ Файл превышает максимальный лимит!\n\n"
+                            f"📁 Размер файла: {file.file_size / (1024*1024):.1f}MB\n"
+                            f"📏 Максимальный размер: {settings.max_input_mb}MB\n\n"
+                            f"💡 Уменьшите размер файла до {settings.max_input_mb}MB или меньше"
                         )
-                        return
-                else:
-                    await file.download_to_drive(temp_input_path)
+                        trace.status = 'too_big'
+                        return trace.status
                 
-                # Логируем размер скачанного файла
-                if temp_input_path.exists():
-                    downloaded_size = temp_input_path.stat().st_size
-                    downloaded_size_mb = downloaded_size / (1024*1024)
-                    logger.info(f"✅ Файл скачан:")
-                    logger.info(f"   📏 Реальный размер: {downloaded_size_mb:.2f}MB ({downloaded_size} bytes)")
-                    logger.info(f"   📂 Путь: {temp_input_path}")
+                    # Скачиваем файл
+                    transfer_started_at = time.monotonic()
+                    local_path = Path(file.file_path) if settings.bot_api_local_mode and file.file_path else None
+                    if local_path is not None and local_path.is_absolute() and local_path.exists():
+                        # Локальный сервер Bot API уже сохранил файл - FFmpeg читает его на месте.
+                        # Файл принадлежит серверу: задача его не копирует и не удаляет
+                        video_processor.attach_external_input(temp_input_path, local_path)
+                        trace.set(input_source='local_api')
+                    elif settings.memory_input_max_mb and file.file_size <= settings.memory_input_max_mb * 1024 * 1024:
+                        # Небольшие видео скачиваем в память: FFmpeg читает их через stdin,
+                        # если контейнер читается потоком, иначе файл пишется в рабочий каталог
+                        data = bytes(await file.download_as_bytearray())
+                        if is_streamable(data):
+                            video_processor.attach_memory_input(temp_input_path, data)
+                            trace.set(input_source='pipe')
+                        else:
+                            await asyncio.to_thread(temp_input_path.write_bytes, data)
+                            trace.set(input_source='file')
+                    elif file.file_size > 15 * 1024 * 1024:  # 15MB+
+                        # Для файлов больше 15MB используем увеличенный таймаут
+                        download_task = asyncio.create_task(file.download_to_drive(temp_input_path))
+                        try:
+                            await asyncio.wait_for(download_task, timeout=300)  # 5 минут для больших файлов
+                        except asyncio.TimeoutError:
+                            await progress_message.edit_text(
+                                f"❌ Таймаут скачивания (5 минут)!\n\n"
+                                f"📁 Файл слишком большой: {file.file_size / (1024*1024):.1f}MB\n"
+                                f"💡 Попробуйте файл меньшего размера"
+                            )
+                            trace.status = 'download_timeout'
+                            return trace.status
+                    else:
+                        await file.download_to_drive(temp_input_path)
+                
+                    # Логируем размер скачанного файла
+                    if video_processor.has_input(temp_input_path):
+                        downloaded_size = video_processor.input_size(temp_input_path)
+                        downloaded_size_mb = downloaded_size / (1024*1024)
+                        logger.info(f"✅ Файл скачан:")
+                        logger.info(f"   📏 Реальный размер: {downloaded_size_mb:.2f}MB ({downloaded_size} bytes)")
+                        logger.info(f"   📂 Путь: {temp_input_path}")
+                        DOWNLOAD_SECONDS.observe(time.monotonic() - download_started_at)
+                        BYTES_IN.inc(downloaded_size)
+                        trace.add_span('download', transfer_started_at, time.monotonic(), bytes=downloaded_size)
+                        trace.set(input_bytes=downloaded_size)
+                        janitor.track(temp_input_path)
+                        if temp_input_path.exists():
+                            # Файл на диске переживёт перезапуск, вход в памяти придётся скачать заново
+                            self.journal.record_download(journal_entry, temp_input_path)
                     
-                    # Сравниваем размеры
-                    if abs(downloaded_size - file.file_size) > 1024:  # Разница больше 1KB
-                        logger.warning(f"⚠️ Размеры не совпадают! API: {file.file_size} bytes, файл: {downloaded_size} bytes")
-                else:
-                    logger.error(f"❌ Файл не был скачан: {temp_input_path} не существует")
+                        # Сравниваем размеры
+                        if abs(downloaded_size - file.file_size) > 1024:  # Разница больше 1KB
+                            logger.warning(f"⚠️ Размеры не совпадают! API: {file.file_size} bytes, файл: {downloaded_size} bytes")
+                    else:
+                        logger.error(f"❌ Файл не был скачан: {temp_input_path} не существует")
                 
-            except Exception as download_error:
-                error_msg = str(download_error)
-                logger.error(f"Ошибка скачивания файла: {error_msg}")
+                except Exception as download_error:
+                    error_msg = str(download_error)
+                    logger.error(f"Ошибка скачивания файла: {error_msg}")
+                    trace.status = 'download_failed'
+                    trace.set(error=error_msg[:200])
                 
-                if "File is too big" in error_msg or "too large" in error_msg or "Request Entity Too Large" in error_msg:
-                    await progress_message.edit_text(
-                        f"❌ Telegram не может скачать такой большой файл!\n\n"
-                        f"🔍 Причины:\n"
-                        f"• Файл больше лимитов Bot API\n"
-                        f"• Отправлен как документ (без сжатия)\n"
-                        f"• Проблемы с сетью\n\n"
-                        f"💡 Решения:\n"
-                        f"• Сожмите видео до 15-20MB\n"
-                        f"• Отправьте с телефона как ВИДЕО (не документ)\n"
-                        f"• Используйте более короткое видео\n\n"
-                        f"📱 С телефона Telegram автоматически сжимает видео!"
-                    )
-                elif "timeout" in error_msg.lower():
-                    await progress_message.edit_text(
-                        f"❌ Таймаут при скачивании файла!\n\n"
-                        f"📡 Возможные причины:\n"
-                        f"• Медленное интернет-соединение\n"
-                        f"• Файл слишком большой для скачивания\n\n"
-                        f"💡 Попробуйте файл меньшего размера."
-                    )
-                else:
-                    await progress_message.edit_text(
-                        f"❌ Ошибка скачивания файла!\n\n"
-                        f"🔍 Детали: {error_msg}\n\n"
-                        f"💡 Попробуйте:\n"
-                        f"• Отправить файл меньшего размера\n"
-                        f"• Повторить попытку\n"
-                        f"• Отправить с телефона"
-                    )
-                return
+                    if "File is too big" in error_msg or "too large" in error_msg or "Request Entity Too Large" in error_msg:
+                        await progress_message.edit_text(
+                            f"❌ Telegram не может скачать такой большой файл!\n\n"
+                            f"🔍 Причины:\n"
+                            f"• Файл больше лимитов Bot API\n"
+                            f"• Отправлен как документ (без сжатия)\n"
+                            f"• Проблемы с сетью\n\n"
+                            f"💡 Решения:\n"
+                            f"• Сожмите видео до {settings.max_input_mb}MB\n"
+                            f"• Отправьте с телефона как ВИДЕО (не документ)\n"
+                            f"• Используйте более короткое видео\n\n"
+                            f"📱 С телефона Telegram автоматически сжимает видео!"
+                        )
+                    elif "timeout" in error_msg.lower():
+                        await progress_message.edit_text(
+                            f"❌ Таймаут при скачивании файла!\n\n"
+                            f"📡 Возможные причины:\n"
+                            f"• Медленное интернет-соединение\n"
+                            f"• Файл слишком большой для скачивания\n\n"
+                            f"💡 Попробуйте файл меньшего размера."
+                        )
+                    else:
+                        await progress_message.edit_text(
+                            f"❌ Ошибка скачивания файла!\n\n"
+                            f"🔍 Детали: {error_msg}\n\n"
+                            f"💡 Попробуйте:\n"
+                            f"• Отправить файл меньшего размера\n"
+                            f"• Повторить попытку\n"
+                            f"• Отправить с телефона"
+                        )
+                    return trace.status
             
             await progress_message.edit_text("🔄 Обрабатываю видео...")
             
-            # Получаем информацию о видео
-            video_info = await video_processor.get_video_info(temp_input_path)
-            input_size_mb = temp_input_path.stat().st_size / (1024 * 1024)
+            # Получаем информацию о видео и отсекаем нечитаемые файлы до кодирования
+            with trace_span('probe') as span:
+                try:
+                    video_info = await video_processor.get_video_info(temp_input_path)
+                except Exception:
+                    video_info = {}
+                span.update({key: video_info.get(key) for key in ('codec', 'width', 'height', 'duration', 'fps')})
+            
+            input_size = video_processor.input_size(temp_input_path) if video_processor.has_input(temp_input_path) else None
+            validation = validate_video_file(temp_input_path, video_info, file_size=input_size)
+            if validation['is_valid'] and not await video_processor.check_decodable(temp_input_path, video_info):
+                validation = {'is_valid': False, 'error': "Видеопоток не декодируется"}
+            
+            if not validation['is_valid']:
+                logger.warning(f"❌ Видео пользователя {user_id} отклонено: {validation['error']}")
+                await progress_message.edit_text(
+                    f"❌ Не удалось прочитать видео!\n\n"
+                    f"🔍 Причина: {validation['error']}\n\n"
+                    f"💡 Проверьте, что файл не повреждён, и попробуйте ещё раз"
+                )
+                trace.status = 'invalid'
+                trace.set(error=validation['error'])
+                return trace.status
+            
+            input_size_mb = input_size / (1024 * 1024)
             
-            # Всегда создаем 6 вариантов
-            await progress_message.edit_text(f"🔄 Создаю {variant_count} вариантов видео...")
+            # Резерв ресурсов задачи уточняем по реальному размеру и разрешению входа
+            if footprint is not None:
+                display_width, display_height = video_processor.get_display_size(video_info)
+                self.admission.adjust(footprint, self.admission.estimate(
+                    input_size, display_width, display_height, video_info['duration'], variant_count
+                ))
+                trace.set(estimated_disk_bytes=footprint.disk_bytes,
+                          estimated_memory_bytes=footprint.memory_bytes)
             
-            variants = await video_processor.create_multiple_variants(
-                temp_input_path, 
-                settings.output_dir,
-                variant_count
+            # Отбираем варианты по прогнозу размера
+            ladder_plan = video_processor.plan_ladder(video_info, variant_count)
+            if ladder_plan['dropped']:
+                await message.reply_text(
+                    "ℹ️ Пропущены варианты:\n" + "\n".join(
+                        f"• {item['name']}: {item['reason']}" for item in ladder_plan['dropped']
+                    )
+                )
+            
+            # Пресет x264 подбираем под текущую очередь
+            preset = video_processor.choose_preset(
+                video_info, len(ladder_plan['rungs']), queue_depth=self.job_counts()['queued']
             )
+            trace.set(preset=preset,
+                      engine='segmented' if video_processor.should_segment(video_info) else settings.encode_engine,
+                      rungs=[rung['name'] for rung in ladder_plan['rungs']],
+                      dropped=[item['name'] for item in ladder_plan['dropped']])
             
-            if not variants:
-                await progress_message.edit_text("❌ Ошибка при создании вариантов")
-                return
+            # Конвейер: каждый готовый вариант отправляется, пока кодируется следующий
+            await progress_message.edit_text(
+                f"🔄 Создаю {len(ladder_plan['rungs'])} вариантов видео...\n"
+                f"📤 Готовые варианты отправляю сразу"
+            )
             
-            # Отправляем все варианты
-            await progress_message.edit_text("📤 Отправляю варианты...")
+            # После перезапуска отправленные варианты пропускаем, а закодированные отправляем без кодирования
+            uploaded_before = dict(journal_entry.uploaded)
+            encoded_before = {index: variant for index, variant in journal_entry.encoded.items()
+                              if variant['path'].exists()}
+            if uploaded_before or encoded_before:
+                trace.set(reused_uploaded=sorted(uploaded_before), reused_encoded=sorted(encoded_before))
             
-            for i, variant in enumerate(variants):
-                try:
-                    with open(variant['path'], 'rb') as video_file:
-                        await message.reply_video(
-                            video=video_file,
-                            caption=f"✅ Вариант {i+1}/{len(variants)}: {variant['name']}\n\n"
-                                   f"📐 Исходный размер: {video_info['width']}x{video_info['height']}\n"
-                                   f"📐 Новый размер: 1080x1920 (Stories)\n"
-                                   f"⏱ Длительность: {video_info['duration']:.1f}с\n"
-                                   f"📁 Размер: {variant['size_mb']:.1f}MB\n"
-                                   f"🎯 Качество: CRF {variant['quality']}\n"
-                                   f"🎨 Цвет рамки: {variant['frame_color']}\n"
-                                   f"🖼 Толщина рамки: {variant['frame_thickness']} ({variant['frame_thickness_px']}px)",
-                            supports_streaming=True,
-                            read_timeout=60,
-                            write_timeout=60
-                        )
-                except Exception as upload_error:
-                    logger.error(f"Ошибка отправки варианта {i+1}: {upload_error}")
+            # Прогресс FFmpeg показываем в статусном сообщении с процентами и ETA
+            # (только по вариантам, которые действительно будут кодироваться)
+            job_progress = JobProgress(video_info['duration'], len(ladder_plan['rungs']),
+                                       skip={*uploaded_before, *encoded_before})
+            status = ProgressMessage(progress_message, self.edit_limiter, settings.progress_edit_interval)
             
-            # Очищаем временные файлы вариантов
-            for variant in variants:
-                video_processor.cleanup_temp_files(variant['path'])
+            def on_progress(variant_index: int, snapshot: dict):
+                job_progress.update(variant_index, snapshot)
+                status.update(job_progress.format_status())
+            
+            variants_queue: asyncio.Queue = asyncio.Queue()
+            upload_task = asyncio.create_task(
+                self.upload_variants(message, variants_queue, video_info,
+                                     on_sent=lambda entry: self.journal.record_uploaded(journal_entry, entry))
+            )
+            
+            try:
+                async for variant in video_processor.iter_variants(
+                    temp_input_path, 
+                    workspace.output_dir,
+                    variant_count,
+                    on_progress=on_progress,
+                    ladder=ladder_plan['rungs'],
+                    preset=preset,
+                    completed=encoded_before,
+                    skip=set(uploaded_before)
+                ):
+                    self.journal.record_encoded(journal_entry, variant)
+                    await variants_queue.put(variant)
+            except BaseException:
+                upload_task.cancel()
+                raise
+            finally:
+                # Сигнал потребителю: новых вариантов не будет
+                variants_queue.put_nowait(None)
+                await status.close()
+            
+            sent_entries, variants_count = await upload_task
+            sent_entries = sorted([*uploaded_before.values(), *sent_entries], key=lambda entry: entry['index'])
+            variants_count += len(uploaded_before)
+            trace.set(variants_created=variants_count, variants_sent=len(sent_entries))
+            
+            if not variants_count:
+                await progress_message.edit_text("❌ Ошибка при создании вариантов")
+                trace.status = 'no_variants'
+                return trace.status
+            
+            # Запоминаем file_id, чтобы повторно присланное видео не кодировать заново
+            if cache_key and len(sent_entries) == variants_count:
+                self.result_cache.put(cache_key, sent_entries)
             
             # Очищаем временные данные пользователя
             context.user_data.clear()
             
             # Удаляем сообщение о прогрессе и завершаем
+            trace.status = 'done' if len(sent_entries) == variants_count else 'partial'
             await progress_message.delete()
-            return
+            return trace.status
             
+        except asyncio.CancelledError:
+            trace.status = 'cancelled'
+            raise
         except Exception as e:
             logger.error(f"Ошибка обработки видео для пользователя {user_id}: {e}")
+            trace.status = 'error'
+            trace.set(error=str(e)[:200])
             await message.reply_text(
                 f"❌ Произошла ошибка при обработке видео: {str(e)}"
             )
         
         finally:
-            # Небольшая задержка перед удалением файлов
-            await asyncio.sleep(0.5)
-            # Очищаем временные файлы
-            video_processor.cleanup_temp_files(temp_input_path, temp_output_path)
+            if self.stopping and trace.status == 'cancelled':
+                # Процесс останавливается: файлы и запись журнала нужны, чтобы продолжить после запуска
+                trace.status = 'interrupted'
+                logger.info(f"⏸ Задача {journal_entry.job_id} прервана остановкой и продолжится после запуска")
+            else:
+                # Небольшая задержка перед удалением файлов
+                await asyncio.sleep(0.5)
+                # Очищаем временные файлы, включая варианты прерванного кодирования
+                leftovers = [temp_input_path, temp_output_path,
+                             *video_processor.get_job_outputs(temp_input_path, workspace.output_dir),
+                             *(path for variant in journal_entry.encoded.values()
+                               for path in self.variant_files(variant))]
+                with trace_span('cleanup', files=sum(1 for path in leftovers if path.exists())):
+                    await video_processor.cleanup_temp_files(*leftovers)
+                self.journal.finish(journal_entry)
+            video_processor.detach_input(temp_input_path)
+            workspace_manager.release(workspace)
+            janitor.release(job_prefix)
+            trace.finish()
+            current_trace.reset(trace_token)
+        return trace.status
+    
+    async def start_updates(self):
+        """Запускает приём обновлений: long polling или webhook со встроенным HTTP-сервером"""
+        if settings.update_mode == "webhook":
+            if not settings.webhook_secret_token:
+                logger.warning("⚠️ WEBHOOK_SECRET_TOKEN не задан - запросы к webhook не проверяются")
+            await self.application.updater.start_webhook(
+                listen=settings.webhook_listen,
+                port=settings.webhook_port,
+                url_path=settings.webhook_path,
+                webhook_url=settings.webhook_url,
+                secret_token=settings.webhook_secret_token or None,
+                max_connections=settings.webhook_max_connections,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=settings.drop_pending_updates
+            )
+            logger.info(f"🌐 Webhook: http://{settings.webhook_listen}:{settings.webhook_port}/"
+                        f"{settings.webhook_path} <- {settings.webhook_url}")
+        else:
+            await self.application.updater.start_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=settings.drop_pending_updates
+            )
+    
+    async def wait_for_stop_signal(self):
+        """Ждёт SIGINT или SIGTERM"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Windows: цикл событий не умеет обработчики сигналов, ставим обычные
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop_event.set))
+        await stop_event.wait()
+    
+    async def resume_journal(self):
+        """Ставит в очередь задачи, прерванные остановкой или падением бота"""
+        for entry in self.journal.unfinished():
+            # Файлы задачи не должен удалить уборщик, пока она ждёт своей очереди
+            janitor.protect(entry.prefix)
+            payload = entry.payload
+            message = Message.de_json(payload['message'], self.application.bot)
+            if entry.resumes >= MAX_RESUMES:
+                logger.warning(f"⚠️ Задача {entry.job_id} прерывалась {entry.resumes} раз, не возобновляю")
+                self.journal.finish(entry)
+                janitor.release(entry.prefix)
+                try:
+                    await message.reply_text(
+                        "❌ Не удалось обработать видео: бот несколько раз перезапускался во время обработки\n\n"
+                        "💡 Попробуйте отправить видео меньшего размера"
+                    )
+                except Exception as e:
+                    logger.warning(f"Не удалось уведомить пользователя {entry.user_id}: {e}")
+                continue
+            
+            self.journal.mark_resumed(entry)
+            context = ContextTypes.DEFAULT_TYPE(self.application, chat_id=message.chat_id, user_id=entry.user_id)
+            footprint = self.admission.estimate(payload['file_size'] or 0, payload['width'] or 0,
+                                                payload['height'] or 0, payload['duration'] or 0.0,
+                                                payload['variant_count'])
+            trace = JobTrace(entry.user_id, file_unique_id=payload['file_unique_id'], filename=payload['filename'],
+                             variant_count=payload['variant_count'], parent_trace_id=payload['trace_id'],
+                             resumed=True)
+            try:
+                self.scheduler.submit(
+                    entry.user_id,
+                    lambda entry=entry, message=message, context=context, trace=trace, footprint=footprint:
+                        self.process_video_file(message, context, entry.payload['file_id'],
+                                                entry.payload['filename'], entry.payload['variant_count'],
+                                                entry.payload['cache_key'], trace, footprint, entry),
+                    footprint,
+                    on_cancel=lambda entry=entry, trace=trace: self.drop_queued_job(entry, trace)
+                )
+            except QueueLimitExceeded:
+                # Очередь пользователя уже заполнена - задача подождёт следующего запуска
+                janitor.release(entry.prefix)
+                continue
+            logger.info(f"🔄 Задача {entry.job_id} пользователя {entry.user_id} возобновлена "
+                        f"(перезапуск {entry.resumes}, отправлено вариантов: {len(entry.uploaded)}, "
+                        f"готово к отправке: {len(entry.encoded)})")
+    
+    async def start_services(self, metrics_port: Optional[int] = None, remove_files: bool = True):
+        """
+        Запускает планировщик и фоновые службы (общие для бота и воркера).
+        metrics_port - порт эндпоинта метрик этого процесса (по умолчанию METRICS_PORT);
+        remove_files=False - файлы удаляет уборка другого процесса, здесь только учёт места
+        """
+        self.scheduler.start()
+        # Фоновая уборка рабочих каталогов по возрасту и квоте; файлы задач,
+        # которые в журнале (в том числе у других процессов), она не трогает
+        janitor.share_protection(self.journal.active_prefixes)
+        self.janitor_task = asyncio.create_task(janitor.run(remove_files))
+        # Фоновые замеры CPU, памяти и диска для допуска задач (у каждого процесса свои задачи)
+        self.monitor_task = asyncio.create_task(system_monitor.run())
+        if metrics_port is None:
+            metrics_port = settings.metrics_port
+        if metrics_port:
+            self.metrics_server = await start_metrics_server(settings.metrics_host, metrics_port)
+    
+    async def stop_services(self):
+        """Останавливает планировщик, фоновые службы и дочерние процессы"""
+        # Прерванные остановкой задачи остаются в журнале и продолжатся после запуска
+        self.stopping = True
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        for task in (self.janitor_task, self.monitor_task):
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(task for task in (self.janitor_task, self.monitor_task) if task),
+                             return_exceptions=True)
+        await self.scheduler.stop()
+        # Ни один дочерний FFmpeg не должен пережить бота
+        process_supervisor.kill_all()
+        self.result_cache.close()
+        self.journal.close()
+        if self.spool is not None:
+            self.spool.close()
     
     async def run(self):
         """Запуск бота"""
@@ -416,19 +1117,18 @@ Bot работает стабильно! ✅
         try:
             # Запускаем бота
             await self.application.start()
-            await self.application.updater.start_polling(
-                allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
-            )
+            if self.spool is None:
+                # Задачи спула после перезапуска доделывают воркеры
+                await self.resume_journal()
+            await self.start_services()
+            await self.start_updates()
             
-            # Ждем бесконечно
-            while True:
-                await asyncio.sleep(1)
-                
-        except KeyboardInterrupt:
+            # Работаем до SIGINT/SIGTERM
+            await self.wait_for_stop_signal()
             logger.info("Получен сигнал остановки")
         finally:
             # Корректно останавливаем
+            await self.stop_services()
             await self.application.updater.stop()
             await self.application.stop()
             await self.application.shutdown()
@@ -439,6 +1139,9 @@ async def main():
     if not settings.bot_token:
         logger.error("BOT_TOKEN не установлен! Проверьте файл .env")
         return False
+    if settings.update_mode == "webhook" and not settings.webhook_url:
+        logger.error("UPDATE_MODE=webhook требует WEBHOOK_URL (публичный адрес для Telegram)")
+        return False
     
     bot = VideoBot()
     await bot.run()
@@ -9,20 +9,143 @@ class Settings(BaseSettings):
     # Токен бота
     bot_token: str = ""
     
+    # Приём обновлений: polling - long polling, webhook - встроенный HTTP-сервер
+    update_mode: str = "polling"
+    # Webhook: адрес и порт локального сервера (за обратным прокси), путь,
+    # публичный URL для setWebhook, секрет заголовка X-Telegram-Bot-Api-Secret-Token
+    # и сколько соединений Telegram может держать одновременно
+    webhook_listen: str = "127.0.0.1"
+    webhook_port: int = 8443
+    webhook_path: str = "telegram"
+    webhook_url: str = ""
+    webhook_secret_token: str = ""
+    webhook_max_connections: int = 40
+    # Сбрасывать накопившиеся обновления при запуске (с несколькими экземплярами - false)
+    drop_pending_updates: bool = True
+    
+    # Локальный сервер Bot API (telegram-bot-api --local): адрес методов, например
+    # http://127.0.0.1:8081/bot, и адрес файлов (по умолчанию /file/bot на том же сервере).
+    # В режиме local_mode сервер отдаёт путь к файлу на диске, и FFmpeg читает его без копирования
+    bot_api_base_url: str = ""
+    bot_api_base_file_url: str = ""
+    bot_api_local_mode: bool = False
+    
     # Ограничения файлов
     max_file_size_mb: int = 50  # Максимальный размер файла в MB
+    upload_limit_mb: int = 50  # Лимит Bot API на отправку файла в MB
     
     # Директории
     temp_dir: Path = Path("temp")
     output_dir: Path = Path("output")
     
+    # Рабочий каталог в RAM (tmpfs): вход и выходы задачи не касаются диска.
+    # Задача, которая не помещается в ram_workspace_max_mb, работает на диске
+    ram_workspace_enabled: bool = False
+    ram_workspace_dir: Path = Path("/dev/shm/videobot")
+    ram_workspace_max_mb: int = 512
+    # Видео до этого размера скачиваются в память и подаются FFmpeg через stdin,
+    # если контейнер читается потоком (у MP4 - moov перед mdat); 0 - выключено
+    memory_input_max_mb: int = 0
+    
     # Настройки FFmpeg
     ffmpeg_timeout: int = 300  # 5 минут
+    ffmpeg_stall_timeout: int = 60  # Сколько секунд FFmpeg может не сообщать о прогрессе
+    probe_cache_size: int = 128  # Сколько результатов ffprobe держать в памяти
+    # Движок кодирования вариантов:
+    # sequential - отдельный процесс FFmpeg на каждый вариант
+    # single_pass - один процесс, вход декодируется один раз (split/asplit)
+    encode_engine: str = "sequential"
+    # Сколько вариантов одной задачи кодируется одновременно (движок sequential)
+    max_parallel_encodes: int = 1
+    # Сегментное кодирование длинных видео: вход режется по ключевым кадрам на куски
+    # без перекодирования, куски каждого варианта кодируются параллельно и склеиваются
+    # concat demuxer. Включается для видео не короче segment_min_duration секунд (0 - выключено)
+    segment_min_duration: int = 120
+    segment_count: int = 0  # На сколько кусков резать видео; 0 - по числу ядер CPU
+    
+    # Пресет x264: adaptive - выбирается по нагрузке и SLO, fixed - всегда x264_preset
+    preset_policy: str = "adaptive"
+    x264_preset: str = "medium"
+    latency_slo_seconds: int = 180  # Целевое время обработки задачи, включая ожидание в очереди
+    
+    # Адаптивная лестница качества: пропуск вариантов, которые по прогнозу
+    # не пройдут по лимиту отправки или почти совпадут по размеру с другими
+    adaptive_ladder: bool = True
+    ladder_similarity_percent: float = 10.0
+    
+    # Планировщик задач
+    encode_workers: int = 2  # Сколько видео обрабатывается одновременно
+    max_jobs_per_user: int = 3  # Лимит задач одного пользователя в очереди и в работе
+    
+    # Где кодируются задачи: local - в процессе бота, spool - в отдельных процессах
+    # (run.py --mode worker), которые забирают задачи из очереди в SQLite
+    encode_backend: str = "local"
+    spool_path: Path = Path("cache/jobs.db")
+    spool_poll_interval: float = 1.0  # Как часто воркер проверяет очередь и отмены, секунды
+    spool_stale_seconds: int = 600  # Задача воркера без heartbeat дольше этого возвращается в очередь
+    
+    # Журнал задач: этапы каждой задачи, чтобы после перезапуска продолжить с места остановки
+    journal_path: Path = Path("cache/journal.db")
+    
+    # Статус кодирования: правка сообщения задачи не чаще раза в N секунд,
+    # и не больше M правок в секунду суммарно по всем задачам
+    progress_edit_interval: float = 3.0
+    progress_edits_per_second: float = 20.0
+    
+    # Доставка вариантов: single - отдельными сообщениями, album - альбомами (send_media_group)
+    delivery_mode: str = "single"
+    
+    # Кэш отправленных результатов (file_unique_id -> file_id вариантов)
+    result_cache_path: Path = Path("cache/results.db")
+    result_cache_max_entries: int = 1000
+    result_cache_ttl_hours: int = 72
+    
+    # Уборка рабочих каталогов: возраст файлов и общая квота temp_dir + output_dir
+    janitor_interval_seconds: int = 300
+    janitor_rescan_every: int = 12  # Полная сверка с диском раз в N проходов уборки
+    temp_max_age_hours: int = 1
+    output_max_age_hours: int = 24
+    workspace_max_mb: int = 2048
+    
+    # Допуск задач: бюджеты диска и памяти FFmpeg на все задачи (0 - по реальному запасу),
+    # и сколько оставлять свободным в любом случае
+    disk_budget_mb: int = 0
+    memory_budget_mb: int = 0
+    disk_reserve_mb: int = 512
+    memory_reserve_mb: int = 256
+    system_sample_interval: float = 5.0  # Период фоновых замеров CPU, памяти и диска
+    
+    # Эндпоинт метрик Prometheus (http://host:port/metrics); 0 - выключен
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    # Эндпоинт метрик процесса-воркера; у каждого воркера свой порт
+    # (pm2 увеличивает его на номер экземпляра, см. ecosystem.config.js), 0 - выключен
+    worker_metrics_port: int = 0
+    
+    # Трассы задач: одна JSON-строка на задачу, файл с ротацией по размеру
+    trace_log_enabled: bool = True
+    trace_log_path: Path = Path("logs/traces.jsonl")
+    trace_log_max_mb: int = 10
+    trace_log_backups: int = 5
+    
+    @property
+    def max_input_mb(self) -> int:
+        """Сколько MB бот может принять: max_file_size_mb, но не больше лимита getFile сервера Bot API"""
+        limit = LOCAL_BOT_API_DOWNLOAD_LIMIT_MB if self.bot_api_local_mode else BOT_API_DOWNLOAD_LIMIT_MB
+        return min(self.max_file_size_mb, limit)
+    
+    @property
+    def max_input_bytes(self) -> int:
+        return self.max_input_mb * 1024 * 1024
     
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
 
+# Лимит getFile: облачный Bot API отдаёт файлы до 20MB, локальный сервер - до 2000MB
+BOT_API_DOWNLOAD_LIMIT_MB = 20
+LOCAL_BOT_API_DOWNLOAD_LIMIT_MB = 2000
+
 # Создаем экземпляр настроек
 settings = Settings()
 
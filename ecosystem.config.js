@@ -20,6 +20,42 @@ module.exports = {
         NODE_ENV: "production",
         PYTHONPATH: "/opt/videobot",
         PYTHONUNBUFFERED: "1",
+        // Кодирование - в процессах videobot-worker
+        ENCODE_BACKEND: "spool",
+      },
+      env_production: {
+        NODE_ENV: "production",
+      },
+    },
+    {
+      name: "videobot-worker",
+      script: "run.py",
+      args: "--mode worker",
+      interpreter: "/opt/videobot/venv/bin/python",
+      cwd: "/opt/videobot",
+      // Число воркеров масштабируется независимо от бота: pm2 scale videobot-worker N
+      instances: 2,
+      exec_mode: "fork",
+      autorestart: true,
+      watch: false,
+      max_memory_restart: "2G",
+      // Дать FFmpeg завершиться и вернуть задачи в очередь при остановке
+      kill_timeout: 10000,
+      // Метрики воркеров: у каждого экземпляра свой порт (9465, 9466, ...) -
+      // раскомментируйте вместе с WORKER_METRICS_PORT ниже
+      // increment_var: "WORKER_METRICS_PORT",
+      min_uptime: "10s",
+      max_restarts: 10,
+      error_file: "./logs/worker-err.log",
+      out_file: "./logs/worker-out.log",
+      log_file: "./logs/worker-combined.log",
+      time: true,
+      env: {
+        NODE_ENV: "production",
+        PYTHONPATH: "/opt/videobot",
+        PYTHONUNBUFFERED: "1",
+        ENCODE_BACKEND: "spool",
+        // WORKER_METRICS_PORT: "9465",
       },
       env_production: {
         NODE_ENV: "production",
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз пытаться удалить занятый файл и пауза между попытками, секунды
+REMOVE_ATTEMPTS = 3
+REMOVE_RETRY_DELAY = 1.0
+
+
+class WorkspaceJanitor:
+    """
+    Учёт и уборка рабочих каталогов (temp_dir, output_dir).
+    Размер каталогов считается инкрементально: файлы регистрируются при создании
+    и снимаются с учёта при удалении; полный обход каталогов нужен только
+    при старте и изредка для сверки (файлы, о которых никто не сообщил)
+    """
+
+    def __init__(self, directories: Dict[str, Path]):
+        self.directories = directories
+        # Путь -> (каталог, размер, время изменения)
+        self._files: Dict[Path, Tuple[str, int, float]] = {}
+        self._usage: Dict[str, int] = {name: 0 for name in directories}
+        self._counts: Dict[str, int] = {name: 0 for name in directories}
+        # Префиксы файлов задач, которые сейчас в работе: их уборка не трогает
+        self._protected: Set[str] = set()
+        # Бот и воркеры убирают общие каталоги: префиксы задач всех процессов
+        # (из журнала задач) перечитываются перед каждым проходом уборки
+        self._shared_source: Optional[Callable[[], Iterable[str]]] = None
+        self._shared: Set[str] = set()
+        self._sweeps = 0
+
+    def usage(self, name: str) -> int:
+        """Занято байт в каталоге"""
+        return self._usage.get(name, 0)
+
+    def file_count(self, name: str) -> int:
+        """Файлов в каталоге"""
+        return self._counts.get(name, 0)
+
+    @property
+    def total_usage(self) -> int:
+        """Занято байт во всех рабочих каталогах"""
+        return sum(self._usage.values())
+
+    def _directory_of(self, path: Path) -> Optional[str]:
+        parent = path.parent.resolve()
+        for name, directory in self.directories.items():
+            if parent == directory.resolve():
+                return name
+        return None
+
+    def _add(self, path: Path, name: str, size: int, mtime: float):
+        self._forget(path)
+        self._files[path] = (name, size, mtime)
+        self._usage[name] += size
+        self._counts[name] += 1
+
+    def _forget(self, path: Path):
+        entry = self._files.pop(path, None)
+        if entry is not None:
+            name, size, _ = entry
+            self._usage[name] -= size
+            self._counts[name] -= 1
+
+    def track(self, *paths: Optional[Path]):
+        """Учитывает созданные (или дописанные) файлы рабочих каталогов"""
+        for path in paths:
+            if path is None:
+                continue
+            name = self._directory_of(path)
+            if name is None:
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                self._forget(path)
+                continue
+            self._add(path, name, stat.st_size, stat.st_mtime)
+
+    def protect(self, prefix: str):
+        """Защищает файлы задачи (по префиксу имени) от уборки, пока она в работе"""
+        self._protected.add(prefix)
+
+    def release(self, prefix: str):
+        """Снимает защиту с файлов задачи"""
+        self._protected.discard(prefix)
+
+    def share_protection(self, source: Callable[[], Iterable[str]]):
+        """Задаёт источник префиксов задач, которые сейчас в работе у любого процесса"""
+        self._shared_source = source
+
+    def _is_protected(self, path: Path) -> bool:
+        return any(path.name.startswith(prefix) for prefix in (*self._protected, *self._shared))
+
+    async def remove(self, path: Path) -> bool:
+        """Удаляет файл вне цикла событий, повторяя попытки, пока файл занят"""
+        for attempt in range(REMOVE_ATTEMPTS):
+            try:
+                await asyncio.to_thread(path.unlink)
+                self._forget(path)
+                logger.info(f"Удален временный файл: {path}")
+                return True
+            except FileNotFoundError:
+                self._forget(path)
+                return True
+            except PermissionError:
+                if attempt < REMOVE_ATTEMPTS - 1:
+                    logger.info(f"Файл занят, ждём... попытка {attempt + 1}/{REMOVE_ATTEMPTS}")
+                    await asyncio.sleep(REMOVE_RETRY_DELAY)
+                else:
+                    logger.warning(f"Не удалось удалить файл {path} после {REMOVE_ATTEMPTS} попыток")
+            except Exception as e:
+                logger.warning(f"Ошибка удаления файла {path}: {e}")
+                break
+        return False
+
+    async def remove_many(self, paths: Iterable[Optional[Path]]):
+        """Удаляет несколько файлов параллельно"""
+        await asyncio.gather(*(self.remove(path) for path in paths if path is not None))
+
+    def _scan(self) -> List[Tuple[Path, str, int, float]]:
+        """Полный обход рабочих каталогов (выполняется в отдельном потоке)"""
+        found = []
+        for name, directory in self.directories.items():
+            if not directory.exists():
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            found.append((Path(entry.path), name, stat.st_size, stat.st_mtime))
+                    except OSError:
+                        continue
+        return found
+
+    async def rescan(self):
+        """Сверяет учёт с содержимым каталогов"""
+        found = await asyncio.to_thread(self._scan)
+        self._files.clear()
+        self._usage = {name: 0 for name in self.directories}
+        self._counts = {name: 0 for name in self.directories}
+        for path, name, size, mtime in found:
+            self._add(path, name, size, mtime)
+
+    def _expired(self, now: float) -> List[Path]:
+        """Файлы старше допустимого возраста своего каталога"""
+        max_age = {
+            'temp': settings.temp_max_age_hours * 3600,
+            'ram': settings.temp_max_age_hours * 3600,
+            'output': settings.output_max_age_hours * 3600,
+        }
+        return [path for path, (name, _, mtime) in self._files.items()
+                if now - mtime > max_age.get(name, float('inf')) and not self._is_protected(path)]
+
+    def _over_quota(self) -> List[Path]:
+        """Самые старые файлы, без которых каталоги укладываются в квоту"""
+        quota = settings.workspace_max_mb * 1024 * 1024
+        excess = self.total_usage - quota
+        if excess <= 0:
+            return []
+
+        victims = []
+        by_age = sorted(self._files.items(), key=lambda item: item[1][2])
+        for path, (_, size, _) in by_age:
+            if excess <= 0:
+                break
+            if self._is_protected(path):
+                continue
+            victims.append(path)
+            excess -= size
+        if excess > 0:
+            logger.warning(f"⚠️ Рабочие каталоги превышают квоту {settings.workspace_max_mb}MB "
+                           f"файлами задач в работе")
+        return victims
+
+    async def sweep(self, remove_files: bool = True):
+        """
+        Один проход уборки: сверка (изредка), удаление старых файлов, соблюдение квоты.
+        remove_files=False - только учёт занятого места, удаляет файлы другой процесс
+        """
+        if self._sweeps % max(1, settings.janitor_rescan_every) == 0:
+            await self.rescan()
+        self._sweeps += 1
+        if not remove_files:
+            return
+
+        if self._shared_source is not None:
+            # Без списка чужих задач уборка могла бы удалить их файлы - пропускаем проход
+            try:
+                self._shared = set(self._shared_source())
+            except Exception as e:
+                logger.error(f"Не удалось прочитать задачи других процессов, уборка пропущена: {e}")
+                return
+
+        expired = self._expired(time.time())
+        if expired:
+            logger.info(f"🧹 Удаляю устаревших файлов: {len(expired)}")
+            await self.remove_many(expired)
+
+        over_quota = self._over_quota()
+        if over_quota:
+            logger.info(f"🧹 Рабочие каталоги больше квоты {settings.workspace_max_mb}MB, "
+                        f"удаляю старых файлов: {len(over_quota)}")
+            await self.remove_many(over_quota)
+
+    async def run(self, remove_files: bool = True):
+        """Фоновая уборка (или только учёт, см. sweep) каждые janitor_interval_seconds"""
+        if remove_files:
+            logger.info(f"🧹 Уборка рабочих каталогов каждые {settings.janitor_interval_seconds}с, "
+                        f"квота {settings.workspace_max_mb}MB")
+        while True:
+            try:
+                await self.sweep(remove_files)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка уборки рабочих каталогов: {e}")
+            await asyncio.sleep(settings.janitor_interval_seconds)
+
+
+# Глобальный учёт рабочих каталогов (RAM-каталог - только если он включён)
+janitor = WorkspaceJanitor({
+    'temp': settings.temp_dir,
+    'output': settings.output_dir,
+    **({'ram': settings.ram_workspace_dir} if settings.ram_workspace_enabled else {})
+})
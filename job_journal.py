@@ -0,0 +1,203 @@
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз возобновлять задачу после перезапуска: видео, из-за которого
+# процесс падает (например, по max_memory_restart), не должно перезапускать его бесконечно
+MAX_RESUMES = 3
+
+# Этапы вариантов
+ENCODED = 'encoded'
+UPLOADED = 'uploaded'
+
+
+@dataclass
+class JournalEntry:
+    """Незавершённая задача из журнала и её пройденные этапы"""
+    job_id: str
+    prefix: str
+    user_id: int
+    payload: dict
+    spool_job_id: Optional[int] = None
+    input_path: Optional[Path] = None
+    resumes: int = 0
+    # Закодированные, но не отправленные варианты: индекс -> результат кодирования
+    encoded: Dict[int, dict] = field(default_factory=dict)
+    # Отправленные варианты: индекс -> {file_id, caption, index}
+    uploaded: Dict[int, dict] = field(default_factory=dict)
+
+
+def _dump_variant(variant: dict) -> str:
+    """Результат кодирования в JSON (пути - строками)"""
+    return json.dumps({key: str(value) if isinstance(value, Path) else value
+                       for key, value in variant.items()}, ensure_ascii=False)
+
+
+def _load_variant(data: str) -> dict:
+    """Результат кодирования из JSON"""
+    variant = json.loads(data)
+    for key in ('path', 'thumbnail'):
+        if variant.get(key):
+            variant[key] = Path(variant[key])
+    return variant
+
+
+class JobJournal:
+    """
+    Журнал задач в SQLite: задача записывается при постановке в очередь,
+    затем отмечаются этапы - скачивание, кодирование и отправка каждого варианта.
+    После перезапуска задача продолжается с последнего пройденного этапа,
+    а готовые файлы вариантов не кодируются заново
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает базу журнала при первом обращении"""
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            # WAL: в журнал пишут бот и процессы-воркеры
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " prefix TEXT NOT NULL,"
+                " user_id INTEGER NOT NULL,"
+                " spool_job_id INTEGER,"
+                " payload TEXT NOT NULL,"
+                " input_path TEXT,"
+                " resumes INTEGER NOT NULL DEFAULT 0,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS variants ("
+                " job_id TEXT NOT NULL,"
+                " variant_index INTEGER NOT NULL,"
+                " stage TEXT NOT NULL,"
+                " data TEXT NOT NULL,"
+                " PRIMARY KEY (job_id, variant_index))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_spool ON jobs (spool_job_id)")
+        return self._connection
+
+    def start(self, user_id: int, payload: dict, spool_job_id: Optional[int] = None) -> JournalEntry:
+        """Записывает новую задачу; префикс её файлов - {user_id}_{timestamp}_"""
+        now = time.time()
+        entry = JournalEntry(job_id=uuid.uuid4().hex[:16], prefix=f"{user_id}_{int(now)}_",
+                             user_id=user_id, payload=payload, spool_job_id=spool_job_id)
+        self._connect().execute(
+            "INSERT INTO jobs (job_id, prefix, user_id, spool_job_id, payload, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (entry.job_id, entry.prefix, user_id, spool_job_id,
+             json.dumps(payload, ensure_ascii=False), now, now)
+        )
+        return entry
+
+    def _touch(self, connection: sqlite3.Connection, job_id: str):
+        connection.execute("UPDATE jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def record_download(self, entry: JournalEntry, input_path: Path):
+        """Этап: исходное видео скачано в файл"""
+        entry.input_path = input_path
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET input_path = ? WHERE job_id = ?", (str(input_path), entry.job_id))
+        self._touch(connection, entry.job_id)
+
+    def record_encoded(self, entry: JournalEntry, variant: dict):
+        """Этап: вариант закодирован, его файлы готовы к отправке"""
+        entry.encoded[variant['index']] = variant
+        connection = self._connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO variants (job_id, variant_index, stage, data) VALUES (?, ?, ?, ?)",
+            (entry.job_id, variant['index'], ENCODED, _dump_variant(variant))
+        )
+        self._touch(connection, entry.job_id)
+
+    def record_uploaded(self, entry: JournalEntry, sent: dict):
+        """Этап: вариант отправлен пользователю (file_id и подпись)"""
+        entry.encoded.pop(sent['index'], None)
+        entry.uploaded[sent['index']] = sent
+        connection = self._connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO variants (job_id, variant_index, stage, data) VALUES (?, ?, ?, ?)",
+            (entry.job_id, sent['index'], UPLOADED, json.dumps(sent, ensure_ascii=False))
+        )
+        self._touch(connection, entry.job_id)
+
+    def mark_resumed(self, entry: JournalEntry):
+        """Отмечает очередное возобновление задачи после перезапуска"""
+        entry.resumes += 1
+        connection = self._connect()
+        connection.execute("UPDATE jobs SET resumes = ? WHERE job_id = ?", (entry.resumes, entry.job_id))
+        self._touch(connection, entry.job_id)
+
+    def finish(self, entry: JournalEntry):
+        """Задача завершена (успешно, с ошибкой или отменена) - возобновлять нечего"""
+        connection = self._connect()
+        connection.execute("DELETE FROM variants WHERE job_id = ?", (entry.job_id,))
+        connection.execute("DELETE FROM jobs WHERE job_id = ?", (entry.job_id,))
+
+    def _load(self, row: tuple) -> JournalEntry:
+        job_id, prefix, user_id, spool_job_id, payload, input_path, resumes = row
+        entry = JournalEntry(job_id=job_id, prefix=prefix, user_id=user_id, payload=json.loads(payload),
+                             spool_job_id=spool_job_id, input_path=Path(input_path) if input_path else None,
+                             resumes=resumes)
+        variants = self._connect().execute(
+            "SELECT variant_index, stage, data FROM variants WHERE job_id = ?", (job_id,)
+        ).fetchall()
+        for index, stage, data in variants:
+            if stage == UPLOADED:
+                entry.uploaded[index] = json.loads(data)
+            else:
+                entry.encoded[index] = _load_variant(data)
+        return entry
+
+    def unfinished(self) -> List[JournalEntry]:
+        """Незавершённые задачи бота (задачи спула возобновляют воркеры)"""
+        rows = self._connect().execute(
+            "SELECT job_id, prefix, user_id, spool_job_id, payload, input_path, resumes FROM jobs"
+            " WHERE spool_job_id IS NULL ORDER BY created_at"
+        ).fetchall()
+        return [self._load(row) for row in rows]
+
+    def find_by_spool_job(self, spool_job_id: int) -> Optional[JournalEntry]:
+        """Незавершённая запись задачи спула, которую начинал другой воркер"""
+        row = self._connect().execute(
+            "SELECT job_id, prefix, user_id, spool_job_id, payload, input_path, resumes FROM jobs"
+            " WHERE spool_job_id = ?", (spool_job_id,)
+        ).fetchone()
+        return self._load(row) if row else None
+
+    def spool_job_ids(self) -> List[int]:
+        """Номера задач спула, у которых есть запись в журнале"""
+        rows = self._connect().execute("SELECT spool_job_id FROM jobs WHERE spool_job_id IS NOT NULL").fetchall()
+        return [row[0] for row in rows]
+
+    def forget_spool_jobs(self, spool_job_ids: List[int]):
+        """Удаляет записи задач спула, которые уже не продолжатся (например, failed после зависаний)"""
+        for spool_job_id in spool_job_ids:
+            entry = self.find_by_spool_job(spool_job_id)
+            if entry is not None:
+                self.finish(entry)
+
+    def active_prefixes(self) -> Set[str]:
+        """Префиксы файлов незавершённых задач - их нельзя удалять при уборке"""
+        rows = self._connect().execute("SELECT prefix FROM jobs").fetchall()
+        return {row[0] for row in rows}
+
+    def close(self):
+        """Закрывает соединение с базой"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,247 @@
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from scheduler import QueueLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Статусы задач спула
+QUEUED = 'queued'
+RUNNING = 'running'
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+@dataclass
+class SpoolJob:
+    """Задача, забранная воркером из спула"""
+    job_id: int
+    user_id: int
+    payload: dict
+    attempts: int
+    created_at: float
+
+
+class JobSpool:
+    """
+    Очередь задач кодирования в SQLite между процессом бота и процессами-воркерами.
+    Бот кладёт задачу (file_id, сообщение, лестница), воркер атомарно забирает её,
+    продлевает heartbeat, пока кодирует, и отмечает результат. Задача воркера,
+    который перестал присылать heartbeat, возвращается в очередь
+    """
+
+    def __init__(self, db_path: Path, stale_seconds: int = 600, max_attempts: int = 3):
+        self.db_path = db_path
+        self.stale_seconds = stale_seconds
+        self.max_attempts = max_attempts
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает базу спула при первом обращении"""
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            # Транзакции открываем явно: захват задачи - BEGIN IMMEDIATE
+            self._connection = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            # WAL: бот и воркеры пишут в базу из разных процессов
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " user_id INTEGER NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " worker TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " created_at REAL NOT NULL,"
+                " heartbeat_at REAL,"
+                " finished_at REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        return self._connection
+
+    def user_job_count(self, user_id: int) -> int:
+        """Задачи пользователя в очереди и в работе на всех воркерах"""
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN (?, ?)",
+            (user_id, *ACTIVE_STATUSES)
+        ).fetchone()
+        return row[0]
+
+    def counts(self) -> Dict[str, int]:
+        """Количество задач в очереди и в работе"""
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status", ACTIVE_STATUSES
+        ).fetchall()
+        counts = {status: 0 for status in ACTIVE_STATUSES}
+        counts.update(dict(rows))
+        return counts
+
+    def submit(self, user_id: int, payload: dict, max_jobs_per_user: int) -> Tuple[int, int]:
+        """Кладёт задачу в спул, возвращает её номер и место в очереди"""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.user_job_count(user_id) >= max_jobs_per_user:
+                raise QueueLimitExceeded(
+                    f"У пользователя {user_id} уже {max_jobs_per_user} задач в обработке"
+                )
+            cursor = connection.execute(
+                "INSERT INTO jobs (user_id, payload, status, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, json.dumps(payload, ensure_ascii=False), QUEUED, time.time())
+            )
+            job_id = cursor.lastrowid
+            position = connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND id <= ?", (QUEUED, job_id)
+            ).fetchone()[0]
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        logger.info(f"Задача спула {job_id} пользователя {user_id} поставлена в очередь, место: {position}")
+        return job_id, position
+
+    def _requeue_stale(self, connection: sqlite3.Connection, now: float):
+        """Возвращает в очередь задачи воркеров без heartbeat; после max_attempts - failed"""
+        stale_before = now - self.stale_seconds
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', finished_at = ?"
+            " WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+            (now, RUNNING, stale_before, self.max_attempts)
+        )
+        requeued = connection.execute(
+            "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat_at < ?",
+            (QUEUED, RUNNING, stale_before)
+        ).rowcount
+        if requeued:
+            logger.warning(f"⚠️ Возвращено в очередь задач зависших воркеров: {requeued}")
+
+    def claim(self, worker_id: str) -> Optional[SpoolJob]:
+        """
+        Атомарно забирает следующую задачу.
+        Первыми идут задачи пользователей, у которых меньше всего задач в работе
+        """
+        connection = self._connect()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._requeue_stale(connection, now)
+            row = connection.execute(
+                "SELECT id, user_id, payload, attempts, created_at FROM jobs AS queued"
+                " WHERE status = ?"
+                " ORDER BY (SELECT COUNT(*) FROM jobs AS running"
+                "           WHERE running.user_id = queued.user_id AND running.status = ?), id"
+                " LIMIT 1",
+                (QUEUED, RUNNING)
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            job_id, user_id, payload, attempts, created_at = row
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, heartbeat_at = ?"
+                " WHERE id = ?",
+                (RUNNING, worker_id, now, job_id)
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return SpoolJob(job_id=job_id, user_id=user_id, payload=json.loads(payload),
+                        attempts=attempts + 1, created_at=created_at)
+
+    def outcome_counts(self) -> Dict[str, int]:
+        """
+        Итоги завершённых задач всех воркеров (за время хранения, см. purge):
+        всё, кроме done и cancelled, считается ошибкой
+        """
+        rows = self._connect().execute(
+            "SELECT status, COUNT(*) FROM jobs WHERE status NOT IN (?, ?) GROUP BY status", ACTIVE_STATUSES
+        ).fetchall()
+        counts = {'done': 0, 'failed': 0, 'cancelled': 0}
+        for status, count in rows:
+            counts[status if status in ('done', 'cancelled') else 'failed'] += count
+        return counts
+
+    def heartbeat(self, job_ids: Iterable[int]):
+        """Продлевает задачи, которые воркер ещё выполняет"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        self._connect().execute(
+            f"UPDATE jobs SET heartbeat_at = ? WHERE id IN ({','.join('?' * len(job_ids))})",
+            (time.time(), *job_ids)
+        )
+
+    def requeue(self, job_id: int, refund_attempt: bool = True):
+        """
+        Возвращает задачу в очередь. Если воркер не смог её взять, попытка не засчитывается;
+        прерванная остановкой воркера задача (refund_attempt=False) попытку тратит
+        """
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, worker = NULL, attempts = attempts - ? WHERE id = ?",
+            (QUEUED, 1 if refund_attempt else 0, job_id)
+        )
+
+    def finish(self, job_id: int, status: str):
+        """Отмечает результат задачи: done, failed или cancelled"""
+        self._connect().execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), job_id)
+        )
+
+    def cancel_user_jobs(self, user_id: int) -> int:
+        """
+        Отменяет задачи пользователя: ожидающие - сразу,
+        выполняемые - флагом, который воркер увидит при следующем heartbeat
+        """
+        connection = self._connect()
+        now = time.time()
+        queued = connection.execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE user_id = ? AND status = ?",
+            (now, user_id, QUEUED)
+        ).rowcount
+        running = connection.execute(
+            "UPDATE jobs SET cancel_requested = 1 WHERE user_id = ? AND status = ? AND cancel_requested = 0",
+            (user_id, RUNNING)
+        ).rowcount
+        return queued + running
+
+    def cancel_requested(self, job_ids: Iterable[int]) -> List[int]:
+        """Какие из выполняемых задач пользователь попросил отменить"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        rows = self._connect().execute(
+            f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({','.join('?' * len(job_ids))})",
+            job_ids
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def inactive(self, job_ids: Iterable[int]) -> List[int]:
+        """Какие из задач уже завершены (или удалены из спула)"""
+        job_ids = list(job_ids)
+        if not job_ids:
+            return []
+        rows = self._connect().execute(
+            f"SELECT id FROM jobs WHERE status IN (?, ?) AND id IN ({','.join('?' * len(job_ids))})",
+            (*ACTIVE_STATUSES, *job_ids)
+        ).fetchall()
+        active = {row[0] for row in rows}
+        return [job_id for job_id in job_ids if job_id not in active]
+
+    def purge(self, max_age_hours: int = 24):
+        """Удаляет завершённые задачи старше max_age_hours"""
+        self._connect().execute(
+            "DELETE FROM jobs WHERE status NOT IN (?, ?) AND finished_at < ?",
+            (*ACTIVE_STATUSES, time.time() - max_age_hours * 3600)
+        )
+
+    def close(self):
+        """Закрывает соединение с базой"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
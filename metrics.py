@@ -0,0 +1,297 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Все созданные метрики в порядке объявления - отдаются эндпоинтом /metrics
+REGISTRY: List["Metric"] = []
+
+# Сколько ждать строку запроса от клиента эндпоинта метрик, секунды
+METRICS_REQUEST_TIMEOUT = 5.0
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str]) -> str:
+    """Форматирует метки в виде {name="value",...}"""
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labelvalues):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    """Форматирует число для текстового формата Prometheus"""
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Базовая метрика: имя, описание, метки и вывод в текстовом формате Prometheus"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """Значения меток в порядке labelnames"""
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], Tuple[str, ...], float]]:
+        """Строки метрики: (суффикс имени, имена меток, значения меток, значение)"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Метрика в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} {self.metric_type}"]
+        for suffix, labelnames, labelvalues, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labelnames, labelvalues)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонно растущий счётчик (событий, байт)"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        """Увеличивает счётчик"""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        """Текущее значение счётчика для меток"""
+        return self._values.get(self._key(labels), 0)
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """Значения счётчика по всем встречавшимся меткам"""
+        return dict(self._values)
+
+    @property
+    def total(self) -> float:
+        """Сумма по всем меткам"""
+        return sum(self._values.values())
+
+    def samples(self):
+        return [("", self.labelnames, key, value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """Текущее значение; может вычисляться функцией в момент чтения"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, description, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def set(self, value: float, **labels):
+        """Устанавливает значение"""
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """Значение будет вычисляться функцией при каждом чтении"""
+        self._functions[self._key(labels)] = function
+
+    def value(self, **labels) -> float:
+        """Текущее значение для меток"""
+        key = self._key(labels)
+        function = self._functions.get(key)
+        if function is not None:
+            try:
+                return function()
+            except Exception as e:
+                logger.warning(f"Ошибка вычисления метрики {self.name}: {e}")
+                return 0
+        return self._values.get(key, 0)
+
+    def samples(self):
+        keys = sorted(set(self._values) | set(self._functions))
+        return [("", self.labelnames, key, self.value(**dict(zip(self.labelnames, key))))
+                for key in keys]
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными корзинами (в духе Prometheus)"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float]):
+        super().__init__(name, description)
+        self.buckets: List[float] = sorted(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Добавляет наблюдение"""
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    @property
+    def average(self) -> float:
+        """Среднее значение наблюдений"""
+        return self.sum / self.count if self.count else 0.0
+
+    def samples(self):
+        samples = [("_bucket", ("le",), (_format_value(float(bound)),), count)
+                   for bound, count in zip(self.buckets, self.bucket_counts)]
+        samples.append(("_bucket", ("le",), ("+Inf",), self.count))
+        samples.append(("_sum", (), (), self.sum))
+        samples.append(("_count", (), (), self.count))
+        return samples
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Отвечает на HTTP-запрос: /metrics - метрики, остальное - 404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), METRICS_REQUEST_TIMEOUT)
+        # Заголовки запроса не нужны, но их надо дочитать до пустой строки
+        while True:
+            header = await asyncio.wait_for(reader.readline(), METRICS_REQUEST_TIMEOUT)
+            if header in (b'\r\n', b'\n', b''):
+                break
+
+        parts = request_line.decode('latin-1').split()
+        path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+        if path == '/metrics':
+            status = "200 OK"
+            body = render_metrics().encode('utf-8')
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status = "404 Not Found"
+            body = b"Not Found\n"
+            content_type = "text/plain; charset=utf-8"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.warning(f"Ошибка обработки запроса метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """Запускает HTTP-эндпоинт /metrics; при ошибке бот продолжает работать без него"""
+    try:
+        server = await asyncio.start_server(_handle_metrics_request, host, port)
+        logger.info(f"📈 Метрики Prometheus: http://{host}:{port}/metrics")
+        return server
+    except OSError as e:
+        logger.error(f"Не удалось запустить эндпоинт метрик на {host}:{port}: {e}")
+        return None
+
+
+# Задачи планировщика
+JOBS_IN_FLIGHT = Gauge(
+    'videobot_jobs_in_flight',
+    'Задачи, которые обрабатываются прямо сейчас'
+)
+JOBS_QUEUED = Gauge(
+    'videobot_jobs_queued',
+    'Задачи, ожидающие свободного воркера'
+)
+JOBS_TOTAL = Counter(
+    'videobot_jobs_total',
+    'Завершённые задачи по результату',
+    labelnames=('status',)
+)
+
+# Длительность этапов задачи, секунды
+DOWNLOAD_SECONDS = Histogram(
+    'videobot_download_seconds',
+    'Длительность скачивания исходного видео',
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+)
+PROBE_SECONDS = Histogram(
+    'videobot_probe_seconds',
+    'Длительность ffprobe',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+ENCODE_SECONDS = Histogram(
+    'videobot_encode_seconds',
+    'Длительность кодирования одного варианта',
+    buckets=(1, 2, 5, 10, 30, 60, 120, 300, 600)
+)
+UPLOAD_SECONDS = Histogram(
+    'videobot_upload_seconds',
+    'Длительность одного запроса отправки (видео или альбом)',
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 120)
+)
+
+# Трафик
+BYTES_IN = Counter(
+    'videobot_bytes_in_total',
+    'Скачано байт исходных видео'
+)
+BYTES_OUT = Counter(
+    'videobot_bytes_out_total',
+    'Отправлено байт готовых вариантов'
+)
+
+# Ошибки FFmpeg: timeout, stall, exit (ненулевой код), spawn (не запустился), probe (ffprobe)
+FFMPEG_FAILURES = Counter(
+    'videobot_ffmpeg_failures_total',
+    'Неудачные запуски FFmpeg по причине',
+    labelnames=('reason',)
+)
+
+# Занятое место во временных каталогах
+DIR_USAGE_BYTES = Gauge(
+    'videobot_dir_usage_bytes',
+    'Размер файлов во временном и выходном каталогах',
+    labelnames=('dir',)
+)
+DIR_FILES = Gauge(
+    'videobot_dir_files',
+    'Количество файлов во временном и выходном каталогах',
+    labelnames=('dir',)
+)
+
+# Скорость кодирования относительно реального времени (speed из -progress FFmpeg)
+ENCODE_SPEED = Histogram(
+    'videobot_encode_speed_ratio',
+    'Скорость кодирования FFmpeg относительно реального времени',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16)
+)
+
+# Кадров в секунду при кодировании
+ENCODE_FPS = Histogram(
+    'videobot_encode_fps',
+    'Кадров в секунду при кодировании FFmpeg',
+    buckets=(5, 10, 25, 50, 100, 200, 400)
+)
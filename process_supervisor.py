@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Владелец (user_id) задачи, в контексте которой запускаются дочерние процессы
+current_job_owner: ContextVar[Optional[int]] = ContextVar('current_job_owner', default=None)
+
+# Как часто проверять таймауты запущенного процесса, секунды
+WATCH_INTERVAL = 1.0
+
+
+class ProcessSupervisor:
+    """Учёт дочерних процессов FFmpeg: таймауты, отмена и принудительное завершение"""
+
+    def __init__(self):
+        # pid -> (процесс, владелец)
+        self._processes: Dict[int, tuple] = {}
+
+    @property
+    def active_count(self) -> int:
+        """Количество запущенных дочерних процессов"""
+        return len(self._processes)
+
+    async def spawn(self, *args, **kwargs) -> asyncio.subprocess.Process:
+        """Запускает процесс в отдельной группе, чтобы при остановке убить его вместе с потомками"""
+        if os.name == 'posix':
+            kwargs.setdefault('start_new_session', True)
+
+        process = await asyncio.create_subprocess_exec(*args, **kwargs)
+        self._processes[process.pid] = (process, current_job_owner.get())
+        return process
+
+    def release(self, process: asyncio.subprocess.Process):
+        """Снимает завершившийся процесс с учёта"""
+        self._processes.pop(process.pid, None)
+
+    def kill(self, process: asyncio.subprocess.Process):
+        """Убивает процесс вместе с его группой"""
+        if process.returncode is not None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+            logger.warning(f"Процесс {process.pid} принудительно завершён")
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            logger.error(f"Не удалось завершить процесс {process.pid}: {e}")
+
+    def kill_owner(self, owner: int) -> int:
+        """Убивает все процессы задач пользователя, возвращает их количество"""
+        processes = [process for process, process_owner in self._processes.values()
+                     if process_owner == owner]
+        for process in processes:
+            self.kill(process)
+        return len(processes)
+
+    def kill_all(self) -> int:
+        """Убивает все запущенные процессы (при остановке бота)"""
+        processes = [process for process, _ in self._processes.values()]
+        for process in processes:
+            self.kill(process)
+        if processes:
+            logger.info(f"При остановке завершено процессов FFmpeg: {len(processes)}")
+        return len(processes)
+
+    async def supervise(self, process: asyncio.subprocess.Process, work: Awaitable,
+                        last_activity: Callable[[], float],
+                        wall_timeout: float, stall_timeout: float) -> Optional[str]:
+        """
+        Ждёт, пока завершится работа с процессом (чтение его вывода).
+        Убивает процесс при превышении общего таймаута или если он перестал
+        сообщать о прогрессе. Возвращает причину остановки ('timeout', 'stall') или None
+        """
+        started_at = time.monotonic()
+        work_task = asyncio.ensure_future(work)
+        try:
+            while True:
+                done, _ = await asyncio.wait({work_task}, timeout=WATCH_INTERVAL)
+                if done:
+                    work_task.result()
+                    return None
+
+                now = time.monotonic()
+                if wall_timeout and now - started_at > wall_timeout:
+                    reason = 'timeout'
+                elif stall_timeout and now - last_activity() > stall_timeout:
+                    reason = 'stall'
+                else:
+                    continue
+
+                logger.error(f"Процесс {process.pid} остановлен: "
+                             f"{'превышен общий таймаут' if reason == 'timeout' else 'нет прогресса'}")
+                self.kill(process)
+                # После убийства вывод процесса закрывается и чтение завершается
+                await asyncio.gather(work_task, return_exceptions=True)
+                return reason
+        except asyncio.CancelledError:
+            # Задачу отменили (/cancel, остановка бота) - процесс не должен пережить её
+            self.kill(process)
+            work_task.cancel()
+            raise
+        finally:
+            await asyncio.gather(work_task, return_exceptions=True)
+            self.release(process)
+
+
+# Глобальный супервизор дочерних процессов
+process_supervisor = ProcessSupervisor()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def format_eta(seconds: float) -> str:
+    """Форматирует оставшееся время как М:СС"""
+    seconds = max(0, int(seconds))
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class JobProgress:
+    """
+    Сводный прогресс кодирования задачи по всем вариантам.
+    skip - индексы вариантов, которые не кодируются (готовы или отправлены до перезапуска):
+    они не входят ни в проценты, ни в оценку оставшегося времени
+    """
+
+    def __init__(self, duration: float, variants: int, skip: Iterable[int] = ()):
+        self.duration = duration
+        skip = set(skip)
+        self.fractions: Dict[int, float] = {index: 0.0 for index in range(variants) if index not in skip}
+        self.speed = 0.0
+        self.fps = 0.0
+        self.started_at = time.monotonic()
+
+    def update(self, variant_index: int, snapshot: dict):
+        """Учитывает очередной снимок прогресса FFmpeg для варианта"""
+        if self.duration > 0 and variant_index in self.fractions:
+            fraction = snapshot.get('out_time', 0.0) / self.duration
+            if snapshot.get('done'):
+                fraction = 1.0
+            self.fractions[variant_index] = min(1.0, max(self.fractions[variant_index], fraction))
+        self.speed = snapshot.get('speed') or self.speed
+        self.fps = snapshot.get('fps') or self.fps
+
+    @property
+    def fraction(self) -> float:
+        """Доля выполненной работы по всем вариантам"""
+        if not self.fractions:
+            return 1.0
+        return sum(self.fractions.values()) / len(self.fractions)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах"""
+        fraction = self.fraction
+        if fraction <= 0:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return elapsed / fraction - elapsed
+
+    def format_status(self) -> str:
+        """Текст статусного сообщения"""
+        text = f"🔄 Кодирую варианты: {self.fraction * 100:.0f}%"
+        eta = self.eta
+        if eta is not None:
+            text += f"\n⏱ Осталось примерно {format_eta(eta)}"
+        if self.speed:
+            text += f"\n⚡ Скорость: {self.speed:.2f}x, {self.fps:.0f} fps"
+        return text
+
+
+class EditRateLimiter:
+    """Общий для всех задач ограничитель частоты правок сообщений"""
+
+    def __init__(self, edits_per_second: float):
+        self._interval = 1.0 / max(edits_per_second, 0.01)
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """Ждёт свободного слота для очередной правки"""
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot = max(now, self._next_slot) + self._interval
+
+
+class ProgressMessage:
+    """
+    Статусное сообщение задачи: частые обновления схлопываются,
+    в Telegram уходит только последний текст не чаще раза в min_interval секунд
+    """
+
+    def __init__(self, message: Message, limiter: EditRateLimiter, min_interval: float):
+        self.message = message
+        self.limiter = limiter
+        self.min_interval = min_interval
+        self._pending: Optional[str] = None
+        self._last_text: Optional[str] = None
+        self._last_edit = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def update(self, text: str):
+        """Запоминает новый текст; правка будет отправлена, когда позволят лимиты"""
+        self._pending = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending is not None:
+            delay = self._last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.limiter.wait()
+
+            text, self._pending = self._pending, None
+            if text == self._last_text:
+                continue
+            try:
+                await self.message.edit_text(text)
+                self._last_text = text
+            except RetryAfter as e:
+                # Telegram просит подождать - повторим с последним текстом
+                logger.warning(f"Лимит правок сообщений, ждём {e.retry_after}с")
+                self._pending = self._pending or text
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                # "Message is not modified" и подобные ошибки не критичны
+                logger.debug(f"Правка статуса пропущена: {e}")
+            except Exception as e:
+                logger.warning(f"Ошибка обновления статуса: {e}")
+            self._last_edit = time.monotonic()
+
+    async def close(self):
+        """Останавливает отправку отложенных правок"""
+        self._pending = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """
+    Постоянный кэш уже отправленных вариантов.
+    Ключ - file_unique_id исходного видео плюс лестница качества,
+    значение - file_id Telegram отправленных видео с подписями
+    """
+
+    def __init__(self, db_path: Path, max_entries: int = 1000, ttl_hours: int = 72):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_hours * 3600
+        self.hits = 0
+        self.misses = 0
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def hit_rate(self) -> float:
+        """Доля запросов, обслуженных из кэша"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает базу кэша при первом обращении"""
+        if self._connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.db_path))
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " entries TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def make_key(file_unique_id: str, ladder: List[dict]) -> str:
+        """Строит ключ кэша из file_unique_id и настроек вариантов"""
+        ladder_json = json.dumps(ladder, sort_keys=True, ensure_ascii=False)
+        ladder_hash = hashlib.sha1(ladder_json.encode('utf-8')).hexdigest()[:16]
+        return f"{file_unique_id}:{ladder_hash}"
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """Возвращает сохранённые варианты ([{file_id, caption}, ...]) или None"""
+        try:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT entries, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            now = time.time()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            connection.commit()
+            self.hits += 1
+            logger.info(f"♻️ Кэш результатов: попадание {key}, hit rate {self.hit_rate:.0%}")
+            return json.loads(row[0])
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша результатов: {e}")
+            self.misses += 1
+            return None
+
+    def put(self, key: str, entries: List[dict]):
+        """Сохраняет отправленные варианты и вытесняет устаревшие записи"""
+        try:
+            connection = self._connect()
+            now = time.time()
+            connection.execute(
+                "INSERT OR REPLACE INTO results (key, entries, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(entries, ensure_ascii=False), now, now)
+            )
+            self._evict(connection, now)
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш результатов: {e}")
+
+    def delete(self, key: str):
+        """Удаляет запись (например, с устаревшими file_id)"""
+        try:
+            connection = self._connect()
+            connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Ошибка удаления из кэша результатов: {e}")
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        """Удаляет записи старше TTL и самые давно использованные сверх лимита"""
+        connection.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+        connection.execute(
+            "DELETE FROM results WHERE key IN ("
+            " SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def close(self):
+        """Закрывает соединение с базой"""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 """
 VideoBot - Телеграм бот для сжатия видео
-Запуск основного приложения
+Запуск основного приложения:
+    python run.py                - бот (приём видео и, при ENCODE_BACKEND=local, кодирование)
+    python run.py --mode worker  - воркер кодирования, забирает задачи из спула
 """
 
+import argparse
 import asyncio
 import sys
 import logging
@@ -14,6 +17,7 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from bot import main
 from config import settings
+from job_journal import JobJournal
 from utils import cleanup_old_files
 
 logger = logging.getLogger(__name__)
@@ -62,16 +66,21 @@ def setup_directories():
 def cleanup_startup():
     """Очистка при запуске"""
     try:
-        # Очищаем старые временные файлы
-        cleanup_old_files(settings.temp_dir, max_age_hours=1)
-        cleanup_old_files(settings.output_dir, max_age_hours=24)
+        # Очищаем старые временные файлы, кроме файлов незавершённых задач из журнала
+        journal = JobJournal(settings.journal_path)
+        try:
+            keep_prefixes = journal.active_prefixes()
+        finally:
+            journal.close()
+        cleanup_old_files(settings.temp_dir, max_age_hours=1, keep_prefixes=keep_prefixes)
+        cleanup_old_files(settings.output_dir, max_age_hours=24, keep_prefixes=keep_prefixes)
         logger.info("✅ Очистка временных файлов завершена")
     except Exception as e:
         logger.warning(f"⚠️ Ошибка очистки: {e}")
 
 
-def run_bot():
-    """Запускает бота с проверками"""
+def run_bot(mode: str = "bot"):
+    """Запускает бота или воркер кодирования с проверками"""
     
     # Проверяем конфигурацию
     if not settings.bot_token:
@@ -94,14 +103,21 @@ def run_bot():
     # Очистка при запуске
     cleanup_startup()
     
-    logger.info("🚀 Запускаем VideoBot...")
-    logger.info(f"📊 Максимальный размер файла: {settings.max_file_size_mb}MB")
+    logger.info(f"🚀 Запускаем VideoBot ({mode})...")
+    logger.info(f"📊 Максимальный размер файла: {settings.max_input_mb}MB")
+    if settings.bot_api_base_url:
+        logger.info(f"🖥 Локальный Bot API: {settings.bot_api_base_url}"
+                    f"{' (файлы читаются с диска сервера)' if settings.bot_api_local_mode else ''}")
     logger.info(f"📁 Временные файлы: {settings.temp_dir}")
     logger.info(f"📁 Выходные файлы: {settings.output_dir}")
     
     # Запускаем основное приложение
     try:
-        asyncio.run(main())
+        if mode == "worker":
+            from worker import worker_main
+            asyncio.run(worker_main())
+        else:
+            asyncio.run(main())
         return True
     except KeyboardInterrupt:
         logger.info("👋 Бот остановлен пользователем")
@@ -112,6 +128,11 @@ def run_bot():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VideoBot")
+    parser.add_argument("--mode", choices=("bot", "worker"), default="bot",
+                        help="bot - телеграм бот, worker - процесс кодирования задач из спула")
+    args = parser.parse_args()
+    
     # Настройка логирования
     logging.basicConfig(
         level=logging.INFO,
@@ -127,7 +148,7 @@ if __name__ == "__main__":
     logger.info("=" * 50)
     
     # Запускаем бота
-    success = run_bot()
+    success = run_bot(args.mode)
     
     if success:
         logger.info("✅ Бот завершен успешно")
@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, Deque, Dict, List, Optional
+
+from metrics import JOBS_TOTAL
+from process_supervisor import current_job_owner, process_supervisor
+
+if TYPE_CHECKING:
+    from admission import AdmissionController, Footprint
+
+logger = logging.getLogger(__name__)
+
+# Как часто перепроверять допуск задачи, которая ждёт ресурсов, секунды
+ADMISSION_RECHECK_INTERVAL = 5.0
+
+
+class QueueLimitExceeded(Exception):
+    """Пользователь превысил лимит задач в очереди"""
+
+
+@dataclass
+class Job:
+    """Задача кодирования в очереди планировщика"""
+    job_id: int
+    user_id: int
+    # Возвращает итоговый статус задачи: None или 'done' - успех, любой другой - ошибка
+    run: Callable[[], Awaitable[Optional[str]]]
+    created_at: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Task] = None
+    cancelled: bool = False
+    footprint: Optional["Footprint"] = None
+    # Вызывается, если задачу сняли с очереди до запуска (run так и не вызван)
+    on_cancel: Optional[Callable[[], None]] = None
+
+
+class JobScheduler:
+    """Очередь тяжёлых задач с пулом воркеров и круговой очередностью между пользователями"""
+
+    def __init__(self, workers: int, max_jobs_per_user: int,
+                 admission: Optional["AdmissionController"] = None):
+        self.workers = max(1, workers)
+        self.max_jobs_per_user = max_jobs_per_user
+        # Допуск по диску и памяти; без него задачи ограничены только числом воркеров
+        self.admission = admission
+        # Срабатывает, когда задача завершилась и освободила ресурсы
+        self._capacity_changed = asyncio.Event()
+
+        # Очереди пользователей; порядок ключей - порядок обхода по кругу
+        self._user_queues: "OrderedDict[int, Deque[Job]]" = OrderedDict()
+        # Один токен на каждую поставленную задачу - будит свободного воркера
+        self._tokens: asyncio.Queue = asyncio.Queue()
+        self._running: Dict[int, Job] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        self._job_ids = itertools.count(1)
+
+    @property
+    def queued_count(self) -> int:
+        """Количество задач, ожидающих воркера"""
+        return sum(len(jobs) for jobs in self._user_queues.values())
+
+    @property
+    def running_count(self) -> int:
+        """Количество задач, обрабатываемых прямо сейчас"""
+        return len(self._running)
+
+    def user_job_count(self, user_id: int) -> int:
+        """Количество задач пользователя в очереди и в работе"""
+        queued = len(self._user_queues.get(user_id, ()))
+        running = sum(1 for job in self._running.values() if job.user_id == user_id)
+        return queued + running
+
+    def submit(self, user_id: int, run: Callable[[], Awaitable[Optional[str]]],
+               footprint: Optional["Footprint"] = None,
+               on_cancel: Optional[Callable[[], None]] = None) -> int:
+        """
+        Ставит задачу в очередь.
+        on_cancel вызывается, если задачу отменят до запуска.
+        Возвращает место в очереди (0 - задача сразу уйдёт свободному воркеру)
+        """
+        if self.user_job_count(user_id) >= self.max_jobs_per_user:
+            raise QueueLimitExceeded(
+                f"У пользователя {user_id} уже {self.max_jobs_per_user} задач в обработке"
+            )
+
+        job = Job(job_id=next(self._job_ids), user_id=user_id, run=run, footprint=footprint,
+                  on_cancel=on_cancel)
+        self._user_queues.setdefault(user_id, deque()).append(job)
+        self._tokens.put_nowait(job.job_id)
+        # Воркеры, ждущие ресурсов, перепроверяют очередь с новой задачей
+        self._capacity_changed.set()
+
+        idle_workers = max(0, self.workers - self.running_count)
+        position = max(0, self._position(job) - idle_workers)
+        if position == 0 and not self._admissible(job):
+            # Воркер свободен, но задача ждёт, пока освободятся диск или память
+            position = 1
+        logger.info(f"Задача {job.job_id} пользователя {user_id} поставлена в очередь, место: {position}")
+        return position
+
+    def _position(self, job: Job) -> int:
+        """Вычисляет порядковый номер задачи при круговом обходе пользователей"""
+        queues = [list(jobs) for jobs in self._user_queues.values()]
+        position = 0
+        for round_index in itertools.count():
+            if all(round_index >= len(jobs) for jobs in queues):
+                break
+            for jobs in queues:
+                if round_index < len(jobs):
+                    position += 1
+                    if jobs[round_index] is job:
+                        return position
+        return position
+
+    def _admissible(self, job: Job) -> bool:
+        """Хватает ли ресурсов на задачу рядом с уже запущенными"""
+        if self.admission is None or job.footprint is None:
+            return True
+        if not self._running:
+            # Задачи, которые не поместятся никогда, отсекаются при постановке;
+            # на простаивающем сервере очередная задача запускается в любом случае
+            return True
+        return self.admission.fits(job.footprint)
+
+    def _next_job(self) -> Optional[Job]:
+        """
+        Берёт следующую задачу по кругу между пользователями.
+        Задача, которой не хватает ресурсов, пропускается в пользу следующей
+        """
+        for user_id, jobs in list(self._user_queues.items()):
+            job = jobs[0]
+            if not self._admissible(job):
+                continue
+
+            jobs.popleft()
+            if jobs:
+                # Пользователь с оставшимися задачами уходит в конец круга
+                self._user_queues.move_to_end(user_id)
+            else:
+                del self._user_queues[user_id]
+            return job
+        return None
+
+    async def _wait_admissible_job(self) -> Optional[Job]:
+        """Ждёт задачу, на которую хватает ресурсов; None - очередь опустела"""
+        while self._user_queues:
+            job = self._next_job()
+            if job is not None:
+                return job
+
+            self._capacity_changed.clear()
+            try:
+                await asyncio.wait_for(self._capacity_changed.wait(), ADMISSION_RECHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return None
+
+    async def _worker(self, worker_id: int):
+        """Воркер: забирает задачи из очереди и выполняет их по одной"""
+        while True:
+            await self._tokens.get()
+            job = await self._wait_admissible_job()
+            if job is None:
+                continue
+
+            if self.admission is not None and job.footprint is not None:
+                self.admission.reserve(job.footprint)
+            self._running[job.job_id] = job
+            wait_time = time.monotonic() - job.created_at
+            logger.info(f"Воркер {worker_id}: задача {job.job_id} пользователя {job.user_id}, "
+                        f"ожидание в очереди {wait_time:.1f}с")
+
+            # Дочерние процессы задачи помечаются её владельцем (для /cancel)
+            current_job_owner.set(job.user_id)
+            job.task = asyncio.ensure_future(job.run())
+            try:
+                # Обработчики сами ловят свои ошибки, поэтому итог берём из возвращённого статуса
+                status = await job.task
+                JOBS_TOTAL.inc(status='done' if status in (None, 'done') else 'failed')
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    raise
+                JOBS_TOTAL.inc(status='cancelled')
+                logger.info(f"Воркер {worker_id}: задача {job.job_id} отменена пользователем")
+            except Exception as e:
+                JOBS_TOTAL.inc(status='failed')
+                logger.error(f"Воркер {worker_id}: ошибка задачи {job.job_id}: {e}")
+            finally:
+                self._running.pop(job.job_id, None)
+                if self.admission is not None and job.footprint is not None:
+                    self.admission.release(job.footprint)
+                self._capacity_changed.set()
+
+    def cancel_user_jobs(self, user_id: int) -> int:
+        """Отменяет задачи пользователя в очереди и в работе, возвращает их количество"""
+        cancelled = 0
+
+        queued_jobs = self._user_queues.pop(user_id, None)
+        if queued_jobs:
+            cancelled += len(queued_jobs)
+            for job in queued_jobs:
+                if job.on_cancel is None:
+                    continue
+                try:
+                    job.on_cancel()
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика отмены задачи {job.job_id}: {e}")
+
+        for job in list(self._running.values()):
+            if job.user_id == user_id and job.task is not None and not job.task.done():
+                job.cancelled = True
+                job.task.cancel()
+                cancelled += 1
+
+        # Процессы убиваем сразу, не дожидаясь обработки отмены
+        process_supervisor.kill_owner(user_id)
+
+        if cancelled:
+            logger.info(f"Отменено задач пользователя {user_id}: {cancelled}")
+        return cancelled
+
+    def start(self):
+        """Запускает воркеров"""
+        if self._worker_tasks:
+            return
+        self._worker_tasks = [
+            asyncio.create_task(self._worker(worker_id))
+            for worker_id in range(1, self.workers + 1)
+        ]
+        logger.info(f"Планировщик запущен: воркеров {self.workers}, "
+                    f"лимит задач на пользователя {self.max_jobs_per_user}")
+
+    async def stop(self):
+        """Останавливает воркеров и прерывает текущие задачи"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable
+
+import psutil
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SystemMonitor:
+    """
+    Фоновый замер ресурсов машины: CPU, память, свободное место и память FFmpeg.
+    Обработчики читают последний снимок и не ждут замеров
+    """
+
+    def __init__(self, directories: Iterable[Path]):
+        self.directories = list(directories)
+        self.cpu_percent = 0.0
+        self.memory_percent = 0.0
+        self.memory_available = 0
+        self.disk_percent = 0.0
+        self.disk_free = 0
+        # Суммарная память дочерних процессов (FFmpeg)
+        self.children_rss = 0
+        self.sampled_at = 0.0
+        self._process = psutil.Process()
+
+    def _disk_usage(self):
+        """Использование диска рабочих каталогов (берётся самый заполненный)"""
+        usages = []
+        for directory in self.directories:
+            path = directory if directory.exists() else Path('.')
+            usages.append(shutil.disk_usage(path))
+        return min(usages, key=lambda usage: usage.free)
+
+    def _children_rss(self) -> int:
+        rss = 0
+        for child in self._process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def sample(self):
+        """Снимает показатели (неблокирующий cpu_percent - загрузка с прошлого замера)"""
+        memory = psutil.virtual_memory()
+        disk = self._disk_usage()
+
+        self.cpu_percent = psutil.cpu_percent(interval=None)
+        self.memory_percent = memory.percent
+        self.memory_available = memory.available
+        self.disk_percent = disk.used / disk.total * 100 if disk.total else 0.0
+        self.disk_free = disk.free
+        self.children_rss = self._children_rss()
+        self.sampled_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Последние замеры; при первом обращении замер делается сразу"""
+        if not self.sampled_at:
+            self.sample()
+        return {
+            'cpu_percent': self.cpu_percent,
+            'memory_percent': self.memory_percent,
+            'memory_available': self.memory_available,
+            'disk_percent': self.disk_percent,
+            'disk_free': self.disk_free,
+            'children_rss': self.children_rss,
+            'sampled_at': self.sampled_at,
+        }
+
+    async def run(self):
+        """Замеры каждые system_sample_interval секунд в отдельном потоке"""
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка замера ресурсов системы: {e}")
+            await asyncio.sleep(settings.system_sample_interval)
+
+
+# Глобальный монитор ресурсов
+system_monitor = SystemMonitor([settings.temp_dir, settings.output_dir])
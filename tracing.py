@@ -0,0 +1,122 @@
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Отдельный логгер: одна JSON-строка на задачу, без форматирования основного лога
+trace_logger = logging.getLogger('videobot.traces')
+trace_logger.propagate = False
+
+# Трасса задачи и текущий этап в контексте, где выполняется задача
+current_trace: ContextVar[Optional["JobTrace"]] = ContextVar('current_trace', default=None)
+current_span: ContextVar[Optional[dict]] = ContextVar('current_span', default=None)
+
+
+def setup_trace_log(path: Path, max_mb: int, backups: int):
+    """Направляет готовые трассы в файл с ротацией по размеру"""
+    if trace_logger.handlers:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    handler = RotatingFileHandler(path, maxBytes=max_mb * 1024 * 1024,
+                                  backupCount=backups, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    logger.info(f"🧭 Трассы задач пишутся в {path}")
+
+
+class JobTrace:
+    """Трасса одной задачи: этапы с длительностями, размерами и аргументами FFmpeg"""
+
+    def __init__(self, user_id: int, **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.user_id = user_id
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.spans: List[dict] = []
+        self.status = "unknown"
+        self.started_at = time.time()
+        self.started_monotonic = time.monotonic()
+        self._finished = False
+
+    def _offset(self, monotonic: float) -> float:
+        return round(monotonic - self.started_monotonic, 3)
+
+    def add_span(self, name: str, started_monotonic: float, finished_monotonic: float, **attributes) -> dict:
+        """Добавляет уже завершившийся этап"""
+        span = {
+            'name': name,
+            'start': self._offset(started_monotonic),
+            'duration': round(finished_monotonic - started_monotonic, 3),
+            **attributes
+        }
+        self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[dict]:
+        """Этап задачи; атрибуты можно дописывать в выданный словарь"""
+        span = {'name': name, 'start': self._offset(time.monotonic()), **attributes}
+        started = time.monotonic()
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span['error'] = type(e).__name__ if not str(e) else f"{type(e).__name__}: {str(e)[:200]}"
+            raise
+        finally:
+            current_span.reset(token)
+            span['duration'] = round(time.monotonic() - started, 3)
+            self.spans.append(span)
+
+    def set(self, **attributes):
+        """Дописывает атрибуты задачи"""
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        """Трасса в виде словаря для JSON"""
+        return {
+            'trace_id': self.trace_id,
+            'user_id': self.user_id,
+            'status': self.status,
+            'started_at': round(self.started_at, 3),
+            'duration': self._offset(time.monotonic()),
+            **self.attributes,
+            'spans': sorted(self.spans, key=lambda span: span['start'])
+        }
+
+    def finish(self, status: Optional[str] = None):
+        """Завершает трассу и записывает её одной JSON-строкой"""
+        if self._finished:
+            return
+        self._finished = True
+        if status:
+            self.status = status
+        try:
+            trace_logger.info(json.dumps(self.to_dict(), ensure_ascii=False, default=str))
+        except Exception as e:
+            logger.warning(f"Не удалось записать трассу задачи {self.trace_id}: {e}")
+
+
+@contextmanager
+def trace_span(name: str, **attributes) -> Iterator[dict]:
+    """Этап текущей задачи; вне задачи атрибуты просто никуда не попадут"""
+    trace = current_trace.get()
+    if trace is None:
+        yield dict(attributes)
+        return
+    with trace.span(name, **attributes) as span:
+        yield span
+
+
+def annotate_span(**attributes):
+    """Дописывает атрибуты в текущий этап задачи (например, аргументы FFmpeg)"""
+    span = current_span.get()
+    if span is not None:
+        span.update(attributes)
@@ -1,8 +1,7 @@
 import os
-import psutil
 import logging
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, Optional
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
@@ -13,8 +12,11 @@ def get_file_size_formatted(file_path: Path) -> str:
     if not file_path.exists():
         return "0 B"
     
-    size = file_path.stat().st_size
-    
+    return format_file_size(file_path.stat().st_size)
+
+
+def format_file_size(size: float) -> str:
+    """Форматирует размер в байтах в читаемый вид"""
     for unit in ['B', 'KB', 'MB', 'GB']:
         if size < 1024.0:
             return f"{size:.1f} {unit}"
@@ -23,21 +25,30 @@ def get_file_size_formatted(file_path: Path) -> str:
 
 
 def get_system_info() -> Dict[str, Any]:
-    """Возвращает информацию о системе"""
+    """Возвращает информацию о системе (последний замер фонового монитора, без ожидания)"""
+    from system_monitor import system_monitor
+    
     try:
+        snapshot = system_monitor.snapshot()
         return {
-            'cpu_percent': psutil.cpu_percent(interval=1),
-            'memory_percent': psutil.virtual_memory().percent,
-            'disk_percent': psutil.disk_usage('/').percent,
-            'timestamp': datetime.now().isoformat()
+            'cpu_percent': snapshot['cpu_percent'],
+            'memory_percent': snapshot['memory_percent'],
+            'disk_percent': snapshot['disk_percent'],
+            'timestamp': datetime.fromtimestamp(snapshot['sampled_at']).isoformat()
         }
     except Exception as e:
         logger.error(f"Ошибка получения информации о системе: {e}")
         return {}
 
 
-def validate_video_file(file_path: Path) -> Dict[str, Any]:
-    """Валидирует видео файл"""
+def validate_video_file(file_path: Path, video_info: Optional[Dict[str, Any]] = None,
+                        file_size: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Валидирует видео файл.
+    Если передан результат ffprobe (video_info), формат проверяется по нему,
+    а не по расширению; пустой словарь означает, что ffprobe не смог прочитать файл.
+    file_size передаётся для входа, который хранится в памяти, а не на диске
+    """
     result = {
         'is_valid': False,
         'error': None,
@@ -45,23 +56,39 @@ def validate_video_file(file_path: Path) -> Dict[str, Any]:
     }
     
     try:
-        if not file_path.exists():
-            result['error'] = "Файл не существует"
-            return result
+        if file_size is None:
+            if not file_path.exists():
+                result['error'] = "Файл не существует"
+                return result
+            file_size = file_path.stat().st_size
         
-        if file_path.stat().st_size == 0:
+        if file_size == 0:
             result['error'] = "Файл пустой"
             return result
         
-        # Проверяем расширение
-        from config import SUPPORTED_VIDEO_FORMATS
-        if file_path.suffix.lower() not in SUPPORTED_VIDEO_FORMATS:
-            result['error'] = f"Неподдерживаемый формат: {file_path.suffix}"
-            return result
+        if video_info is not None:
+            # Проверяем данные ffprobe: есть ли декодируемый видеопоток
+            if not video_info.get('codec'):
+                result['error'] = "Не найден видеопоток"
+                return result
+            
+            if video_info.get('width', 0) <= 0 or video_info.get('height', 0) <= 0:
+                result['error'] = "Некорректный размер кадра"
+                return result
+            
+            if video_info.get('duration', 0) <= 0:
+                result['error'] = "Не удалось определить длительность видео"
+                return result
+        else:
+            # Проверяем расширение
+            from config import SUPPORTED_VIDEO_FORMATS
+            if file_path.suffix.lower() not in SUPPORTED_VIDEO_FORMATS:
+                result['error'] = f"Неподдерживаемый формат: {file_path.suffix}"
+                return result
         
         result['is_valid'] = True
         result['info'] = {
-            'size': get_file_size_formatted(file_path),
+            'size': format_file_size(file_size),
             'extension': file_path.suffix.lower(),
             'name': file_path.name
         }
@@ -73,8 +100,9 @@ def validate_video_file(file_path: Path) -> Dict[str, Any]:
     return result
 
 
-def cleanup_old_files(directory: Path, max_age_hours: int = 24):
-    """Удаляет старые файлы из директории"""
+def cleanup_old_files(directory: Path, max_age_hours: int = 24, keep_prefixes: Iterable[str] = ()):
+    """Удаляет старые файлы из директории, кроме файлов с префиксами keep_prefixes"""
+    keep_prefixes = tuple(keep_prefixes)
     if not directory.exists():
         return
     
@@ -83,7 +111,7 @@ def cleanup_old_files(directory: Path, max_age_hours: int = 24):
     
     for file_path in directory.iterdir():
         try:
-            if file_path.is_file():
+            if file_path.is_file() and not file_path.name.startswith(keep_prefixes):
                 file_age = current_time - file_path.stat().st_mtime
                 if file_age > max_age_seconds:
                     file_path.unlink()
@@ -120,30 +148,12 @@ def log_user_action(user_id: int, action: str, details: str = ""):
 
 
 def get_processing_stats() -> Dict[str, Any]:
-    """Возвращает статистику обработки"""
-    from config import settings
-    
-    stats = {
-        'temp_files': 0,
-        'output_files': 0,
-        'temp_size': 0,
-        'output_size': 0
-    }
-    
-    try:
-        # Подсчитываем файлы во временной директории
-        if settings.temp_dir.exists():
-            temp_files = list(settings.temp_dir.glob('*'))
-            stats['temp_files'] = len(temp_files)
-            stats['temp_size'] = sum(f.stat().st_size for f in temp_files if f.is_file())
-        
-        # Подсчитываем файлы в выходной директории
-        if settings.output_dir.exists():
-            output_files = list(settings.output_dir.glob('*'))
-            stats['output_files'] = len(output_files)
-            stats['output_size'] = sum(f.stat().st_size for f in output_files if f.is_file())
-    
-    except Exception as e:
-        logger.error(f"Ошибка получения статистики: {e}")
+    """Возвращает статистику обработки (по учёту уборщика, без обхода каталогов)"""
+    from janitor import janitor
     
-    return stats 
\ No newline at end of file
+    return {
+        'temp_files': janitor.file_count('temp'),
+        'output_files': janitor.file_count('output'),
+        'temp_size': janitor.usage('temp'),
+        'output_size': janitor.usage('output')
+    } 
\ No newline at end of file
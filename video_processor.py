@@ -1,13 +1,56 @@
 import asyncio
+import csv
+import json
+import os
 import random
 import logging
+import time
+from collections import OrderedDict
+from fractions import Fraction
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import AsyncIterator, Callable, Dict, List, Set, Tuple, Optional
 import ffmpeg
 from config import VIDEO_ASPECT_RATIOS, settings
+from janitor import janitor
+from metrics import ENCODE_FPS, ENCODE_SECONDS, ENCODE_SPEED, FFMPEG_FAILURES, PROBE_SECONDS
+from process_supervisor import process_supervisor
+from tracing import annotate_span, trace_span
 
 logger = logging.getLogger(__name__)
 
+# Параметры прогноза размера вариантов
+AUDIO_BITRATE_KBPS = 128
+REFERENCE_CRF = 23  # CRF, которому условно соответствует битрейт источника
+CONTAINER_OVERHEAD_BYTES = 64 * 1024
+
+# Сколько кадров декодировать при проверке входного файла
+DECODE_CHECK_FRAMES = 5
+
+# Превью для Telegram: JPEG не больше 320px по большей стороне
+THUMBNAIL_MAX_SIDE = 320
+# С какой секунды брать кадр превью (для коротких видео - с середины)
+THUMBNAIL_OFFSET_SECONDS = 1.0
+
+# Сегментное кодирование: куски не короче SEGMENT_MIN_SECONDS (запуск процесса и лишний
+# ключевой кадр на коротком куске не окупаются); после склейки длительность видео и начало
+# дорожек могут расходиться с исходником не больше чем на SEGMENT_SYNC_TOLERANCE секунд
+SEGMENT_MIN_SECONDS = 10.0
+SEGMENT_SYNC_TOLERANCE = 0.1
+
+# Пресеты x264 от медленного к быстрому и их скорость относительно medium
+X264_PRESET_SPEED = {
+    'slow': 0.5,
+    'medium': 1.0,
+    'fast': 1.3,
+    'faster': 1.8,
+    'veryfast': 3.0,
+    'superfast': 5.0,
+}
+# Примерная скорость medium на одно ядро, пикселей кодируемых кадров в секунду
+MEDIUM_PIXELS_PER_CORE_SECOND = 20_000_000
+# Стоимость декодирования и масштабирования пикселя входа относительно кодирования
+DECODE_COST = 0.1
+
 
 class VideoProcessor:
     """Класс для обработки видео с использованием FFmpeg"""
@@ -15,20 +58,186 @@ class VideoProcessor:
     def __init__(self):
         self.temp_dir = settings.temp_dir
         self.output_dir = settings.output_dir
+        
+        # LRU-кэш результатов ffprobe: (путь, размер, mtime) -> информация о видео
+        self._probe_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+        # Незавершённые пробы: параллельные запросы одного файла ждут одну пробу
+        self._probe_tasks: Dict[tuple, asyncio.Task] = {}
+        # Входы задач, скачанные в память: путь задачи -> содержимое файла.
+        # FFmpeg и ffprobe читают их через stdin (pipe:0), на диске файла нет
+        self._memory_inputs: Dict[Path, bytes] = {}
+        # Входы, которые читаются на месте (файлы локального сервера Bot API): путь задачи -> файл
+        self._external_inputs: Dict[Path, Path] = {}
+    
+    def attach_memory_input(self, path: Path, data: bytes):
+        """Регистрирует вход задачи, который хранится в памяти, под путём задачи"""
+        self._memory_inputs[path] = data
+    
+    def attach_external_input(self, path: Path, source: Path):
+        """
+        Регистрирует вход задачи, который FFmpeg читает из чужого файла без копирования.
+        Файл source не принадлежит задаче и никогда не удаляется
+        """
+        self._external_inputs[path] = source
+    
+    def detach_input(self, path: Path):
+        """Освобождает вход задачи в памяти или ссылку на чужой файл"""
+        self._memory_inputs.pop(path, None)
+        self._external_inputs.pop(path, None)
+    
+    def _input_file(self, path: Path) -> Path:
+        """Файл, из которого читается вход задачи"""
+        return self._external_inputs.get(path, path)
+    
+    def has_input(self, path: Path) -> bool:
+        """Есть ли вход задачи - в памяти или на диске"""
+        return path in self._memory_inputs or self._input_file(path).exists()
+    
+    def input_size(self, path: Path) -> int:
+        """Размер входа задачи в байтах"""
+        data = self._memory_inputs.get(path)
+        return len(data) if data is not None else self._input_file(path).stat().st_size
+    
+    def _input_url(self, path: Path) -> str:
+        """Источник для -i: pipe:0 для входа в памяти, иначе путь к файлу"""
+        return 'pipe:0' if path in self._memory_inputs else str(self._input_file(path))
+    
+    def _input_key(self, path: Path) -> tuple:
+        """Ключ кэша ffprobe: вход в памяти - по объекту, файл - по размеру и mtime"""
+        data = self._memory_inputs.get(path)
+        if data is not None:
+            return ('memory', str(path), len(data), id(data))
+        source = self._input_file(path)
+        stat = source.stat()
+        return (str(source.resolve()), stat.st_size, stat.st_mtime_ns)
+    
+    async def _run_ffprobe(self, video_path: Path) -> dict:
+        """Запускает ffprobe асинхронно, не блокируя цикл событий"""
+        started_at = time.monotonic()
+        input_data = self._memory_inputs.get(video_path)
+        process = await process_supervisor.spawn(
+            'ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json',
+            self._input_url(video_path),
+            stdin=asyncio.subprocess.PIPE if input_data is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(input_data), settings.ffmpeg_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process_supervisor.kill(process)
+            raise
+        finally:
+            process_supervisor.release(process)
+        
+        if process.returncode != 0:
+            FFMPEG_FAILURES.inc(reason='probe')
+            raise ffmpeg.Error('ffprobe', stdout, stderr)
+        PROBE_SECONDS.observe(time.monotonic() - started_at)
+        return json.loads(stdout.decode('utf-8'))
+    
+    def _parse_probe(self, probe: dict) -> dict:
+        """Извлекает из вывода ffprobe всё, что нужно для кодирования"""
+        video_info = next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+        audio_streams = [stream for stream in probe['streams'] if stream['codec_type'] == 'audio']
+        format_info = probe.get('format', {})
+        
+        # Поворот хранится либо в тегах (старые файлы), либо в side data матрицы отображения
+        rotation = int(float(video_info.get('tags', {}).get('rotate', 0)))
+        for side_data in video_info.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = int(float(side_data['rotation']))
+        
+        duration = float(video_info.get('duration') or format_info.get('duration') or 0)
+        
+        return {
+            'video_index': video_info['index'],
+            'width': int(video_info['width']),
+            'height': int(video_info['height']),
+            'duration': duration,
+            'codec': video_info['codec_name'],
+            'fps': self._parse_frame_rate(video_info.get('r_frame_rate', '30/1')),
+            'bitrate': int(format_info.get('bit_rate') or 0),
+            'rotation': rotation % 360,
+            'has_audio': bool(audio_streams),
+            'audio_streams': [
+                {
+                    'index': stream['index'],
+                    'codec': stream.get('codec_name'),
+                    'channels': stream.get('channels'),
+                    'language': stream.get('tags', {}).get('language'),
+                    'default': bool(stream.get('disposition', {}).get('default'))
+                }
+                for stream in audio_streams
+            ]
+        }
+    
+    def _parse_frame_rate(self, frame_rate: str) -> float:
+        """Переводит частоту кадров ffprobe (например, 30000/1001) в число"""
+        try:
+            return float(Fraction(frame_rate))
+        except (ValueError, ZeroDivisionError):
+            return 30.0
+    
+    def get_display_size(self, video_info: dict) -> Tuple[int, int]:
+        """
+        Размер кадра с учётом поворота: FFmpeg при декодировании
+        сам разворачивает кадры, поэтому при 90/270° ширина и высота меняются местами
+        """
+        if video_info.get('rotation') in (90, 270):
+            return video_info['height'], video_info['width']
+        return video_info['width'], video_info['height']
+    
+    def select_audio_stream(self, video_info: dict) -> Optional[dict]:
+        """Выбирает аудиодорожку: помеченную по умолчанию, иначе первую"""
+        audio_streams = video_info.get('audio_streams') or []
+        if not audio_streams:
+            return None
+        
+        selected = next((stream for stream in audio_streams if stream['default']), audio_streams[0])
+        if len(audio_streams) > 1:
+            logger.info(f"Аудиодорожек: {len(audio_streams)}, выбрана #{selected['index']} "
+                        f"({selected['codec']}, язык: {selected['language'] or 'не указан'})")
+        return selected
+    
+    async def check_decodable(self, video_path: Path, video_info: dict) -> bool:
+        """Проверяет, что видеопоток действительно декодируется (первые кадры)"""
+        output = ffmpeg.output(
+            ffmpeg.input(self._input_url(video_path))[str(video_info['video_index'])],
+            '-',
+            format='null',
+            vframes=DECODE_CHECK_FRAMES
+        )
+        with trace_span('decode_check'):
+            success, error_msg = await self._run_ffmpeg(output, track_speed=False,
+                                                        input_data=self._memory_inputs.get(video_path))
+        if not success:
+            logger.error(f"Видео не декодируется: {error_msg}")
+        return success
     
     async def get_video_info(self, video_path: Path) -> dict:
-        """Получает информацию о видео"""
+        """Получает информацию о видео (результат ffprobe кэшируется)"""
         try:
-            probe = ffmpeg.probe(str(video_path))
-            video_info = next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+            cache_key = self._input_key(video_path)
             
-            return {
-                'width': int(video_info['width']),
-                'height': int(video_info['height']),
-                'duration': float(video_info.get('duration', 0)),
-                'codec': video_info['codec_name'],
-                'fps': eval(video_info.get('r_frame_rate', '30/1'))
-            }
+            if cache_key in self._probe_cache:
+                self._probe_cache.move_to_end(cache_key)
+                return dict(self._probe_cache[cache_key])
+            
+            probe_task = self._probe_tasks.get(cache_key)
+            if probe_task is None:
+                probe_task = asyncio.ensure_future(self._run_ffprobe(video_path))
+                probe_task.add_done_callback(lambda _: self._probe_tasks.pop(cache_key, None))
+                self._probe_tasks[cache_key] = probe_task
+            probe = await asyncio.shield(probe_task)
+            
+            video_info = self._parse_probe(probe)
+            self._probe_cache[cache_key] = video_info
+            while len(self._probe_cache) > settings.probe_cache_size:
+                self._probe_cache.popitem(last=False)
+            
+            return dict(video_info)
         except Exception as e:
             logger.error(f"Ошибка получения информации о видео: {e}")
             raise
@@ -128,15 +337,15 @@ class VideoProcessor:
     
     async def compress_and_resize_video(self, input_path: Path, output_path: Path,
                                       target_width: Optional[int] = None, 
-                                      target_height: Optional[int] = None) -> dict:
+                                      target_height: Optional[int] = None,
+                                      on_progress: Optional[Callable[[dict], None]] = None) -> dict:
         """
         Сжимает видео без потери качества и применяет случайные рамки
         """
         try:
             # Получаем информацию о исходном видео
             video_info = await self.get_video_info(input_path)
-            original_width = video_info['width']
-            original_height = video_info['height']
+            original_width, original_height = self.get_display_size(video_info)
             
             # Если размеры не указаны, используем финальный размер Stories
             if not target_width or not target_height:
@@ -154,12 +363,15 @@ class VideoProcessor:
             logger.info(f"Обработка видео: {original_width}x{original_height} -> {target_width}x{target_height}")
             logger.info(f"Толщина рамки: {frame_thickness_info['name']} ({frame_thickness_info['description']})")
             
+            preset = self.choose_preset(video_info)
+            
             # Создаем FFmpeg pipeline
-            input_stream = ffmpeg.input(str(input_path))
+            input_stream = ffmpeg.input(self._input_url(input_path))
             
-            # Берём только видео поток
-            video_stream = input_stream['v']
-            audio_stream = input_stream['a']
+            # Потоки выбираем по данным ffprobe
+            video_stream = input_stream[str(video_info['video_index'])]
+            selected_audio = self.select_audio_stream(video_info)
+            audio_stream = input_stream[str(selected_audio['index'])] if selected_audio else None
             
             # Масштабируем видео
             scaled = ffmpeg.filter(video_stream, 'scale', 
@@ -175,14 +387,13 @@ class VideoProcessor:
                                  color=frame_color)
             
             # Сбалансированное качество - хорошее качество с разумным размером
-            try:
-                # Пытаемся с аудио
+            if audio_stream is not None:
                 output = ffmpeg.output(
                     padded, audio_stream,
                     str(output_path),
                     vcodec='libx264',
                     crf=23,  # Хорошее качество с разумным размером
-                    preset='medium',  # Баланс скорости и качества
+                    preset=preset,  # Баланс скорости и качества под текущую нагрузку
                     acodec='aac',  # Кодек для аудио
                     audio_bitrate='128k',  # Качественное аудио
                     pix_fmt='yuv420p',  # Совместимость с большинством плееров
@@ -192,14 +403,14 @@ class VideoProcessor:
                     maxrate='2000k',  # Максимальный битрейт
                     bufsize='4000k'   # Размер буфера
                 )
-            except:
-                # Если ошибка с аудио, то только видео
+            else:
+                # В исходнике нет звука - только видео
                 output = ffmpeg.output(
                     padded,
                     str(output_path),
                     vcodec='libx264',
                     crf=23,
-                    preset='medium',
+                    preset=preset,
                     pix_fmt='yuv420p',
                     movflags='faststart',
                     tune='film',
@@ -208,24 +419,19 @@ class VideoProcessor:
                     bufsize='4000k'
                 )
             
-            # Запускаем обработку
-            process = await asyncio.create_subprocess_exec(
-                *ffmpeg.compile(output, overwrite_output=True),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            # Запускаем обработку и ждём завершения процесса
+            success, error_msg = await self._run_ffmpeg(output, on_progress=on_progress,
+                                                        input_data=self._memory_inputs.get(input_path))
             
-            # Ждём завершения процесса
-            stdout, stderr = await process.communicate()
-            
-            if process.returncode != 0:
-                error_msg = stderr.decode() if stderr else "Неизвестная ошибка FFmpeg"
+            if not success:
                 logger.error(f"FFmpeg завершился с ошибкой: {error_msg}")
                 return False
             
+            janitor.track(output_path)
             logger.info(f"Видео успешно обработано: {output_path}")
             return {
                 'success': True, 
+                'preset': preset,
                 'frame_color': frame_color,
                 'frame_thickness': frame_thickness_info['name'],
                 'frame_thickness_px': frame_thickness_info['pixels']
@@ -233,178 +439,842 @@ class VideoProcessor:
             
         except Exception as e:
             logger.error(f"Ошибка при обработке видео: {e}")
-            return {'success': False, 'frame_color': None, 'frame_thickness': None, 'frame_thickness_px': None}
+            return {'success': False, 'preset': None, 'frame_color': None, 'frame_thickness': None, 'frame_thickness_px': None}
     
-    async def create_multiple_variants(self, input_path: Path, output_dir: Path, count: int = 3) -> list:
-        """Создает несколько вариантов видео с разным качеством/размером"""
+    # Настройки качества для разных вариантов
+    QUALITY_SETTINGS = [
+        {"name": "Максимальное", "crf": 18, "bitrate": "2000k", "maxrate": "2500k"},
+        {"name": "Высокое", "crf": 21, "bitrate": "1500k", "maxrate": "2000k"},
+        {"name": "Среднее", "crf": 23, "bitrate": "1200k", "maxrate": "1500k"},
+        {"name": "Компактное", "crf": 25, "bitrate": "900k", "maxrate": "1200k"},
+        {"name": "Минимальное", "crf": 28, "bitrate": "600k", "maxrate": "800k"},
+        {"name": "Ультра-компактное", "crf": 30, "bitrate": "400k", "maxrate": "500k"}
+    ]
+    
+    def get_quality_ladder(self, count: int) -> List[dict]:
+        """Возвращает настройки качества для первых count вариантов"""
+        return self.QUALITY_SETTINGS[:min(count, len(self.QUALITY_SETTINGS))]
+    
+    def predict_variant_size_mb(self, quality: dict, video_info: dict) -> float:
+        """
+        Прогнозирует размер варианта: битрейт по CRF (±6 CRF ≈ ×2 от битрейта источника),
+        ограниченный maxrate, плюс аудио и накладные расходы контейнера
+        """
+        maxrate_kbps = int(quality['maxrate'][:-1])
+        audio_kbps = AUDIO_BITRATE_KBPS if video_info.get('has_audio', True) else 0
         
-        # Настройки качества для разных вариантов
-        quality_settings = [
-            {"name": "Максимальное", "crf": 18, "bitrate": "2000k", "maxrate": "2500k"},
-            {"name": "Высокое", "crf": 21, "bitrate": "1500k", "maxrate": "2000k"},
-            {"name": "Среднее", "crf": 23, "bitrate": "1200k", "maxrate": "1500k"},
-            {"name": "Компактное", "crf": 25, "bitrate": "900k", "maxrate": "1200k"},
-            {"name": "Минимальное", "crf": 28, "bitrate": "600k", "maxrate": "800k"},
-            {"name": "Ультра-компактное", "crf": 30, "bitrate": "400k", "maxrate": "500k"}
-        ]
+        source_kbps = video_info.get('bitrate', 0) / 1000 - audio_kbps
+        if source_kbps > 0:
+            video_kbps = min(maxrate_kbps, source_kbps * 2 ** ((REFERENCE_CRF - quality['crf']) / 6))
+        else:
+            # Битрейт источника неизвестен - считаем по верхней границе
+            video_kbps = maxrate_kbps
         
-        # Ограничиваем количество вариантов
-        count = min(count, len(quality_settings))
-        selected_settings = quality_settings[:count]
+        size_bytes = video_info['duration'] * (video_kbps + audio_kbps) * 1000 / 8
+        return (size_bytes + CONTAINER_OVERHEAD_BYTES) / (1024 * 1024)
+    
+    def plan_ladder(self, video_info: dict, count: int) -> dict:
+        """
+        Отбирает ступени лестницы качества по прогнозу размера: пропускает те,
+        что не пройдут по лимиту отправки, и те, что почти совпадут с уже выбранными
+        """
+        ladder = self.get_quality_ladder(count)
+        if not settings.adaptive_ladder:
+            return {'rungs': ladder, 'dropped': []}
+        
+        rungs = []
+        dropped = []
+        kept_sizes = []
+        for quality in ladder:
+            predicted_mb = self.predict_variant_size_mb(quality, video_info)
+            
+            if predicted_mb > settings.upload_limit_mb:
+                dropped.append({'name': quality['name'], 'predicted_mb': predicted_mb,
+                                'reason': f"прогноз {predicted_mb:.1f}MB больше лимита {settings.upload_limit_mb}MB"})
+                continue
+            
+            similar_mb = next(
+                (size for size in kept_sizes
+                 if abs(size - predicted_mb) <= size * settings.ladder_similarity_percent / 100),
+                None
+            )
+            if similar_mb is not None:
+                dropped.append({'name': quality['name'], 'predicted_mb': predicted_mb,
+                                'reason': f"почти совпадает с другим вариантом ({predicted_mb:.1f}MB ≈ {similar_mb:.1f}MB)"})
+                continue
+            
+            rungs.append(quality)
+            kept_sizes.append(predicted_mb)
+        
+        if not rungs and ladder:
+            # Прогноз грубый: самую компактную ступень всё равно пробуем
+            rungs.append(ladder[-1])
+            dropped = [item for item in dropped if item['name'] != ladder[-1]['name']]
+        
+        for item in dropped:
+            logger.info(f"Вариант «{item['name']}» пропущен: {item['reason']}")
+        return {'rungs': rungs, 'dropped': dropped}
+    
+    def choose_preset(self, video_info: dict, variants: int = 1, queue_depth: int = 0) -> str:
+        """
+        Выбирает пресет x264 под текущую нагрузку: самый медленный (качественный) пресет,
+        при котором задача с учётом очереди укладывается в latency_slo_seconds
+        """
+        if settings.preset_policy != "adaptive":
+            return settings.x264_preset
         
-        results = []
+        frames = video_info['duration'] * (video_info.get('fps') or 30)
+        encode_pixels = frames * 1080 * 1920 * max(1, variants)
+        decode_passes = 1 if settings.encode_engine == "single_pass" else max(1, variants)
+        decode_pixels = frames * video_info['width'] * video_info['height'] * decode_passes
         
-        for i, settings in enumerate(selected_settings):
-            output_path = output_dir / f"variant_{i+1}_{settings['name'].lower()}.mp4"
+        cores_per_job = max(1, (os.cpu_count() or 1) // max(1, settings.encode_workers))
+        throughput = MEDIUM_PIXELS_PER_CORE_SECOND * cores_per_job
+        # Задачи впереди в очереди делят тех же воркеров
+        load_factor = 1 + queue_depth / max(1, settings.encode_workers)
+        
+        for preset, speed in X264_PRESET_SPEED.items():
+            job_seconds = (encode_pixels / speed + decode_pixels * DECODE_COST) / throughput
+            if job_seconds * load_factor <= settings.latency_slo_seconds:
+                break
+        
+        logger.info(f"Выбран пресет x264: {preset} (очередь: {queue_depth}, "
+                    f"прогноз {job_seconds * load_factor:.0f}с при SLO {settings.latency_slo_seconds}с)")
+        return preset
+    
+    def get_thread_budget(self, encoders: int) -> int:
+        """Делит ядра CPU между кодировщиками всех одновременно обрабатываемых задач"""
+        cpu_count = os.cpu_count() or 1
+        total_encoders = max(1, encoders) * max(1, settings.encode_workers)
+        return max(1, cpu_count // total_encoders)
+    
+    def _plan_variants(self, input_path: Path, video_info: dict, output_dir: Path,
+                       ladder: List[dict], preset: str) -> List[dict]:
+        """Подбирает параметры (рамка, цвет, качество) для каждого варианта"""
+        
+        # Всегда 1080x1920 финальный размер
+        target_width, target_height = 1080, 1920
+        
+        # Поворот учитываем до расчёта масштаба
+        display_width, display_height = self.get_display_size(video_info)
+        
+        plans = []
+        for i, quality in enumerate(ladder):
+            # Получаем уникальную толщину рамки для каждого варианта
+            frame_thickness_info = self.get_random_frame_thickness()
             
+            # Вычисляем параметры изменения размера с учетом рамки
+            resize_params = self.calculate_resize_params(
+                display_width, display_height,
+                target_width, target_height, frame_thickness_info['pixels']
+            )
+            
+            plans.append({
+                'index': i,
+                'count': len(ladder),
+                'settings': quality,
+                # Префикс входного файла разводит варианты одновременных задач
+                'output_path': output_dir / f"{input_path.stem}_variant_{i+1}.mp4",
+                'thumbnail_path': output_dir / f"{input_path.stem}_variant_{i+1}_thumb.jpg",
+                'thumbnail_offset': self.get_thumbnail_offset(video_info),
+                'video_index': video_info['video_index'],
+                'target_width': target_width,
+                'target_height': target_height,
+                'resize_params': resize_params,
+                'frame_color': self.get_random_frame_color(),
+                'frame_thickness_info': frame_thickness_info,
+                'preset': preset,
+                'threads': 0
+            })
+        
+        return plans
+    
+    def _build_variant_video(self, video_stream, plan: dict):
+        """Масштабирует поток и добавляет цветную рамку варианта"""
+        resize_params = plan['resize_params']
+        
+        scaled = ffmpeg.filter(video_stream, 'scale',
+                             resize_params['scale_width'],
+                             resize_params['scale_height'])
+        
+        # Добавляем цветные рамки до финального размера 1080x1920
+        return ffmpeg.filter(scaled, 'pad',
+                           plan['target_width'], plan['target_height'],
+                           resize_params['pad_left'],   # Отступ слева (с учетом рамки)
+                           resize_params['pad_top'],    # Отступ сверху (с учетом рамки)
+                           color=plan['frame_color'])
+    
+    def get_thumbnail_offset(self, video_info: dict) -> float:
+        """Момент кадра превью: THUMBNAIL_OFFSET_SECONDS, но не дальше середины видео"""
+        return min(THUMBNAIL_OFFSET_SECONDS, (video_info.get('duration') or 0) / 2)
+    
+    def _build_thumbnail_output(self, video_stream, output_path: Path):
+        """Создает выход превью: один JPEG-кадр, вписанный в THUMBNAIL_MAX_SIDE"""
+        scaled = ffmpeg.filter(video_stream, 'scale', THUMBNAIL_MAX_SIDE, THUMBNAIL_MAX_SIDE,
+                               force_original_aspect_ratio='decrease').filter('setsar', 1)
+        return ffmpeg.output(scaled, str(output_path),
+                             vframes=1, format='image2', vcodec='mjpeg', **{'q:v': 3})
+    
+    def _video_codec_kwargs(self, plan: dict) -> dict:
+        """Параметры x264 варианта (одинаковые для целого файла и для каждого его куска)"""
+        quality = plan['settings']
+        return {
+            'vcodec': 'libx264',
+            'crf': quality['crf'],
+            'preset': plan['preset'],
+            'pix_fmt': 'yuv420p',
+            'tune': 'film',
+            'b:v': quality['bitrate'],
+            'maxrate': quality['maxrate'],
+            'bufsize': f"{int(quality['maxrate'][:-1]) * 2}k",
+            'threads': plan['threads']
+        }
+    
+    def _build_variant_output(self, video_stream, audio_stream, plan: dict):
+        """
+        Создает выходы варианта с его настройками качества.
+        Кадр превью снимается веткой select с того же декодированного потока,
+        поэтому отдельный проход декодирования для превью не нужен
+        """
+        output_kwargs = {**self._video_codec_kwargs(plan), 'movflags': 'faststart'}
+        
+        framed = self._build_variant_video(video_stream, plan).filter_multi_output('split', 2)
+        
+        streams = [framed.stream(0)]
+        if audio_stream is not None:
+            # Дорожка уже подготовлена аудио-этапом задачи - только копируем
+            streams.append(audio_stream)
+            output_kwargs['acodec'] = 'copy'
+        
+        thumbnail_stream = framed.stream(1)
+        offset = plan['thumbnail_offset']
+        if offset > 0:
+            # floor(t/offset) равно нулю до нужного момента - select пропускает эти кадры
+            # (выражение без запятой, которую пришлось бы экранировать в filter_complex)
+            thumbnail_stream = thumbnail_stream.filter('select', f"floor(t/{offset:g})")
+        
+        return ffmpeg.merge_outputs(
+            ffmpeg.output(*streams, str(plan['output_path']), **output_kwargs),
+            self._build_thumbnail_output(thumbnail_stream, plan['thumbnail_path'])
+        )
+    
+    def _parse_progress(self, fields: dict) -> dict:
+        """Разбирает блок -progress FFmpeg (out_time_us, speed, fps)"""
+        # out_time_ms у FFmpeg исторически тоже в микросекундах
+        out_time_us = fields.get('out_time_us') or fields.get('out_time_ms') or '0'
+        snapshot = {'out_time': 0.0, 'speed': 0.0, 'fps': 0.0,
+                    'done': fields.get('progress') == 'end'}
+        try:
+            snapshot['out_time'] = max(0.0, int(out_time_us) / 1_000_000)
+        except ValueError:
+            pass
+        try:
+            snapshot['speed'] = float(fields.get('speed', '0').rstrip('x'))
+        except ValueError:
+            pass
+        try:
+            snapshot['fps'] = float(fields.get('fps', '0'))
+        except ValueError:
+            pass
+        return snapshot
+    
+    async def _run_ffmpeg(self, output,
+                          on_progress: Optional[Callable[[dict], None]] = None,
+                          track_speed: bool = True,
+                          input_data: Optional[bytes] = None) -> Tuple[bool, str]:
+        """
+        Запускает FFmpeg под надзором супервизора и разбирает его прогресс по мере кодирования.
+        Процесс убивается при превышении ffmpeg_timeout, при отсутствии прогресса
+        дольше ffmpeg_stall_timeout и при отмене задачи.
+        track_speed=False - служебный запуск (аудио, проверка, превью), не попадает в метрики скорости;
+        input_data - содержимое входа pipe:0, пишется FFmpeg в stdin
+        """
+        output = output.global_args('-progress', 'pipe:1', '-nostats')
+        args = ffmpeg.compile(output, overwrite_output=True)
+        annotate_span(ffmpeg_args=args)
+        try:
+            process = await process_supervisor.spawn(
+                *args,
+                stdin=asyncio.subprocess.PIPE if input_data is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+        except OSError:
+            FFMPEG_FAILURES.inc(reason='spawn')
+            raise
+        
+        # stderr читаем параллельно, чтобы FFmpeg не заблокировался на полном буфере
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        
+        async def feed_input():
             try:
-                logger.info(f"Создаю вариант {i+1}/{count}: {settings['name']}")
-                
-                # Получаем информацию о видео
-                video_info = await self.get_video_info(input_path)
-                original_width = video_info['width']
-                original_height = video_info['height']
-                
-                # Всегда 1080x1920 финальный размер
-                target_width, target_height = 1080, 1920
+                process.stdin.write(input_data)
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # FFmpeg прочитал сколько нужно (например, vframes) и закрыл вход
+                pass
+            finally:
+                process.stdin.close()
+        
+        stdin_task = asyncio.ensure_future(feed_input()) if input_data is not None else None
+        
+        state = {'snapshot': {}, 'position': None, 'last_activity': time.monotonic()}
+        
+        async def read_progress():
+            fields = {}
+            async for raw_line in process.stdout:
+                key, _, value = raw_line.decode('utf-8', errors='ignore').strip().partition('=')
+                fields[key] = value
+                if key != 'progress':
+                    continue
                 
-                # Получаем уникальную толщину рамки для каждого варианта
-                frame_thickness_info = self.get_random_frame_thickness()
-                frame_thickness = frame_thickness_info['pixels']
+                # Строка progress=continue|end завершает очередной блок
+                snapshot = self._parse_progress(fields)
+                position = (fields.get('frame'), snapshot['out_time'])
+                fields = {}
+                state['snapshot'] = snapshot
+                if position != state['position']:
+                    state['position'] = position
+                    state['last_activity'] = time.monotonic()
                 
-                # Вычисляем параметры изменения размера с учетом рамки
-                resize_params = self.calculate_resize_params(
-                    original_width, original_height, target_width, target_height, frame_thickness
+                if on_progress:
+                    try:
+                        on_progress(snapshot)
+                    except Exception as e:
+                        logger.warning(f"Ошибка обработчика прогресса: {e}")
+        
+        try:
+            stop_reason = await process_supervisor.supervise(
+                process,
+                read_progress(),
+                last_activity=lambda: state['last_activity'],
+                wall_timeout=settings.ffmpeg_timeout,
+                stall_timeout=settings.ffmpeg_stall_timeout
+            )
+        except asyncio.CancelledError:
+            stderr_task.cancel()
+            if stdin_task is not None:
+                stdin_task.cancel()
+            raise
+        
+        if stdin_task is not None:
+            await asyncio.gather(stdin_task, return_exceptions=True)
+        stderr = await stderr_task
+        await process.wait()
+        
+        annotate_span(returncode=process.returncode, stop_reason=stop_reason,
+                      speed=state['snapshot'].get('speed'), fps=state['snapshot'].get('fps'))
+        if stop_reason:
+            FFMPEG_FAILURES.inc(reason=stop_reason)
+        if stop_reason == 'timeout':
+            return False, f"Превышен таймаут FFmpeg ({settings.ffmpeg_timeout}с)"
+        if stop_reason == 'stall':
+            return False, f"FFmpeg не сообщал о прогрессе {settings.ffmpeg_stall_timeout}с"
+        if process.returncode != 0:
+            FFMPEG_FAILURES.inc(reason='exit')
+            return False, stderr.decode() if stderr else "Неизвестная ошибка FFmpeg"
+        
+        snapshot = state['snapshot']
+        if not track_speed:
+            return True, ""
+        if snapshot.get('speed'):
+            ENCODE_SPEED.observe(snapshot['speed'])
+        if snapshot.get('fps'):
+            ENCODE_FPS.observe(snapshot['fps'])
+        return True, ""
+    
+    def _collect_variant_result(self, plan: dict) -> Optional[dict]:
+        """Собирает информацию о созданном файле варианта"""
+        output_path = plan['output_path']
+        if not output_path.exists():
+            return None
+        
+        frame_thickness_info = plan['frame_thickness_info']
+        file_size = output_path.stat().st_size / (1024 * 1024)
+        logger.info(f"Вариант {plan['index']+1} готов: {file_size:.1f}MB, рамка: {frame_thickness_info['name']}")
+        
+        thumbnail_path = plan['thumbnail_path']
+        janitor.track(output_path, thumbnail_path)
+        if not thumbnail_path.exists():
+            # Без превью вариант всё равно отправляется, Telegram сделает его сам
+            logger.warning(f"Превью варианта {plan['index']+1} не создано")
+            thumbnail_path = None
+        
+        return {
+            'path': output_path,
+            'thumbnail': thumbnail_path,
+            'index': plan['index'],
+            'count': plan['count'],
+            'name': plan['settings']['name'],
+            'size_mb': file_size,
+            'quality': plan['settings']['crf'],
+            'preset': plan['preset'],
+            'frame_color': plan['frame_color'],
+            'frame_thickness': frame_thickness_info['name'],
+            'frame_thickness_px': frame_thickness_info['pixels']
+        }
+    
+    async def _encode_variant(self, input_path: Path, plan: dict, audio_path: Optional[Path],
+                              on_progress: Optional[Callable[[int, dict], None]] = None) -> Optional[dict]:
+        """Кодирует один вариант отдельным процессом FFmpeg"""
+        i = plan['index']
+        try:
+            logger.info(f"Создаю вариант {i+1}/{plan['count']}: {plan['settings']['name']}")
+            
+            video_stream = ffmpeg.input(self._input_url(input_path))[str(plan['video_index'])]
+            audio_stream = ffmpeg.input(str(audio_path))['a'] if audio_path else None
+            output = self._build_variant_output(video_stream, audio_stream, plan)
+            
+            started_at = time.monotonic()
+            with trace_span('encode', variant=i + 1, rung=plan['settings']['name'],
+                            preset=plan['preset'], threads=plan['threads']) as span:
+                success, error_msg = await self._run_ffmpeg(
+                    output,
+                    on_progress=(lambda snapshot: on_progress(i, snapshot)) if on_progress else None,
+                    input_data=self._memory_inputs.get(input_path)
                 )
+                if not success:
+                    logger.error(f"FFmpeg завершился с ошибкой для варианта {i+1}: {error_msg}")
+                    return None
+                ENCODE_SECONDS.observe(time.monotonic() - started_at)
                 
-                # Создаем FFmpeg pipeline
-                input_stream = ffmpeg.input(str(input_path))
-                video_stream = input_stream['v']
+                result = self._collect_variant_result(plan)
+                span['output_bytes'] = plan['output_path'].stat().st_size if result else None
+                return result
+            
+        except Exception as e:
+            logger.error(f"Ошибка создания варианта {i+1}: {e}")
+            return None
+    
+    async def _encode_variants_single_pass(self, input_path: Path, plans: List[dict], audio_path: Optional[Path],
+                                           on_progress: Optional[Callable[[int, dict], None]] = None) -> List[dict]:
+        """
+        Кодирует все варианты одним процессом FFmpeg: вход декодируется один раз,
+        поток делится через split на ветки со своими рамками и качеством,
+        а подготовленная аудиодорожка копируется в каждый выход
+        """
+        try:
+            logger.info(f"Создаю {len(plans)} вариантов за один проход декодирования")
+            
+            input_stream = ffmpeg.input(self._input_url(input_path))
+            video_stream = input_stream[str(plans[0]['video_index'])]
+            video_branches = video_stream.filter_multi_output('split', len(plans))
+            audio_stream = ffmpeg.input(str(audio_path))['a'] if audio_path else None
+            
+            outputs = [
+                self._build_variant_output(video_branches.stream(plan['index']), audio_stream, plan)
+                for plan in plans
+            ]
+            
+            def report_progress(snapshot: dict):
+                # Все варианты кодируются одним процессом и продвигаются вместе
+                for plan in plans:
+                    on_progress(plan['index'], snapshot)
+            
+            started_at = time.monotonic()
+            with trace_span('encode', variants=[plan['index'] + 1 for plan in plans], engine='single_pass',
+                            preset=plans[0]['preset'], threads=plans[0]['threads']) as span:
+                success, error_msg = await self._run_ffmpeg(
+                    ffmpeg.merge_outputs(*outputs),
+                    on_progress=report_progress if on_progress else None,
+                    input_data=self._memory_inputs.get(input_path)
+                )
+                if not success:
+                    logger.error(f"FFmpeg завершился с ошибкой при однопроходном кодировании: {error_msg}")
+                    return []
+                # Варианты готовы одновременно - у каждого время всего прохода
+                elapsed = time.monotonic() - started_at
+                for _ in plans:
+                    ENCODE_SECONDS.observe(elapsed)
                 
+                results = []
+                for plan in plans:
+                    result = self._collect_variant_result(plan)
+                    if result:
+                        results.append(result)
+                span['output_bytes'] = [result['path'].stat().st_size for result in results]
+                return results
+            
+        except Exception as e:
+            logger.error(f"Ошибка однопроходного создания вариантов: {e}")
+            return []
+    
+    def should_segment(self, video_info: dict) -> bool:
+        """Длинное видео кодируется кусками параллельно (см. segment_min_duration)"""
+        return bool(settings.segment_min_duration) and video_info['duration'] >= settings.segment_min_duration
+    
+    def get_segment_count(self, video_info: dict) -> int:
+        """На сколько кусков резать видео: segment_count или число ядер, но куски не короче SEGMENT_MIN_SECONDS"""
+        count = settings.segment_count or os.cpu_count() or 1
+        return max(1, min(count, int(video_info['duration'] // SEGMENT_MIN_SECONDS)))
+    
+    def get_segment_parallel(self, segments: int) -> int:
+        """Сколько кусков одного варианта кодируется одновременно"""
+        return max(1, min(segments, os.cpu_count() or 1))
+    
+    async def split_segments(self, input_path: Path, video_info: dict, output_dir: Path) -> List[dict]:
+        """
+        Режет видеопоток на куски по ключевым кадрам без перекодирования (segment muxer).
+        Каждый кусок начинается с ключевого кадра, поэтому кодируется независимо от остальных.
+        Возвращает куски [{path, start, end}] по порядку; пустой список - резать не вышло
+        """
+        count = self.get_segment_count(video_info)
+        if count < 2:
+            return []
+        
+        duration = video_info['duration']
+        # Границы - желаемые моменты, муксер режет по первому ключевому кадру после каждого
+        segment_times = ','.join(f"{duration * k / count:.3f}" for k in range(1, count))
+        # Matroska принимает любой кодек; поворот надёжнее переносит MOV (матрица дорожки)
+        container = 'mov' if video_info['rotation'] else 'mkv'
+        # В имени шаблона segment muxer '%' - спецсимвол
+        pattern = output_dir / f"{input_path.stem.replace('%', '%%')}_segment_%03d.{container}"
+        list_path = output_dir / f"{input_path.stem}_segments.csv"
+        output = ffmpeg.output(
+            ffmpeg.input(self._input_url(input_path))[str(video_info['video_index'])],
+            str(pattern),
+            c='copy',
+            f='segment',
+            segment_times=segment_times,
+            reset_timestamps=1,
+            segment_list=str(list_path),
+            segment_list_type='csv'
+        )
+        with trace_span('split', segments=count) as span:
+            success, error_msg = await self._run_ffmpeg(output, track_speed=False,
+                                                        input_data=self._memory_inputs.get(input_path))
+            segments = []
+            if success and list_path.exists():
+                with open(list_path, newline='', encoding='utf-8') as list_file:
+                    for name, start, end in csv.reader(list_file):
+                        segments.append({'path': output_dir / name, 'start': float(start), 'end': float(end)})
+            span['segments'] = len(segments)
+        await self.cleanup_temp_files(list_path)
+        janitor.track(*(segment['path'] for segment in segments))
+        
+        if not success:
+            logger.error(f"Ошибка нарезки видео на куски: {error_msg}")
+            return []
+        problem = self._check_segments(segments, video_info)
+        if problem:
+            logger.warning(f"Сегментное кодирование отменено: {problem}")
+            await self.cleanup_temp_files(*(segment['path'] for segment in segments))
+            return []
+        
+        logger.info(f"Видео разрезано на {len(segments)} кусков по ключевым кадрам: " +
+                    ", ".join(f"{segment['end'] - segment['start']:.1f}с" for segment in segments))
+        return segments
+    
+    def _sync_tolerance(self, video_info: dict) -> float:
+        """Допустимое расхождение времени: SEGMENT_SYNC_TOLERANCE, но не меньше двух кадров"""
+        return max(SEGMENT_SYNC_TOLERANCE, 2 / (video_info.get('fps') or 30.0))
+    
+    def _check_segments(self, segments: List[dict], video_info: dict) -> Optional[str]:
+        """Проверяет, что куски идут встык и покрывают всё видео; возвращает описание проблемы"""
+        if len(segments) < 2:
+            return "в видео слишком мало ключевых кадров"
+        tolerance = self._sync_tolerance(video_info)
+        if segments[0]['start'] > tolerance:
+            return f"первый кусок начинается с {segments[0]['start']:.2f}с"
+        for previous, segment in zip(segments, segments[1:]):
+            if abs(segment['start'] - previous['end']) > tolerance:
+                return f"разрыв между кусками: {previous['end']:.2f}с -> {segment['start']:.2f}с"
+        if abs(segments[-1]['end'] - video_info['duration']) > tolerance:
+            return f"куски покрывают {segments[-1]['end']:.2f}с из {video_info['duration']:.2f}с"
+        return None
+    
+    async def _check_sync(self, output_path: Path, video_info: dict) -> Optional[str]:
+        """
+        Проверяет склеенный вариант: длительность видео совпадает с исходником
+        (на стыках не потеряны и не задвоены кадры), а видео и звук начинаются одновременно
+        """
+        probe = await self._run_ffprobe(output_path)
+        streams = {stream['codec_type']: stream for stream in reversed(probe['streams'])}
+        video = streams.get('video')
+        if video is None:
+            return "в результате нет видеопотока"
+        tolerance = self._sync_tolerance(video_info)
+        video_duration = float(video.get('duration') or 0)
+        if abs(video_duration - video_info['duration']) > tolerance:
+            return f"длительность видео {video_duration:.2f}с вместо {video_info['duration']:.2f}с"
+        audio = streams.get('audio')
+        if audio is not None:
+            offset = float(video.get('start_time') or 0) - float(audio.get('start_time') or 0)
+            if abs(offset) > tolerance:
+                return f"звук смещён относительно видео на {offset:.2f}с"
+        return None
+    
+    async def _encode_segment(self, segment: dict, plan: dict, part_path: Path,
+                              on_progress: Optional[Callable[[dict], None]] = None) -> bool:
+        """Кодирует один кусок с параметрами варианта (рамка, масштаб, x264 - как у целого файла)"""
+        output = ffmpeg.output(
+            self._build_variant_video(ffmpeg.input(str(segment['path']))['v'], plan),
+            str(part_path),
+            **self._video_codec_kwargs(plan)
+        )
+        success, error_msg = await self._run_ffmpeg(output, on_progress=on_progress)
+        if not success:
+            logger.error(f"FFmpeg завершился с ошибкой для куска {part_path.name}: {error_msg}")
+        return success
+    
+    async def _encode_variant_segmented(self, plan: dict, segments: List[dict], audio_path: Optional[Path],
+                                        video_info: dict, parallel: int,
+                                        on_progress: Optional[Callable[[int, dict], None]] = None) -> Optional[dict]:
+        """
+        Кодирует вариант по кускам: до parallel процессов FFmpeg одновременно,
+        затем склеивает куски concat demuxer без перекодирования и добавляет подготовленный звук.
+        None - вариант не получился, его нужно закодировать целиком
+        """
+        i = plan['index']
+        output_path = plan['output_path']
+        parts = [output_path.with_name(f"{output_path.stem}_part_{k:03d}.mkv") for k in range(len(segments))]
+        concat_path = output_path.with_name(f"{output_path.stem}_concat.txt")
+        
+        # Прогресс варианта - сумма прогресса кусков
+        out_times = [0.0] * len(segments)
+        speeds = [0.0] * len(segments)
+        
+        def report_progress(k: int, snapshot: dict):
+            out_times[k] = min(snapshot['out_time'], segments[k]['end'] - segments[k]['start'])
+            speeds[k] = 0.0 if snapshot['done'] else snapshot['speed']
+            on_progress(i, {'out_time': sum(out_times), 'speed': sum(speeds), 'fps': 0.0, 'done': False})
+        
+        semaphore = asyncio.Semaphore(parallel)
+        
+        async def encode_limited(k: int) -> bool:
+            async with semaphore:
+                return await self._encode_segment(
+                    segments[k], plan, parts[k],
+                    on_progress=(lambda snapshot: report_progress(k, snapshot)) if on_progress else None
+                )
+        
+        logger.info(f"Создаю вариант {i+1}/{plan['count']}: {plan['settings']['name']} "
+                    f"({len(segments)} кусков, {parallel} одновременно)")
+        started_at = time.monotonic()
+        try:
+            with trace_span('encode', variant=i + 1, rung=plan['settings']['name'], engine='segmented',
+                            segments=len(segments), parallel=parallel,
+                            preset=plan['preset'], threads=plan['threads']) as span:
+                tasks = [asyncio.ensure_future(encode_limited(k)) for k in range(len(segments))]
                 try:
-                    audio_stream = input_stream['a']
-                    has_audio = True
-                except:
-                    has_audio = False
-                
-                # Масштабируем видео
-                scaled = ffmpeg.filter(video_stream, 'scale', 
-                                     resize_params['scale_width'], 
-                                     resize_params['scale_height'])
-                
-                # Добавляем цветные рамки до финального размера 1080x1920
-                frame_color = self.get_random_frame_color()
-                padded = ffmpeg.filter(scaled, 'pad',
-                                     target_width, target_height,  # Финальный размер всегда 1080x1920
-                                     resize_params['pad_left'],   # Отступ слева (с учетом рамки)
-                                     resize_params['pad_top'],    # Отступ сверху (с учетом рамки)
-                                     color=frame_color)
-                
-                # Создаем выходной поток с настройками качества
-                if has_audio:
-                    output = ffmpeg.output(
-                        padded, audio_stream,
-                        str(output_path),
-                        vcodec='libx264',
-                        crf=settings['crf'],
-                        preset='medium',
-                        acodec='aac',
-                        audio_bitrate='128k',
-                        pix_fmt='yuv420p',
-                        movflags='faststart',
-                        tune='film',
-                        **{'b:v': settings['bitrate']},
-                        maxrate=settings['maxrate'],
-                        bufsize=f"{int(settings['maxrate'][:-1]) * 2}k"
-                    )
-                else:
-                    output = ffmpeg.output(
-                        padded,
-                        str(output_path),
-                        vcodec='libx264',
-                        crf=settings['crf'],
-                        preset='medium',
-                        pix_fmt='yuv420p',
-                        movflags='faststart',
-                        tune='film',
-                        **{'b:v': settings['bitrate']},
-                        maxrate=settings['maxrate'],
-                        bufsize=f"{int(settings['maxrate'][:-1]) * 2}k"
-                    )
+                    encoded = await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                janitor.track(*parts)
+                if not all(encoded):
+                    return None
                 
-                # Запускаем обработку
-                process = await asyncio.create_subprocess_exec(
-                    *ffmpeg.compile(output, overwrite_output=True),
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
+                # Список concat demuxer: кавычки в путях экранируются как '\''
+                concat_path.write_text(
+                    "".join("file '{}'\n".format(str(part.resolve()).replace("'", "'\\''")) for part in parts),
+                    encoding='utf-8'
                 )
+                streams = [ffmpeg.input(str(concat_path), f='concat', safe=0)['v']]
+                if audio_path:
+                    streams.append(ffmpeg.input(str(audio_path))['a'])
+                success, error_msg = await self._run_ffmpeg(
+                    ffmpeg.output(*streams, str(output_path), c='copy', movflags='faststart'),
+                    track_speed=False
+                )
+                if not success:
+                    logger.error(f"Ошибка склейки кусков варианта {i+1}: {error_msg}")
+                    return None
+                janitor.track(output_path)
                 
-                stdout, stderr = await process.communicate()
-                
-                if process.returncode != 0:
-                    error_msg = stderr.decode() if stderr else "Неизвестная ошибка FFmpeg"
-                    logger.error(f"FFmpeg завершился с ошибкой для варианта {i+1}: {error_msg}")
-                    continue
-                
-                # Добавляем информацию о созданном файле
-                if output_path.exists():
-                    file_size = output_path.stat().st_size / (1024 * 1024)
-                    results.append({
-                        'path': output_path,
-                        'name': settings['name'],
-                        'size_mb': file_size,
-                        'quality': settings['crf'],
-                        'frame_color': frame_color,
-                        'frame_thickness': frame_thickness_info['name'],
-                        'frame_thickness_px': frame_thickness_info['pixels']
-                    })
-                    logger.info(f"Вариант {i+1} готов: {file_size:.1f}MB, рамка: {frame_thickness_info['name']}")
+                problem = await self._check_sync(output_path, video_info)
+                span['sync_problem'] = problem
+                if problem:
+                    logger.warning(f"Склеенный вариант {i+1} не прошёл проверку: {problem}")
+                    await self.cleanup_temp_files(output_path)
+                    return None
+                ENCODE_SECONDS.observe(time.monotonic() - started_at)
                 
-            except Exception as e:
-                logger.error(f"Ошибка создания варианта {i+1}: {e}")
-                continue
+                # Превью снимается с готового файла: у кусков нет общего потока для ветки select
+                await self.get_video_thumbnail(output_path, plan['thumbnail_path'], plan['thumbnail_offset'])
+                result = self._collect_variant_result(plan)
+                span['output_bytes'] = output_path.stat().st_size if result else None
+                return result
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка сегментного кодирования варианта {i+1}: {e}")
+            return None
+        finally:
+            await self.cleanup_temp_files(*parts, concat_path)
+    
+    async def prepare_audio(self, input_path: Path, video_info: dict, output_dir: Path) -> Optional[Path]:
+        """
+        Аудио-этап задачи: готовит одну AAC-дорожку для всех вариантов.
+        AAC копируется без перекодирования, остальные кодеки кодируются в AAC 128k.
+        Возвращает None, если в исходнике нет звука; если звук есть, но подготовить его
+        не удалось, выбрасывает RuntimeError - варианты без звука пользователю не нужны
+        """
+        selected_audio = self.select_audio_stream(video_info)
+        if selected_audio is None:
+            logger.info("В видео нет аудиодорожки - варианты будут без звука")
+            return None
+        
+        audio_path = output_dir / f"{input_path.stem}_audio.m4a"
+        audio_codec = selected_audio['codec']
+        if audio_codec == 'aac':
+            codec_kwargs = {'acodec': 'copy'}
+        else:
+            codec_kwargs = {'acodec': 'aac', 'audio_bitrate': f"{AUDIO_BITRATE_KBPS}k"}
+        
+        output = ffmpeg.output(
+            ffmpeg.input(self._input_url(input_path))[str(selected_audio['index'])],
+            str(audio_path),
+            vn=None,
+            **codec_kwargs
+        )
+        with trace_span('audio', codec=audio_codec, copy=audio_codec == 'aac'):
+            success, error_msg = await self._run_ffmpeg(output, track_speed=False,
+                                                        input_data=self._memory_inputs.get(input_path))
+        if not success:
+            logger.error(f"Ошибка подготовки аудиодорожки ({audio_codec}): {error_msg}")
+            await self.cleanup_temp_files(audio_path)
+            raise RuntimeError(f"не удалось подготовить аудиодорожку ({audio_codec})")
         
-        return results
+        janitor.track(audio_path)
+        logger.info(f"Аудиодорожка подготовлена: {audio_codec} -> "
+                    f"{'копирование' if audio_codec == 'aac' else 'AAC'}")
+        return audio_path
+    
+    async def iter_variants(self, input_path: Path, output_dir: Path, count: int = 3,
+                            on_progress: Optional[Callable[[int, dict], None]] = None,
+                            ladder: Optional[List[dict]] = None,
+                            preset: Optional[str] = None,
+                            completed: Optional[Dict[int, dict]] = None,
+                            skip: Optional[Set[int]] = None) -> AsyncIterator[dict]:
+        """
+        Кодирует варианты и отдаёт каждый результат, как только он готов
+        (в порядке лестницы качества), чтобы отправка шла параллельно с кодированием.
+        on_progress(индекс варианта, снимок прогресса) вызывается по ходу кодирования.
+        ladder - заранее отобранные ступени (см. plan_ladder), иначе отбираются здесь;
+        preset - пресет x264 для задачи (см. choose_preset).
+        После перезапуска: completed - уже закодированные варианты (отдаются сразу, без кодирования),
+        skip - индексы уже отправленных вариантов
+        """
+        try:
+            # Получаем информацию о видео
+            video_info = await self.get_video_info(input_path)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки вариантов: {e}")
+            return
+        
+        if ladder is None:
+            ladder = self.plan_ladder(video_info, count)['rungs']
+        if preset is None:
+            preset = self.choose_preset(video_info, len(ladder))
+        plans = self._plan_variants(input_path, video_info, output_dir, ladder, preset)
+        
+        skip = set(skip or ())
+        completed = {index: result for index, result in (completed or {}).items() if index not in skip}
+        for index in sorted(completed):
+            logger.info(f"Вариант {index+1} уже закодирован до перезапуска, кодирование пропущено")
+            yield completed[index]
+        plans = [plan for plan in plans if plan['index'] not in skip and plan['index'] not in completed]
+        if not plans:
+            return
+        
+        # Аудио кодируется один раз на задачу, варианты только копируют дорожку
+        audio_path = await self.prepare_audio(input_path, video_info, output_dir)
+        segments = []
+        
+        try:
+            if self.should_segment(video_info):
+                # Длинное видео: один раз режем на куски, каждый вариант кодируется по кускам параллельно
+                segments = await self.split_segments(input_path, video_info, output_dir)
+            if segments:
+                parallel = self.get_segment_parallel(len(segments))
+                for plan in plans:
+                    plan['threads'] = self.get_thread_budget(parallel)
+                for plan in plans:
+                    result = await self._encode_variant_segmented(plan, segments, audio_path, video_info,
+                                                                  parallel, on_progress)
+                    if result is None:
+                        logger.warning(f"Вариант {plan['index']+1} кодирую целиком")
+                        # Бюджет потоков делился между кусками, а целиком вариант кодируется один
+                        plan['threads'] = self.get_thread_budget(1)
+                        result = await self._encode_variant(input_path, plan, audio_path, on_progress)
+                    if result:
+                        yield result
+                return
+            
+            if settings.encode_engine == "single_pass":
+                # Все кодировщики работают в одном процессе и делят ядра между собой
+                for plan in plans:
+                    plan['threads'] = self.get_thread_budget(len(plans))
+                for result in await self._encode_variants_single_pass(input_path, plans, audio_path, on_progress):
+                    yield result
+                return
+            
+            parallel = max(1, min(settings.max_parallel_encodes, len(plans)))
+            semaphore = asyncio.Semaphore(parallel)
+            
+            async def encode_limited(plan: dict) -> Optional[dict]:
+                async with semaphore:
+                    return await self._encode_variant(input_path, plan, audio_path, on_progress)
+            
+            for plan in plans:
+                plan['threads'] = self.get_thread_budget(parallel)
+            
+            tasks = [asyncio.ensure_future(encode_limited(plan)) for plan in plans]
+            try:
+                for task in tasks:
+                    result = await task
+                    if result:
+                        yield result
+            finally:
+                # Потребитель остановился раньше времени - не кодируем оставшееся
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await self.cleanup_temp_files(*(segment['path'] for segment in segments))
+            if audio_path:
+                await self.cleanup_temp_files(audio_path)
+    
+    async def create_multiple_variants(self, input_path: Path, output_dir: Path, count: int = 3) -> list:
+        """Создает несколько вариантов видео с разным качеством/размером"""
+        return [result async for result in self.iter_variants(input_path, output_dir, count)]
+    
+    def get_job_outputs(self, input_path: Path, output_dir: Path) -> List[Path]:
+        """Находит все файлы вариантов, куски и аудиодорожку задачи, включая недописанные"""
+        if not output_dir.exists():
+            return []
+        prefixes = (f"{input_path.stem}_variant_", f"{input_path.stem}_segment")
+        audio_name = f"{input_path.stem}_audio.m4a"
+        return [path for path in output_dir.iterdir()
+                if path.name.startswith(prefixes) or path.name == audio_name]
     
     async def get_video_thumbnail(self, video_path: Path, output_path: Path, 
-                                time_offset: float = 1.0) -> bool:
-        """Создает превью видео"""
+                                time_offset: float = THUMBNAIL_OFFSET_SECONDS) -> bool:
+        """
+        Создает JPEG-превью готового видео отдельным запуском FFmpeg.
+        Варианты получают превью при кодировании, это - для уже готовых файлов
+        """
         try:
-            (
-                ffmpeg
-                .input(str(video_path), ss=time_offset)
-                .output(str(output_path), vframes=1, format='image2', vcodec='png')
-                .overwrite_output()
-                .run_async()
+            output = self._build_thumbnail_output(
+                ffmpeg.input(str(video_path), ss=time_offset)['v'], output_path
             )
+            success, error_msg = await self._run_ffmpeg(output, track_speed=False)
+            if not success or not output_path.exists():
+                logger.error(f"Ошибка создания превью: {error_msg or 'кадр не получен'}")
+                return False
             return True
         except Exception as e:
             logger.error(f"Ошибка создания превью: {e}")
             return False
     
-    def cleanup_temp_files(self, *file_paths: Path):
-        """Удаляет временные файлы с повторными попытками"""
-        import time
-        
-        for file_path in file_paths:
-            if not file_path.exists():
-                continue
-                
-            # Пытаемся удалить файл несколько раз с задержкой
-            for attempt in range(3):
-                try:
-                    file_path.unlink()
-                    logger.info(f"Удален временный файл: {file_path}")
-                    break
-                except PermissionError:
-                    if attempt < 2:  # Не последняя попытка
-                        logger.info(f"Файл занят, ждём... попытка {attempt + 1}/3")
-                        time.sleep(1)  # Ждём 1 секунду
-                    else:
-                        logger.warning(f"Не удалось удалить файл {file_path} после 3 попыток")
-                except Exception as e:
-                    logger.warning(f"Ошибка удаления файла {file_path}: {e}")
-                    break
+    async def cleanup_temp_files(self, *file_paths: Path):
+        """
+        Удаляет временные файлы с повторными попытками.
+        Удаление идёт вне цикла событий, а ожидание занятого файла не блокирует других пользователей
+        """
+        await janitor.remove_many(file_paths)
 
 
 # Создаем глобальный экземпляр процессора
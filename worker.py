@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+from typing import Dict
+
+from telegram import Message
+from telegram.ext import ContextTypes
+
+from admission import Footprint
+from bot import VideoBot
+from config import settings
+from job_journal import MAX_RESUMES, JournalEntry
+from job_spool import JobSpool, SpoolJob
+from metrics import JOBS_IN_FLIGHT, JOBS_QUEUED
+from scheduler import QueueLimitExceeded
+from tracing import JobTrace
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять из спула старые завершённые задачи, секунды
+SPOOL_PURGE_INTERVAL = 3600.0
+
+
+class SpoolWorker:
+    """
+    Процесс-воркер: забирает задачи из спула и выполняет их тем же конвейером, что и бот -
+    скачивание, кодирование и отправка вариантов прямо в чат пользователя.
+    Одновременно процесс берёт не больше ENCODE_WORKERS задач
+    """
+
+    def __init__(self, bot: VideoBot, spool: JobSpool):
+        self.bot = bot
+        self.spool = spool
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # Задачи спула, взятые этим процессом: номер -> задача
+        self._running: Dict[int, SpoolJob] = {}
+        self._purged_at = 0.0
+
+    def build_message(self, job: SpoolJob) -> Message:
+        """Восстанавливает сообщение пользователя и привязывает его к боту воркера"""
+        return Message.de_json(job.payload['message'], self.bot.application.bot)
+
+    def estimate_footprint(self, job: SpoolJob) -> Footprint:
+        """Оценка ресурсов задачи по данным, которые бот получил от Telegram"""
+        payload = job.payload
+        return self.bot.admission.estimate(payload['file_size'] or 0, payload['width'] or 0,
+                                           payload['height'] or 0, payload['duration'] or 0.0,
+                                           payload['variant_count'])
+
+    async def run_job(self, job: SpoolJob, footprint: Footprint) -> str:
+        """Выполняет задачу спула, отмечает и возвращает её результат"""
+        payload = job.payload
+        message = self.build_message(job)
+        context = ContextTypes.DEFAULT_TYPE(self.bot.application, chat_id=message.chat_id, user_id=job.user_id)
+        trace = JobTrace(job.user_id, file_unique_id=payload['file_unique_id'], filename=payload['filename'],
+                         variant_count=payload['variant_count'], spool_job_id=job.job_id,
+                         parent_trace_id=payload['trace_id'], worker=self.worker_id, attempt=job.attempts,
+                         spool_wait=round(time.time() - job.created_at, 3))
+        # Задачу мог начать воркер, который упал или был остановлен, - продолжаем по его журналу
+        journal = self.bot.journal
+        entry = journal.find_by_spool_job(job.job_id)
+        if entry is not None:
+            if entry.resumes >= MAX_RESUMES:
+                # Видео раз за разом роняет или перезапускает воркеры - не передаём его дальше
+                await self.give_up(job, entry, message, trace)
+                return trace.status
+            journal.mark_resumed(entry)
+        else:
+            entry = journal.start(job.user_id, payload, spool_job_id=job.job_id)
+            for sent in payload.get('delivered', []):
+                journal.record_uploaded(entry, sent)
+        try:
+            return await self.bot.process_video_file(message, context, payload['file_id'], payload['filename'],
+                                              payload['variant_count'], payload['cache_key'], trace, footprint,
+                                              entry)
+        finally:
+            self._running.pop(job.job_id, None)
+            if trace.status == 'interrupted':
+                # Воркер останавливается - задачу доделает другой процесс
+                self.spool.requeue(job.job_id, refund_attempt=False)
+            else:
+                self.spool.finish(job.job_id, trace.status)
+
+    async def give_up(self, job: SpoolJob, entry: JournalEntry, message: Message, trace: JobTrace):
+        """Снимает задачу, которая прерывалась слишком много раз"""
+        logger.warning(f"⚠️ Задача спула {job.job_id} прерывалась {entry.resumes} раз, не возобновляю")
+        self._running.pop(job.job_id, None)
+        self.bot.journal.finish(entry)
+        self.spool.finish(job.job_id, 'failed')
+        trace.finish('failed')
+        try:
+            await message.reply_text(
+                "❌ Не удалось обработать видео: обработка несколько раз прерывалась перезапуском\n\n"
+                "💡 Попробуйте отправить видео меньшего размера"
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {job.user_id}: {e}")
+
+    def drop_job(self, job: SpoolJob):
+        """Задачу спула отменили, пока она ждала в локальной очереди воркера"""
+        self._running.pop(job.job_id, None)
+        self.spool.finish(job.job_id, 'cancelled')
+    
+    def fill_slots(self):
+        """Забирает задачи из спула, пока у локального планировщика есть свободные воркеры"""
+        scheduler = self.bot.scheduler
+        while scheduler.running_count + scheduler.queued_count < scheduler.workers:
+            job = self.spool.claim(self.worker_id)
+            if job is None:
+                return
+            footprint = self.estimate_footprint(job)
+            try:
+                scheduler.submit(job.user_id, lambda job=job, footprint=footprint: self.run_job(job, footprint),
+                                 footprint, on_cancel=lambda job=job: self.drop_job(job))
+            except QueueLimitExceeded:
+                self.spool.requeue(job.job_id)
+                return
+            self._running[job.job_id] = job
+            logger.info(f"🛠 Воркер {self.worker_id}: задача спула {job.job_id} "
+                        f"пользователя {job.user_id}, попытка {job.attempts}")
+
+    def purge(self):
+        """Удаляет старые завершённые задачи спула и записи журнала, которые уже не продолжатся"""
+        self.spool.purge()
+        journal = self.bot.journal
+        orphaned = self.spool.inactive(journal.spool_job_ids())
+        if orphaned:
+            # Файлы таких задач больше не защищены и уйдут при очередной уборке
+            journal.forget_spool_jobs(orphaned)
+            logger.info(f"🧹 Удалено записей журнала завершённых задач спула: {len(orphaned)}")
+        self._purged_at = time.monotonic()
+
+    def poll(self):
+        """Heartbeat взятых задач, отмены пользователей и новые задачи"""
+        if time.monotonic() - self._purged_at >= SPOOL_PURGE_INTERVAL:
+            self.purge()
+        self.spool.heartbeat(self._running)
+        for job_id in self.spool.cancel_requested(self._running):
+            # Задачи пользователя, ждавшие в локальной очереди, уже сняты через drop_job
+            job = self._running.pop(job_id, None)
+            if job is None:
+                continue
+            self.bot.scheduler.cancel_user_jobs(job.user_id)
+            self.spool.finish(job_id, 'cancelled')
+        self.fill_slots()
+
+    async def run(self):
+        """Запуск воркера до SIGINT/SIGTERM"""
+        settings.temp_dir.mkdir(exist_ok=True)
+        settings.output_dir.mkdir(exist_ok=True)
+
+        # Бот нужен только для запросов к Bot API, обновления получает процесс бота
+        await self.bot.application.initialize()
+        # Метрики воркера - о его собственных задачах
+        JOBS_IN_FLIGHT.set_function(lambda: self.bot.scheduler.running_count)
+        JOBS_QUEUED.set_function(lambda: self.bot.scheduler.queued_count)
+
+        stop_task = asyncio.ensure_future(self.bot.wait_for_stop_signal())
+        try:
+            # Метрики - на своём порту воркера, файлы удаляет уборка процесса бота
+            await self.bot.start_services(metrics_port=settings.worker_metrics_port, remove_files=False)
+            logger.info(f"🛠 Воркер {self.worker_id} запущен: задач одновременно {self.bot.scheduler.workers}, "
+                        f"спул {self.spool.db_path}")
+            while not stop_task.done():
+                try:
+                    self.poll()
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка спула задач: {e}")
+                await asyncio.wait([stop_task], timeout=settings.spool_poll_interval)
+            logger.info("Получен сигнал остановки")
+        finally:
+            stop_task.cancel()
+            self.bot.stopping = True
+            await self.bot.scheduler.stop()
+            # Взятые, но не начатые задачи возвращаем в очередь
+            for job_id in list(self._running):
+                self.spool.requeue(job_id)
+            self._running.clear()
+            await self.bot.stop_services()
+            await self.bot.application.shutdown()
+
+
+async def worker_main():
+    """Главная функция процесса-воркера"""
+    if not settings.bot_token:
+        logger.error("BOT_TOKEN не установлен! Проверьте файл .env")
+        return False
+
+    bot = VideoBot()
+    if bot.spool is None:
+        # Воркер всегда работает через спул, даже если ENCODE_BACKEND не задан
+        bot.spool = JobSpool(settings.spool_path, settings.spool_stale_seconds)
+    await SpoolWorker(bot, bot.spool).run()
+    return True
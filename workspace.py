@@ -0,0 +1,113 @@
+import logging
+import shutil
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Сигнатура EBML (Matroska/WebM): такие файлы читаются потоком без перемотки
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+
+
+def is_streamable(data: bytes) -> bool:
+    """
+    Можно ли подать файл FFmpeg через pipe (без перемотки).
+    MP4/MOV - только если moov идёт перед mdat (faststart), Matroska/WebM - всегда;
+    остальные контейнеры на всякий случай считаются нечитаемыми потоком
+    """
+    if data[:4] == EBML_MAGIC:
+        return True
+    if data[4:8] != b'ftyp':
+        return False
+
+    # Обходим атомы верхнего уровня ISO BMFF: размер (4 байта) + тип (4 байта)
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat':
+            return False
+        if size == 1:
+            # 64-битный размер идёт сразу за типом
+            if offset + 16 > len(data):
+                return False
+            size = struct.unpack('>Q', data[offset + 8:offset + 16])[0]
+        elif size == 0:
+            # Атом до конца файла
+            return False
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+@dataclass
+class JobWorkspace:
+    """Каталоги задачи и сколько места она зарезервировала в RAM"""
+    temp_dir: Path
+    output_dir: Path
+    in_ram: bool = False
+    reserved_bytes: int = 0
+
+
+class WorkspaceManager:
+    """
+    Выдаёт задачам рабочие каталоги: в RAM (tmpfs, /dev/shm), пока оценка
+    задачи укладывается в ram_workspace_max_mb и в свободное место tmpfs,
+    иначе - обычные temp_dir и output_dir на диске
+    """
+
+    def __init__(self, ram_dir: Path):
+        self.ram_dir = ram_dir
+        self.reserved = 0
+        self._ram_ready: Optional[bool] = None
+
+    def _prepare_ram_dir(self) -> bool:
+        """Создаёт каталог в RAM при первом обращении; недоступный каталог отключает режим"""
+        if self._ram_ready is None:
+            try:
+                self.ram_dir.mkdir(parents=True, exist_ok=True)
+                self._ram_ready = True
+                logger.info(f"🧠 Рабочий каталог в RAM: {self.ram_dir} "
+                            f"(до {settings.ram_workspace_max_mb}MB)")
+            except OSError as e:
+                self._ram_ready = False
+                logger.warning(f"⚠️ Каталог в RAM {self.ram_dir} недоступен, работаю на диске: {e}")
+        return self._ram_ready
+
+    def acquire(self, expected_bytes: int) -> JobWorkspace:
+        """Каталоги для задачи с оценкой пикового места expected_bytes"""
+        disk = JobWorkspace(settings.temp_dir, settings.output_dir)
+        if not settings.ram_workspace_enabled or not self._prepare_ram_dir():
+            return disk
+
+        if self.reserved + expected_bytes > settings.ram_workspace_max_mb * MB:
+            logger.info(f"RAM-каталог занят ({self.reserved / MB:.0f}MB из "
+                        f"{settings.ram_workspace_max_mb}MB), задача работает на диске")
+            return disk
+        try:
+            if shutil.disk_usage(self.ram_dir).free < expected_bytes:
+                logger.info("В tmpfs не хватает места, задача работает на диске")
+                return disk
+        except OSError:
+            return disk
+
+        self.reserved += expected_bytes
+        return JobWorkspace(self.ram_dir, self.ram_dir, in_ram=True, reserved_bytes=expected_bytes)
+
+    def release(self, workspace: JobWorkspace):
+        """Освобождает резерв задачи в RAM"""
+        if workspace.in_ram:
+            self.reserved = max(0, self.reserved - workspace.reserved_bytes)
+            workspace.reserved_bytes = 0
+
+
+# Глобальный распределитель рабочих каталогов
+workspace_manager = WorkspaceManager(settings.ram_workspace_dir)